@@ -0,0 +1,85 @@
+"""Let MongoDB bin the points, rather than downloading every one of them.
+
+``aggregate_points`` runs an aggregation pipeline that groups the valid
+points by minute of the day and by a ``grid`` degree latitude/longitude
+cell, and returns only the non-empty bins.  Each bin becomes a point at the
+centre of its cell, with ``count`` set to the number of photos in it, so the
+rest of the visualizer treats it as a weighted point.
+
+Points move by at most half a grid cell, so ``grid`` should be well below
+the size of a heatmap bin (about 0.7 degrees for the World camera at 500
+bins).  Timezone offsets are not kept.
+"""
+import logging
+import numpy as np
+import pymongo
+
+from extract_data import (get_cursors, ensure_location_index,
+                          VALID_POINTS_QUERY)
+from point_dataset import (PointDataset, COLUMNS, MISSING_OFFSET)
+
+AGGREGATE_GRID = 0.05
+
+
+def ensure_point_indexes(ig_mongo):
+    """Create the indexes that the aggregation's match stage can use"""
+    ig_mongo.ensure_index("created_time")
+    ig_mongo.ensure_index([("latitude", pymongo.ASCENDING),
+                           ("longitude", pymongo.ASCENDING)])
+    ensure_location_index(ig_mongo)
+
+
+def grid_cell(field, shift, grid):
+    """Aggregation expression for the index of the ``grid`` sized cell that
+    ``field`` falls in, after adding ``shift`` to make it positive.  This
+    is an exact integer, unlike the edge of the cell in degrees, which
+    comes out of the arithmetic on doubles as e.g. 12.350000000000001"""
+    index = {"$divide": [{"$add": ["$" + field, shift]}, grid]}
+    return {"$subtract": [index, {"$mod": [index, 1]}]}
+
+
+def aggregation_pipeline(grid=AGGREGATE_GRID, query=None):
+    """Pipeline that counts the points matching ``query`` (by default every
+    valid point, see also ``viewport.points_query``) in each grid cell for
+    each minute of the day"""
+    return [
+        {"$match": query if query is not None else VALID_POINTS_QUERY},
+        {"$group": {
+            "_id": {"lat": grid_cell("latitude", 90, grid),
+                    "lng": grid_cell("longitude", 180, grid),
+                    "minutes": {"$add": [
+                        {"$multiply": [{"$hour": "$created_time"}, 60]},
+                        {"$minute": "$created_time"}]}},
+            "count": {"$sum": 1}}}]
+
+
+def aggregate_points(ig_mongo=None, grid=AGGREGATE_GRID, query=None,
+                     batch_size=10000):
+    """Return a ``PointDataset`` of the non-empty bins that MongoDB groups
+    the points into, see ``aggregation_pipeline``"""
+    if ig_mongo is None:
+        ig_mongo, _ = get_cursors()
+    ensure_point_indexes(ig_mongo)
+
+    cursor = ig_mongo.aggregate(aggregation_pipeline(grid, query),
+                                allowDiskUse=True,
+                                cursor={"batchSize": batch_size})
+    lat, lon, minutes, count = [], [], [], []
+    for res in cursor:
+        lat.append(res["_id"]["lat"])
+        lon.append(res["_id"]["lng"])
+        minutes.append(res["_id"]["minutes"])
+        count.append(res["count"])
+
+    dtypes = dict(COLUMNS)
+    points = PointDataset(
+        lat=((np.array(lat) + 0.5)*grid - 90).astype(dtypes["lat"]),
+        lon=((np.array(lon) + 0.5)*grid - 180).astype(dtypes["lon"]),
+        minutes=np.array(minutes, dtype=dtypes["minutes"]),
+        offset=np.empty(len(lat), dtype=dtypes["offset"]),
+        count=np.array(count, dtype=np.float64))
+    points.offset.fill(MISSING_OFFSET)
+
+    logging.getLogger().info("MongoDB grouped %d points into %d bins" %
+                             (int(points.count.sum()), len(points)))
+    return points
@@ -0,0 +1,699 @@
+"""Benchmarks of the visualizer's data paths against synthetic data.
+
+    python benchmarks.py aggregate --num_points 1000000
+
+loads ``num_points`` synthetic photos into a scratch collection on a local
+mongod (once; later runs reuse them), then times downloading every point
+against letting MongoDB aggregate them (``--aggregate_in_db``), and reports
+how far apart the resulting heatmaps are.
+
+    python benchmarks.py density --grid_sizes 500 2000 --num_points 1000000
+
+times each ``--density`` backend on heatmaps of each grid size, made from
+each number of synthetic photos, and reports the extra peak memory it needs
+and how far its result is from ``gaussian_filter``'s.  Each run is in a
+fresh process, so that the peak memory of one doesn't hide another's.
+
+    python benchmarks.py high_resolution --resolution 3840x2160
+
+makes one frame's heatmap at that resolution, from synthetic photos on a
+plain latitude/longitude grid, both the usual float64 way and with
+``--resolution``'s float32 in place pipeline, and reports the time and the
+extra peak memory of each (the map and canvas are not included).
+
+    python benchmarks.py --results before.json stages --num_points 10000 100000
+
+runs each stage of the pipeline (``STAGES``) on synthetic photos, without
+MongoDB or geonames: ``local_services`` stands in for both.  Each stage is
+run in a fresh process with ``profiling`` on, and its time, extra peak
+memory and the spans and counters inside it are reported.  With
+``--results`` the results are also saved, and
+
+    python benchmarks.py compare before.json after.json
+
+gives the ratio of each stage's time and memory between two saved runs.
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import datetime
+import logging
+import multiprocessing
+import resource
+import tempfile
+import timeit
+import traceback
+import numpy as np
+import pymongo
+from scipy.ndimage.filters import gaussian_filter
+
+import profiling
+from configs import (cameras, ValidRegions)
+from extract_data import (read_points_from_mongo, read_results_from_mongo,
+                          add_timezone_info, geojson_point, LOCATION_FIELD)
+from aggregate import (aggregate_points, AGGREGATE_GRID)
+from density import DENSITY_BACKENDS
+from density import SeparableDensity
+from frame_sinks import DEFAULT_ENCODER
+from geonames import GeonamesClient
+from high_resolution import (BinnedPoints, finish_heatmap, heatmap_shape,
+                             uint8_lut, parse_resolution,
+                             DEFAULT_PIXELS_PER_BIN)
+from instagram_map_collect import Collector
+from instagram_map_visualize import (build_histogram_cube, build_color_lut,
+                                     fix_opacity_and_color_map,
+                                     decay_weights, calculate_point_weights,
+                                     make_map_sequence)
+from local_services import (MemoryCollection, LocalGeonamesServer)
+from point_dataset import (PointDataset, COLUMNS)
+from snapshot import column_file
+from timezone_cache import TimezoneCache
+from utils import TimedLogger
+
+
+# Relative number of photos taken in each hour of the day, local time:
+# few overnight, rising through the morning, with peaks at lunchtime and in
+# the evening
+HOURLY_ACTIVITY = np.array([3.0, 2.0, 1.3, 0.9, 0.7, 0.8, 1.4, 2.4, 3.3, 3.8,
+                            4.1, 4.5, 5.0, 4.9, 4.6, 4.5, 4.7, 5.1, 5.6, 6.0,
+                            6.1, 5.8, 5.0, 4.0])
+
+# Points generated at a time by ``synthetic_dataset``
+SYNTHETIC_CHUNK_SIZE = 1000000
+
+# Everything ``stages`` can time, in the order they run
+STAGES = ("calculate_point_weights", "histogram", "blur",
+          "fix_opacity_and_color_map", "make_map_sequence",
+          "read_results_from_mongo", "read_points_from_mongo",
+          "collector_insert", "timezone_backfill")
+
+
+def synthetic_offset_hours(lon):
+    """The UTC offset, in hours, that the synthetic photos at ``lon`` are
+    given: the nautical timezone"""
+    return np.round(np.asarray(lon)/15.)
+
+
+class SyntheticPoints(object):
+    """Generates fake photos, a chunk at a time, that look like the
+    collection does.
+
+    Photos are scattered around ``ncities`` random centres with a standard
+    deviation of ``spread`` degrees, with city sizes following Zipf's law,
+    and ``background_fraction`` of them are spread evenly over the globe.
+    Each photo is taken on one of ``days`` days, at a local time of day
+    drawn from ``HOURLY_ACTIVITY``, so the UTC times of day move with
+    longitude as real ones do.
+    """
+
+    def __init__(self, seed=0, ncities=200, spread=0.5,
+                 background_fraction=0.1, days=30):
+        self.rng = np.random.RandomState(seed)
+        self.city_lat = self.rng.uniform(-60, 70, ncities)
+        self.city_lon = self.rng.uniform(-179, 179, ncities)
+        city_size = 1./np.arange(1, ncities + 1)
+        self.city_p = city_size/city_size.sum()
+        self.spread = spread
+        self.background_fraction = background_fraction
+        self.days = days
+
+    def chunk(self, num_points):
+        """Return ``(lat, lon, seconds)`` arrays for the next
+        ``num_points`` photos, where ``seconds`` is the UTC time each was
+        taken, in seconds from the start of the first day"""
+        rng = self.rng
+        city = rng.choice(len(self.city_p), num_points, p=self.city_p)
+        lat = self.city_lat[city] + rng.normal(0, self.spread, num_points)
+        lon = self.city_lon[city] + rng.normal(0, self.spread, num_points)
+        del city
+        background = rng.uniform(0, 1, num_points) < self.background_fraction
+        lat[background] = rng.uniform(-89, 89, background.sum())
+        lon[background] = rng.uniform(-179, 179, background.sum())
+        np.clip(lat, -89.99, 89.99, out=lat)
+        np.clip(lon, -179.99, 179.99, out=lon)
+
+        hour = rng.choice(24, num_points,
+                          p=HOURLY_ACTIVITY/HOURLY_ACTIVITY.sum())
+        seconds = (86400*rng.randint(0, self.days, num_points) +
+                   3600*hour + rng.randint(0, 3600, num_points) -
+                   (3600*synthetic_offset_hours(lon)).astype(np.int64))
+        seconds %= 86400*self.days
+        return lat, lon, seconds
+
+
+def synthetic_points(num_points, seed=0, **kwargs):
+    """Return ``(lat, lon, seconds)`` arrays for ``num_points`` fake
+    photos, see ``SyntheticPoints``"""
+    return SyntheticPoints(seed=seed, **kwargs).chunk(num_points)
+
+
+def synthetic_dataset(num_points, seed=0, directory=None,
+                      chunk_size=SYNTHETIC_CHUNK_SIZE, **kwargs):
+    """Return a ``PointDataset`` of ``num_points`` fake photos, generated
+    ``chunk_size`` at a time, so that only the 14 bytes per photo of the
+    dataset itself need to fit in memory.  If ``directory`` is given, the
+    columns are memory-mapped files there, laid out as in a snapshot, so
+    that 10^8 photos (1.4GB) need not fit either"""
+    columns = {}
+    for name, dtype in COLUMNS:
+        if directory is None:
+            columns[name] = np.empty(num_points, dtype=dtype)
+        else:
+            columns[name] = np.memmap(column_file(directory, name),
+                                      dtype=dtype, mode="w+",
+                                      shape=(max(num_points, 1),))
+    generator = SyntheticPoints(seed=seed, **kwargs)
+    for start in range(0, num_points, chunk_size):
+        stop = min(start + chunk_size, num_points)
+        lat, lon, seconds = generator.chunk(stop - start)
+        columns["lat"][start:stop] = lat
+        columns["lon"][start:stop] = lon
+        columns["minutes"][start:stop] = (seconds // 60) % (24*60)
+        columns["offset"][start:stop] = 3600*synthetic_offset_hours(lon)
+    return PointDataset(**dict((name, array[:num_points])
+                               for name, array in columns.items()))
+
+
+def synthetic_documents(num_points, seed=0,
+                        start=datetime.datetime(2014, 3, 1),
+                        with_offset=True):
+    """Yield MongoDB documents like the collector's for
+    ``synthetic_points``, without the timezone offset unless
+    ``with_offset`` is set"""
+    lat, lon, seconds = synthetic_points(num_points, seed=seed)
+    offsets = synthetic_offset_hours(lon)
+    for i in xrange(num_points):
+        doc = {"_id": "synthetic_%d" % i,
+               "latitude": float(lat[i]),
+               "longitude": float(lon[i]),
+               "created_time": start + datetime.timedelta(
+                   seconds=int(seconds[i])),
+               "schema": 1}
+        location = geojson_point(doc["latitude"], doc["longitude"])
+        if location is not None:
+            doc[LOCATION_FIELD] = location
+        if with_offset:
+            doc["offset"] = float(offsets[i])
+        yield doc
+
+
+def load_synthetic_collection(collection, num_points, seed=0,
+                              batch_size=10000):
+    """Fill ``collection`` with ``num_points`` synthetic documents, unless it
+    already holds exactly that many"""
+    if collection.count() == num_points:
+        return
+    collection.drop()
+    batch = []
+    for doc in synthetic_documents(num_points, seed=seed):
+        batch.append(doc)
+        if len(batch) == batch_size:
+            collection.insert(batch)
+            batch = []
+    if batch:
+        collection.insert(batch)
+
+
+def time_call(func, *args, **kwargs):
+    """Return ``(result, seconds)`` for calling ``func``"""
+    start = timeit.default_timer()
+    result = func(*args, **kwargs)
+    return result, timeit.default_timer() - start
+
+
+def benchmark_aggregate(args):
+    """Compare the full download and ``--aggregate_in_db`` data paths"""
+    collection = pymongo.MongoClient(args.mongo_uri)[args.database].ig
+    _, load_seconds = time_call(load_synthetic_collection, collection,
+                                args.num_points, seed=args.seed)
+    camera = cameras[args.region]
+    frame = datetime.datetime(2014, 1, 1, 12, 0, 0)
+
+    results = {"num_points": args.num_points, "region": args.region,
+               "grid": args.grid, "load_seconds": load_seconds}
+    histograms = {}
+    for name, read in (
+            ("download", lambda: read_points_from_mongo(ig_mongo=collection)),
+            ("aggregate", lambda: aggregate_points(collection,
+                                                   grid=args.grid))):
+        points, read_seconds = time_call(read)
+        cube, cube_seconds = time_call(build_histogram_cube, points, camera,
+                                       minutes_step=args.minutes_step)
+        histograms[name] = cube.histogram(frame)[0]
+        results[name] = {"rows": len(points), "bytes": points.nbytes,
+                         "read_seconds": read_seconds,
+                         "cube_seconds": cube_seconds}
+
+    difference = np.abs(histograms["aggregate"] - histograms["download"])
+    results["relative_l1_difference"] = (difference.sum() /
+                                         histograms["download"].sum())
+    return results
+
+
+def measure_density(backend_name, im, sigma, repeat, queue):
+    """Put the timings of one density backend smoothing ``im``, and the
+    memory it used on top of what the process already had, on ``queue``.
+    Run in a child process by ``benchmark_density``"""
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    backend = DENSITY_BACKENDS[backend_name]()
+    smooth_seconds = []
+    for _ in range(repeat):
+        smoothed, seconds = time_call(backend.smooth, im, sigma)
+        smooth_seconds.append(seconds)
+
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    difference = np.abs(smoothed - gaussian_filter(im, sigma)).max()
+    queue.put({"first_smooth_seconds": smooth_seconds[0],
+               "smooth_seconds": min(smooth_seconds),
+               "peak_extra_bytes": 1024*(peak - baseline),
+               "max_difference": float(difference)})
+
+
+def benchmark_density(args):
+    """Compare the density backends over grid sizes and point counts"""
+    results = {"sigma": args.sigma, "repeat": args.repeat, "cases": []}
+    for num_points in args.num_points:
+        lat, lon, _ = synthetic_points(num_points, seed=args.seed)
+        for nheatmapbins in args.grid_sizes:
+            bins = (nheatmapbins, int((9./16.)*nheatmapbins))
+            (histogram, _, _), histogram_seconds = time_call(
+                np.histogram2d, lon, lat, bins=bins,
+                range=((-180, 180), (-90, 90)))
+            im = np.log(np.rot90(histogram) + 1)
+
+            for backend_name in args.backends:
+                queue = multiprocessing.Queue()
+                process = multiprocessing.Process(
+                    target=measure_density,
+                    args=(backend_name, im, args.sigma, args.repeat, queue))
+                process.start()
+                case = queue.get()
+                process.join()
+                case.update({"backend": backend_name,
+                             "num_points": num_points,
+                             "nheatmapbins": nheatmapbins,
+                             "image_bytes": im.nbytes,
+                             "histogram_seconds": histogram_seconds})
+                results["cases"].append(case)
+    return results
+
+
+def float64_heatmap(lat, lon, minutes, shape, frame):
+    """One frame's RGBA heatmap the way ``make_single_map`` makes it"""
+    weights = decay_weights(minutes, frame)
+    im, _, _ = np.histogram2d(lon, lat, bins=shape[::-1],
+                              range=((-180, 180), (-90, 90)),
+                              weights=weights)
+    im = np.log(np.rot90(im) + 1)
+    return fix_opacity_and_color_map(gaussian_filter(im, 1))
+
+
+def float32_heatmap(lat, lon, minutes, shape, frame):
+    """One frame's RGBA heatmap the way ``--resolution`` makes it"""
+    points = BinnedPoints(lat, lon, minutes, (-180, 180), (-90, 90), shape,
+                          lambda lon, lat: (lon, lat))
+    grid = points.accumulate(
+        lambda start, stop: decay_weights(points.minutes[start:stop], frame))
+    return finish_heatmap(grid, uint8_lut(build_color_lut()), sigma=1,
+                          density=SeparableDensity())
+
+
+def measure_heatmap(make_heatmap, lat, lon, minutes, shape, queue):
+    """Put the time and extra peak memory of ``make_heatmap`` on ``queue``.
+    Run in a child process by ``benchmark_high_resolution``"""
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    frame = datetime.datetime(2014, 1, 1, 12, 0, 0)
+    rgba, seconds = time_call(make_heatmap, lat, lon, minutes, shape, frame)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({"seconds": seconds, "peak_extra_bytes": 1024*(peak - baseline),
+               "heatmap_bytes": rgba.nbytes})
+
+
+def benchmark_high_resolution(args):
+    """Compare the memory of the float64 and float32 heatmap pipelines"""
+    lat, lon, seconds = synthetic_points(args.num_points, seed=args.seed)
+    minutes = ((seconds // 60) % (24*60)).astype(np.int16)
+    shape = heatmap_shape(args.resolution, args.pixels_per_bin)
+
+    results = {"resolution": "%dx%d" % tuple(args.resolution),
+               "bins": "%dx%d" % (shape[1], shape[0]),
+               "num_points": args.num_points}
+    for name, make_heatmap in (("float64", float64_heatmap),
+                               ("float32", float32_heatmap)):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=measure_heatmap,
+            args=(make_heatmap, lat, lon, minutes, shape, queue))
+        process.start()
+        results[name] = queue.get()
+        process.join()
+    return results
+
+
+def trace_summary(trace_path):
+    """Total seconds and number of calls of each span name in a jsonl
+    trace, and the counter totals"""
+    spans = {}
+    counters = {}
+    with open(trace_path) as f:
+        for line in f:
+            event = json.loads(line)
+            if event["type"] == "totals":
+                counters = dict((name, value) for name, value in event.items()
+                                if name not in ("type", "max_rss_bytes"))
+            else:
+                span = spans.setdefault(event["name"],
+                                        {"seconds": 0.0, "calls": 0})
+                span["seconds"] += event["seconds"]
+                span["calls"] += 1
+    return spans, counters
+
+
+def measure_stage(func, trace_path, queue):
+    """Put the time and extra peak memory of calling ``func``, and a
+    summary of the profiling spans inside it, on ``queue``.  Run in a child
+    process by ``run_stage``"""
+    try:
+        profiling.enable(trace_path)
+        baseline = profiling.max_rss()
+        _, seconds = time_call(func)
+        peak = profiling.max_rss()
+        profiling.disable()
+        spans, counters = trace_summary(trace_path)
+        queue.put({"seconds": seconds, "peak_extra_bytes": peak - baseline,
+                   "spans": spans, "counters": counters})
+    except Exception:
+        queue.put({"error": traceback.format_exc()})
+
+
+def run_stage(func, trace_path):
+    """Time ``func`` in a fresh process, see ``measure_stage``"""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure_stage,
+                                      args=(func, trace_path, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    if "error" in result:
+        logging.getLogger().error("Stage failed:\n%s" % result["error"])
+    return result
+
+
+def insert_in_batches(collection, documents, batch_size):
+    """Save ``documents`` through ``Collector.insert``, ``batch_size`` at a
+    time, as the collector's writer thread does"""
+    collector = Collector(collection, geo=None, api=None)
+    for start in range(0, len(documents), batch_size):
+        collector.insert(documents[start:start + batch_size])
+
+
+def stage_functions(args, points, num_documents, scratch_dir, geonames_url):
+    """Yield ``(stage, func)`` for each of the ``args.stages`` on
+    ``points`` (or on ``num_documents`` synthetic documents, for the stages
+    that read or write MongoDB), with the inputs each needs made up front
+    so that only the stage itself is measured"""
+    frame = datetime.datetime(2014, 1, 1, 12, 0, 0)
+    bins = (500, int((9./16.)*500))
+    stages = set(args.stages)
+    if stages & set(STAGES[:4]):
+        lat, lon, weights = calculate_point_weights(points, frame)
+        histogram, _, _ = np.histogram2d(lon, lat, bins=bins,
+                                         range=((-180, 180), (-90, 90)),
+                                         weights=weights)
+        im = np.log(np.rot90(histogram) + 1)
+        density = DENSITY_BACKENDS[args.density]()
+        smoothed = density.smooth(im, args.gauss_sigma)
+
+    if "calculate_point_weights" in stages:
+        yield ("calculate_point_weights",
+               lambda: calculate_point_weights(points, frame))
+    if "histogram" in stages:
+        yield ("histogram",
+               lambda: np.histogram2d(lon, lat, bins=bins,
+                                      range=((-180, 180), (-90, 90)),
+                                      weights=weights))
+    if "blur" in stages:
+        yield "blur", lambda: density.smooth(im, args.gauss_sigma)
+    if "fix_opacity_and_color_map" in stages:
+        yield ("fix_opacity_and_color_map",
+               lambda: fix_opacity_and_color_map(smoothed))
+
+    if "make_map_sequence" in stages:
+        render_args = argparse.Namespace(
+            region=args.region, minutes_step=args.minutes_step,
+            data_dir=os.path.join(scratch_dir, "frames"),
+            background_cache_dir=args.background_cache_dir,
+            workers=args.workers, output="png", fps=24,
+            encoder=DEFAULT_ENCODER, density=args.density,
+            gauss_sigma=args.gauss_sigma)
+        if not os.path.exists(render_args.data_dir):
+            os.makedirs(render_args.data_dir)
+
+        def render():
+            # As ``render_region`` does it, with the histogram cube
+            cube = build_histogram_cube(points, cameras[args.region],
+                minutes_step=args.minutes_step,
+                background_cache_dir=args.background_cache_dir)
+            make_map_sequence(render_args, points, cube=cube)
+        yield "make_map_sequence", render
+
+    if stages & set(STAGES[5:7]):
+        collection = MemoryCollection(synthetic_documents(num_documents,
+                                                          seed=args.seed))
+    if "read_results_from_mongo" in stages:
+        yield ("read_results_from_mongo",
+               lambda: read_results_from_mongo(ig_mongo=collection))
+    if "read_points_from_mongo" in stages:
+        yield ("read_points_from_mongo",
+               lambda: read_points_from_mongo(ig_mongo=collection))
+
+    if "collector_insert" in stages:
+        documents = list(synthetic_documents(num_documents, seed=args.seed,
+                                             with_offset=False))
+        yield ("collector_insert",
+               lambda: insert_in_batches(MemoryCollection(), documents,
+                                         args.batch_size))
+
+    if "timezone_backfill" in stages:
+        missing = MemoryCollection(synthetic_documents(num_documents,
+                                                       seed=args.seed,
+                                                       with_offset=False))
+
+        def backfill():
+            client = GeonamesClient("benchmark", base_url=geonames_url,
+                                    hourly_limit=None, daily_limit=None,
+                                    max_connections=args.geonames_workers)
+            add_timezone_info(workers=args.geonames_workers,
+                              chunk_size=args.chunk_size, ig_mongo=missing,
+                              geo=TimezoneCache(client))
+        yield "timezone_backfill", backfill
+
+
+def benchmark_stages(args):
+    """Time and measure the memory of each stage of the pipeline on
+    synthetic photos, with MongoDB and geonames replaced by
+    ``local_services``"""
+    scratch_dir = args.scratch_dir
+    if scratch_dir is None:
+        scratch_dir = tempfile.mkdtemp(prefix="instagram_benchmark")
+    elif not os.path.exists(scratch_dir):
+        os.makedirs(scratch_dir)
+    server = LocalGeonamesServer(latency=args.geonames_latency)
+
+    results = {"region": args.region, "minutes_step": args.minutes_step,
+               "density": args.density, "gauss_sigma": args.gauss_sigma,
+               "workers": args.workers, "seed": args.seed,
+               "geonames_latency": args.geonames_latency,
+               "generate_seconds": {}, "cases": []}
+    try:
+        for num_points in args.num_points:
+            points, generate_seconds = time_call(synthetic_dataset,
+                                                 num_points, seed=args.seed)
+            results["generate_seconds"][str(num_points)] = generate_seconds
+            num_documents = min(num_points, args.max_documents)
+
+            for stage, func in stage_functions(args, points, num_documents,
+                                               scratch_dir, server.base_url):
+                with TimedLogger("Measuring %s on %d points" %
+                                 (stage, num_points), logging.getLogger()):
+                    case = run_stage(func, profiling.trace_path(
+                        os.path.join(scratch_dir, "%s_%d" % (stage,
+                                                             num_points))))
+                case.update({"stage": stage, "num_points": num_points})
+                if stage in STAGES[5:]:
+                    case["num_documents"] = num_documents
+                results["cases"].append(case)
+            del points
+    finally:
+        server.close()
+        if args.scratch_dir is None:
+            shutil.rmtree(scratch_dir)
+    return results
+
+
+def compare_results(args):
+    """Ratio of the time and peak memory of each stage in ``args.new`` to
+    that in ``args.old``, both results of ``stages`` saved with
+    ``--results``"""
+    with open(args.old) as f:
+        old = json.load(f)["results"]
+    with open(args.new) as f:
+        new = json.load(f)["results"]
+
+    old_cases = dict(((case["stage"], case["num_points"]), case)
+                     for case in old["cases"] if "error" not in case)
+    comparison = []
+    for case in new["cases"]:
+        before = old_cases.get((case["stage"], case["num_points"]))
+        if before is None or "error" in case:
+            continue
+        row = {"stage": case["stage"], "num_points": case["num_points"],
+               "old_seconds": before["seconds"],
+               "new_seconds": case["seconds"],
+               "seconds_ratio": case["seconds"]/max(before["seconds"], 1e-9)}
+        if before["peak_extra_bytes"] > 0:
+            row["peak_extra_bytes_ratio"] = (float(case["peak_extra_bytes"]) /
+                                             before["peak_extra_bytes"])
+        comparison.append(row)
+    return {"old": args.old, "new": args.new, "stages": comparison}
+
+
+def results_record(args, results):
+    """What ``--results`` saves: the results, with what was run and on
+    what, so that runs can be told apart and compared"""
+    arguments = dict((key, value) for key, value in vars(args).items()
+                     if key not in ("run", "results", "logfile"))
+    return {"benchmark": args.benchmark, "arguments": arguments,
+            "time": datetime.datetime.utcnow().isoformat(),
+            "python": sys.version.split()[0], "numpy": np.__version__,
+            "results": results}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmarks of the "
+        "visualizer against synthetic data.  Results are printed as JSON")
+    parser.add_argument('--logfile', type=str, default="benchmarks.log",
+                   help='Name of logfile')
+    parser.add_argument('--results', type=str, default=None,
+                   help='If given, then also save the results as JSON to '
+                   'this file, along with the arguments, for "compare"')
+    subparsers = parser.add_subparsers(dest="benchmark")
+
+    aggregate_parser = subparsers.add_parser("aggregate",
+        help="Download every point against aggregating in MongoDB")
+    aggregate_parser.add_argument('--num_points', type=int, default=1000000,
+                   help='Number of synthetic photos')
+    aggregate_parser.add_argument('--seed', type=int, default=0,
+                   help='Random seed for the synthetic photos')
+    aggregate_parser.add_argument('--mongo_uri', type=str,
+                   default="mongodb://localhost:27017",
+                   help='MongoDB to load the synthetic photos into')
+    aggregate_parser.add_argument('--database', type=str,
+                   default="instagram_benchmark",
+                   help='Scratch database for the synthetic photos')
+    aggregate_parser.add_argument('--region', type=ValidRegions,
+                   default="World", help='Camera to bin the points for')
+    aggregate_parser.add_argument('--minutes_step', type=int, default=60,
+                   help='Minutes between frames')
+    aggregate_parser.add_argument('--grid', type=float,
+                   default=AGGREGATE_GRID,
+                   help='Size in degrees of the aggregation grid cells')
+    aggregate_parser.set_defaults(run=benchmark_aggregate)
+
+    density_parser = subparsers.add_parser("density",
+        help="Speed and memory of the heatmap density backends")
+    density_parser.add_argument('--backends', nargs='+',
+                   choices=sorted(DENSITY_BACKENDS),
+                   default=sorted(DENSITY_BACKENDS),
+                   help='Backends to compare')
+    density_parser.add_argument('--grid_sizes', type=int, nargs='+',
+                   default=[500, 1000, 2000],
+                   help='Values of nheatmapbins to try')
+    density_parser.add_argument('--num_points', type=int, nargs='+',
+                   default=[100000, 1000000],
+                   help='Numbers of synthetic photos to try')
+    density_parser.add_argument('--sigma', type=float, default=1,
+                   help='Width of the blur in heatmap bins')
+    density_parser.add_argument('--repeat', type=int, default=3,
+                   help='Number of times to time each backend, of which '
+                   'the quickest is reported')
+    density_parser.add_argument('--seed', type=int, default=0,
+                   help='Random seed for the synthetic photos')
+    density_parser.set_defaults(run=benchmark_density)
+
+    resolution_parser = subparsers.add_parser("high_resolution",
+        help="Memory of the float64 and float32 heatmap pipelines")
+    resolution_parser.add_argument('--resolution', type=parse_resolution,
+                   default=(3840, 2160),
+                   help='Frame size, as WIDTHxHEIGHT')
+    resolution_parser.add_argument('--pixels_per_bin', type=float,
+                   default=DEFAULT_PIXELS_PER_BIN,
+                   help='Size of a heatmap bin in pixels')
+    resolution_parser.add_argument('--num_points', type=int,
+                   default=1000000, help='Number of synthetic photos')
+    resolution_parser.add_argument('--seed', type=int, default=0,
+                   help='Random seed for the synthetic photos')
+    resolution_parser.set_defaults(run=benchmark_high_resolution)
+
+    stages_parser = subparsers.add_parser("stages",
+        help="Time and memory of each stage, without MongoDB or geonames")
+    stages_parser.add_argument('--num_points', type=int, nargs='+',
+                   default=[10000, 100000, 1000000],
+                   help='Numbers of synthetic photos to try, up to 10^8')
+    stages_parser.add_argument('--stages', nargs='+', choices=STAGES,
+                   default=list(STAGES), help='Stages to measure')
+    stages_parser.add_argument('--max_documents', type=int, default=100000,
+                   help='Most photos to put in the in-memory MongoDB '
+                   'stand-in, which needs about 1KB for each')
+    stages_parser.add_argument('--seed', type=int, default=0,
+                   help='Random seed for the synthetic photos')
+    stages_parser.add_argument('--region', type=ValidRegions,
+                   default="World", help='Camera to render frames for')
+    stages_parser.add_argument('--minutes_step', type=int, default=60,
+                   help='Minutes between frames of make_map_sequence')
+    stages_parser.add_argument('--density', choices=sorted(DENSITY_BACKENDS),
+                   default="gaussian_filter",
+                   help='How the heatmap is smoothed')
+    stages_parser.add_argument('--gauss_sigma', type=float, default=1,
+                   help='Width of the blur in heatmap bins')
+    stages_parser.add_argument('--workers', type=int, default=1,
+                   help='Number of processes make_map_sequence renders with')
+    stages_parser.add_argument('--background_cache_dir', type=str,
+                   default=None,
+                   help='Where to keep the rasterized map background')
+    stages_parser.add_argument('--scratch_dir', type=str, default=None,
+                   help='Where to put the synthetic points, frames and the '
+                   'trace of each stage.  Defaults to a temporary directory '
+                   'that is removed afterwards')
+    stages_parser.add_argument('--batch_size', type=int, default=100,
+                   help='Photos saved at once by collector_insert')
+    stages_parser.add_argument('--chunk_size', type=int, default=10000,
+                   help='Photos handled at a time by timezone_backfill')
+    stages_parser.add_argument('--geonames_workers', type=int, default=8,
+                   help='Concurrent requests to the geonames stand-in')
+    stages_parser.add_argument('--geonames_latency', type=float,
+                   default=0.02,
+                   help='Seconds the geonames stand-in takes to answer')
+    stages_parser.set_defaults(run=benchmark_stages)
+
+    compare_parser = subparsers.add_parser("compare",
+        help="Compare two runs of stages saved with --results")
+    compare_parser.add_argument('old', type=str, help='Earlier results')
+    compare_parser.add_argument('new', type=str, help='Later results')
+    compare_parser.set_defaults(run=compare_results)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(filename=args.logfile, level=logging.DEBUG)
+
+    results = args.run(args)
+    if args.results is not None:
+        with open(args.results, "w") as f:
+            json.dump(results_record(args, results), f, indent=2,
+                      sort_keys=True)
+    print json.dumps(results, indent=2, sort_keys=True)
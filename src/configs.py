@@ -77,3 +77,9 @@ def ValidRegions(v):
                                          str(cameras.keys()))
     else:
         return v
+
+def ValidRegionsOrAll(v):
+    """Like ``ValidRegions``, but also allows "all" """
+    if v == "all":
+        return v
+    return ValidRegions(v)
@@ -1,24 +1,69 @@
 """Functionality to add timezone offset relative to UTC to any entries in
 the instagram mongo table that requires them"""
 import os
+import timeit
+import argparse
 import pymongo
 import geonames
 import logging
+from multiprocessing.pool import ThreadPool
+from point_dataset import PointDatasetBuilder
+from timezone_cache import TimezoneCache
+from rate_limit import TokenBucket
+import profiling
 
-def get_cursors():
-    """Return cursor connections to the MongoDB database and to Geonames"""
+# Only points inside these bounds are drawn
+VALID_POINTS_QUERY = {"latitude": {"$gt": -90, "$lt": 90},
+                      "longitude": {"$gt": -180, "$lt": 180}}
+
+# The fields of each document that are needed to draw a map
+POINT_FIELDS = {"_id": False, "latitude": True, "longitude": True,
+                "created_time": True, "offset": True}
+
+# GeoJSON point field that the 2dsphere index, and so viewport queries, use
+LOCATION_FIELD = "location"
+
+def geojson_point(latitude, longitude):
+    """GeoJSON value for ``LOCATION_FIELD``, or None if the point is outside
+    ``VALID_POINTS_QUERY``, since the 2dsphere index rejects bad points"""
+    if not (-90 < latitude < 90 and -180 < longitude < 180):
+        return None
+    return {"type": "Point", "coordinates": [longitude, latitude]}
+
+def ensure_location_index(ig_mongo):
+    ig_mongo.ensure_index([(LOCATION_FIELD, pymongo.GEOSPHERE)])
+
+def optional_int(value):
+    return None if value is None else int(value)
+
+def get_cursors(block_on_limit=False, geonames_timeout=10):
+    """Return cursor connections to the MongoDB database and to Geonames.
+    If ``block_on_limit`` is set then geonames calls wait for the client
+    side rate limit rather than failing.  Geonames requests time out after
+    ``geonames_timeout`` seconds"""
 
     geonames_username = os.environ.get("GEONAMES_USERNAME", None)
     if geonames_username is None:
         raise ValueError("GEONAMES_USERNAME must be set to your username")
     ig_mongo = pymongo.MongoClient().instagram.ig
-    geo = geonames.GeonamesClient(geonames_username)
+    client = geonames.GeonamesClient(geonames_username,
+            timeout=geonames_timeout,
+            hourly_limit=optional_int(
+                os.environ.get("GEONAMES_HOURLY_LIMIT", 1000)),
+            daily_limit=optional_int(
+                os.environ.get("GEONAMES_DAILY_LIMIT", 10000)),
+            block_on_limit=block_on_limit)
+    geo = TimezoneCache(client,
+            resolution=float(os.environ.get("GEONAMES_CACHE_RESOLUTION", 0.1)),
+            path=os.environ.get("GEONAMES_CACHE_FILE", "geonames_cache.sqlite"))
     return ig_mongo, geo
 
 
-def read_results_from_mongo():
-    """Read all of the results from MongoDB"""
-    ig_mongo, _ = get_cursors()
+def read_results_from_mongo(ig_mongo=None):
+    """Read all of the results from MongoDB, or from the collection
+    ``ig_mongo`` if given"""
+    if ig_mongo is None:
+        ig_mongo, _ = get_cursors()
     full_results = []
     for res in ig_mongo.find():
         if (res["latitude"] > -90 and res["latitude"] < 90 and
@@ -29,23 +74,216 @@ def read_results_from_mongo():
     return full_results
 
 
-def add_timezone_info():
+def read_points_from_mongo(batch_size=10000, ig_mongo=None, query=None):
+    """Read the points needed to draw maps from MongoDB (or from the
+    collection ``ig_mongo``, if given) into a ``PointDataset``.
+
+    Only the fields in ``POINT_FIELDS`` are fetched, the bounds check (or
+    ``query``, e.g. from ``viewport.points_query``) is done by the database,
+    and documents are converted in batches of ``batch_size`` straight into
+    numpy arrays.
+    """
+    if ig_mongo is None:
+        ig_mongo, _ = get_cursors()
+    if query is None:
+        query = VALID_POINTS_QUERY
+    cursor = ig_mongo.find(query, fields=POINT_FIELDS)
+    cursor.batch_size(batch_size)
+
+    builder = PointDatasetBuilder(capacity=batch_size)
+    batch = []
+    for res in cursor:
+        batch.append(res)
+        if len(batch) == batch_size:
+            builder.extend_results(batch)
+            batch = []
+    builder.extend_results(batch)
+
+    points = builder.dataset()
+    logging.getLogger().info("Total number of points in sample : %d "
+                             "(%d bytes)" % (len(points), points.nbytes))
+    return points
+
+
+def backfill_chunk(ig_mongo, geo, chunk, pool=None, rate_limiter=None):
+    """Look up and save offsets for a list of documents, see
+    ``add_timezone_info``.  Returns the number of documents updated"""
+
+    with profiling.span("find_timezones", documents=len(chunk)):
+        timezones = geo.find_timezones([res["latitude"] for res in chunk],
+                                       [res["longitude"] for res in chunk],
+                                       pool=pool, rate_limiter=rate_limiter)
+
+    ids_by_offset = {}
+    for res, timezone in zip(chunk, timezones):
+        if timezone is not None and "rawOffset" in timezone:
+            ids_by_offset.setdefault(timezone["rawOffset"],
+                                     []).append(res["_id"])
+    if not ids_by_offset:
+        return 0
+
+    with profiling.span("mongo_write", offsets=len(ids_by_offset)):
+        bulk = ig_mongo.initialize_unordered_bulk_op()
+        for offset, ids in ids_by_offset.items():
+            bulk.find({"_id": {"$in": ids}}).update(
+                {"$set": {"offset": offset}})
+        bulk.execute()
+    return sum(len(ids) for ids in ids_by_offset.values())
+
+
+def add_timezone_info(workers=8, max_rate=None, chunk_size=10000,
+                      ig_mongo=None, geo=None):
+    """Add the offset from UTC to every document that is missing one.
+
+    Documents without an offset are found through an index on ``offset``
+    and ``_id``, and handled in chunks of ``chunk_size``.  Each chunk is its
+    own query, for the documents after the last ``_id`` of the chunk before,
+    so no cursor is left idle while a chunk waits on the geonames rate
+    limits (MongoDB would time it out).  Points in a chunk are grouped
+    by timezone cache grid cell, uncached cells are looked up by ``workers``
+    threads at no more than ``max_rate`` requests per second, and the
+    offsets are written back with one bulk ``$set`` per distinct offset.  A
+    document only leaves the query once its offset is written, so an
+    interrupted backfill picks up where it left off when run again.
+
+    The collection and the ``TimezoneCache`` come from ``get_cursors``
+    unless ``ig_mongo`` and ``geo`` are given.
+    """
+
+    if ig_mongo is None or geo is None:
+        default_mongo, default_geo = get_cursors(block_on_limit=True)
+        if ig_mongo is None:
+            ig_mongo = default_mongo
+        if geo is None:
+            geo = default_geo
+    ig_mongo.ensure_index([("offset", pymongo.ASCENDING),
+                           ("_id", pymongo.ASCENDING)])
 
-    ig_mongo, geo = get_cursors()
+    rate_limiter = None if max_rate is None else TokenBucket(max_rate)
+    pool = ThreadPool(workers)
 
+    def next_chunk(last_id):
+        # Documents whose lookup failed stay without an offset, so page on
+        # _id rather than just taking the first chunk_size again
+        query = {"offset": {"$exists": False}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        cursor = ig_mongo.find(query, fields={"latitude": True,
+                                              "longitude": True})
+        return list(cursor.sort("_id", pymongo.ASCENDING).limit(chunk_size))
+
+    start = timeit.default_timer()
+    start_misses = geo.misses
+    num_read = 0
     num_added = 0
-    for res in ig_mongo.find():
-        if "offset" in res:
-            continue
-        try:
-            timezone = geo.find_timezone({"lat": res["latitude"],
-                                  "lng": res["longitude"]})
-            res["offset"] = timezone["rawOffset"]
-            ig_mongo.save(res)
-            num_added += 1
-        except geonames.GeonamesError, e:
-            logging.getLogger().warn("GeonamesError for lat: %f, lng: %f " %
-                   (res["latitude"], res["longitude"]))
-            logging.getLogger().warn("GeonamesError message : "+str(e))
+
+    def log_progress():
+        elapsed = timeit.default_timer() - start
+        num_calls = geo.misses - start_misses
+        logging.getLogger().info("Timezone backfill: read %d, added %d, "
+            "%d geonames calls (%.1f documents/s, %.2f calls/s)" %
+            (num_read, num_added, num_calls, num_read/elapsed,
+             num_calls/elapsed))
+
+    def backfill(chunk):
+        with profiling.span("backfill_chunk", documents=len(chunk)):
+            num_updated = backfill_chunk(ig_mongo, geo, chunk, pool=pool,
+                                         rate_limiter=rate_limiter)
+        profiling.count("documents_read", len(chunk))
+        profiling.count("offsets_added", num_updated)
+        return num_updated
+
+    try:
+        chunk = next_chunk(None)
+        while chunk:
+            num_added += backfill(chunk)
+            num_read += len(chunk)
+            log_progress()
+            if len(chunk) < chunk_size:
+                break
+            chunk = next_chunk(chunk[-1]["_id"])
+    finally:
+        pool.close()
+        pool.join()
 
     logging.getLogger().info("Added %d missing offsets to data" % num_added)
+
+
+def add_geojson_locations(chunk_size=10000):
+    """Add ``LOCATION_FIELD`` to every valid document that is missing it,
+    and create its 2dsphere index.  Like ``add_timezone_info``, this can be
+    interrupted and run again"""
+
+    ig_mongo, _ = get_cursors()
+    ensure_location_index(ig_mongo)
+
+    query = dict(VALID_POINTS_QUERY)
+    query[LOCATION_FIELD] = {"$exists": False}
+    cursor = ig_mongo.find(query, fields={"latitude": True,
+                                          "longitude": True})
+    cursor.batch_size(chunk_size)
+
+    def write(chunk):
+        bulk = ig_mongo.initialize_unordered_bulk_op()
+        for res in chunk:
+            bulk.find({"_id": res["_id"]}).update({"$set": {LOCATION_FIELD:
+                geojson_point(res["latitude"], res["longitude"])}})
+        bulk.execute()
+
+    num_added = 0
+    chunk = []
+    for res in cursor:
+        chunk.append(res)
+        if len(chunk) == chunk_size:
+            write(chunk)
+            num_added += len(chunk)
+            chunk = []
+            logging.getLogger().info("Added %d locations" % num_added)
+    if chunk:
+        write(chunk)
+        num_added += len(chunk)
+    logging.getLogger().info("Added %d missing locations to data" % num_added)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Add the timezone offset to "
+        "every photo in MongoDB that is missing one")
+    parser.add_argument('--add_locations', action="count",
+                   help='If present, then add the GeoJSON location used by '
+                   'regional maps to every photo missing it, rather than '
+                   'timezone offsets')
+    parser.add_argument('--logfile', type=str, default="instagram_map.log",
+                   help='Name of logfile')
+    parser.add_argument('--workers', type=int, default=8,
+                   help='Number of concurrent requests to geonames')
+    parser.add_argument('--max_rate', type=float, default=None,
+                   help='Maximum number of geonames requests per second')
+    parser.add_argument('--chunk_size', type=int, default=10000,
+                   help='Number of documents to handle at a time')
+    parser.add_argument('--profile', choices=profiling.TRACE_FORMATS,
+                   default=None,
+                   help='If given, then write timing spans and counters as '
+                   'JSON lines or a Chrome trace next to the logfile')
+    parser.add_argument('--profile_memory_interval', type=float, default=0.1,
+                   help='Seconds between samples of memory use when '
+                   'profiling, or 0 to not sample')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(filename=args.logfile,
+                        level=logging.DEBUG)
+    logging.basicConfig(format='%(asctime)s %(message)s')
+
+    if args.profile:
+        profiling.enable(profiling.trace_path(args.logfile, args.profile),
+                         trace_format=args.profile,
+                         memory_interval=args.profile_memory_interval)
+    try:
+        if args.add_locations:
+            add_geojson_locations(chunk_size=args.chunk_size)
+        else:
+            add_timezone_info(workers=args.workers, max_rate=args.max_rate,
+                              chunk_size=args.chunk_size)
+    finally:
+        profiling.disable()
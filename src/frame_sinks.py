@@ -0,0 +1,121 @@
+"""Destinations for rendered movie frames.
+
+Every sink takes frames as (height, width, 4) uint8 RGBA arrays through
+``write(index, name, frame)``, where ``index`` is the frame's position in the
+movie and ``name`` is the path the frame would have as a single image, without
+an extension.
+
+``PngSink``:  One PNG per frame, as the visualizer has always written
+``RawStackSink``:  Every frame in one memory-mapped ``.npy`` file of shape
+    (nframes, height, width, 4), which other tools can read (or memory-map)
+    without decoding anything
+``EncoderSink``:  Frames piped as raw video to an encoder subprocess, by
+    default ffmpeg, as they are rendered
+``LatestPngSink``:  Every frame to the same PNG, replaced atomically, for
+    something else to display
+"""
+import os
+import subprocess
+import numpy as np
+import matplotlib.image
+
+import profiling
+
+# Command run by ``EncoderSink``, filled in by ``encoder_command``
+DEFAULT_ENCODER = ("ffmpeg -y -loglevel error -f rawvideo -pix_fmt rgba "
+                   "-s {width}x{height} -r {fps} -i - -pix_fmt yuv420p "
+                   "{output}")
+
+
+class PngSink(object):
+
+    def write(self, index, name, frame):
+        matplotlib.image.imsave(name + ".png", frame)
+        if profiling.enabled():
+            profiling.count("bytes_written", os.path.getsize(name + ".png"))
+
+    def close(self):
+        pass
+
+
+class LatestPngSink(object):
+    """Writes each frame over ``path``, by way of a temporary file, so that
+    readers only ever see a whole frame"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, index, name, frame):
+        base, extension = os.path.splitext(self.path)
+        matplotlib.image.imsave(base + ".tmp" + extension, frame)
+        os.rename(base + ".tmp" + extension, self.path)
+        if profiling.enabled():
+            profiling.count("bytes_written", os.path.getsize(self.path))
+
+    def close(self):
+        pass
+
+
+class RawStackSink(object):
+    """Writes frames into the stack at ``path``.  If ``nframes`` and
+    ``shape`` (height, width) are given a new stack is created, otherwise an
+    existing one is opened, so that several processes can each fill in
+    their own frames"""
+
+    def __init__(self, path, nframes=None, shape=None):
+        if nframes is None:
+            self.frames = np.lib.format.open_memmap(path, mode="r+")
+        else:
+            self.frames = np.lib.format.open_memmap(
+                path, mode="w+", dtype=np.uint8,
+                shape=(nframes,) + tuple(shape[:2]) + (4,))
+
+    def write(self, index, name, frame):
+        self.frames[index] = frame
+        profiling.count("bytes_written", frame.nbytes)
+
+    def close(self):
+        # Sinks are closed from finally blocks, so this may be a second call
+        if self.frames is None:
+            return
+        self.frames.flush()
+        self.frames = None
+
+
+def encoder_command(output, width, height, fps=24, template=DEFAULT_ENCODER):
+    """Fill in an encoder command line template"""
+    return template.format(output=output, width=width, height=height,
+                           fps=fps)
+
+
+class EncoderSink(object):
+    """Pipes frames, which must be written in order, to the standard input
+    of the shell command ``command``"""
+
+    def __init__(self, command):
+        self.command = command
+        self.process = subprocess.Popen(command, shell=True,
+                                        stdin=subprocess.PIPE)
+        self.next_index = 0
+
+    def write(self, index, name, frame):
+        if index != self.next_index:
+            raise ValueError("Frame %d written to the encoder when frame %d "
+                             "was expected" % (index, self.next_index))
+        self.process.stdin.write(np.ascontiguousarray(frame).data)
+        self.next_index += 1
+        profiling.count("bytes_written", frame.nbytes)
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError("Encoder command failed: %s" % self.command)
+
+
+def encode_stack(path, command):
+    """Pipe every frame of the stack at ``path`` through ``EncoderSink``"""
+    frames = np.load(path, mmap_mode="r")
+    sink = EncoderSink(command)
+    for index, frame in enumerate(frames):
+        sink.write(index, None, frame)
+    sink.close()
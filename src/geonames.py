@@ -1,9 +1,14 @@
 import sys
 import urllib
-import urllib2
+import urlparse
+import httplib
+import socket
+import Queue
 import json
 import logging
 
+from rate_limit import TokenBucket
+
 
 class GeonamesError(Exception):
 
@@ -18,20 +23,108 @@ class GeonamesError(Exception):
         return unicode(self.__str__())
 
 
+class ConnectionPool(object):
+    """Pool of persistent HTTP/1.1 connections to a single host, safe to
+    share between threads.  At most ``maxsize`` idle connections are kept"""
+
+    def __init__(self, host, port=None, maxsize=8, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.idle = Queue.Queue(maxsize)
+
+    def _get_connection(self):
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            return httplib.HTTPConnection(self.host, self.port,
+                                          timeout=self.timeout)
+
+    def _put_connection(self, conn):
+        try:
+            self.idle.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    def get(self, path):
+        """GET ``path`` and return ``(status, body)``.  A request on a kept
+        alive connection that the server has since closed is retried once on
+        a new connection"""
+        for attempt in range(2):
+            conn = self._get_connection()
+            try:
+                conn.request("GET", path)
+                response = conn.getresponse()
+                body = response.read()
+            except (httplib.BadStatusLine, httplib.CannotSendRequest,
+                    socket.error), e:
+                conn.close()
+                if attempt == 1 or isinstance(e, socket.timeout):
+                    raise
+                continue
+            except:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._put_connection(conn)
+            return response.status, body
+
+
 class GeonamesClient(object):
+    """Client for the geonames web services.
+
+    Requests go over a pool of up to ``max_connections`` keep-alive
+    connections, each with a ``timeout`` in seconds.  Calls are limited on
+    the client side to ``hourly_limit`` per hour and ``daily_limit`` per day
+    (geonames' quotas for free accounts by default, None for no limit).  If
+    a call would go over a limit then it waits if ``block_on_limit`` is set,
+    and otherwise fails with a ``GeonamesError``.  Requests go to
+    ``base_url``, which is geonames' own server unless another is given.
+    """
     BASE_URL = 'http://api.geonames.org/'
 
-    def __init__(self, username):
+    def __init__(self, username, timeout=10, max_connections=8,
+                 hourly_limit=1000, daily_limit=10000, block_on_limit=False,
+                 base_url=None):
         self.username = username
+        self.base_url = base_url or GeonamesClient.BASE_URL
+        self.block_on_limit = block_on_limit
+        self.limits = []
+        if hourly_limit is not None:
+            self.limits.append(TokenBucket(hourly_limit/3600.,
+                                           capacity=hourly_limit))
+        if daily_limit is not None:
+            self.limits.append(TokenBucket(daily_limit/86400.,
+                                           capacity=daily_limit))
+        base = urlparse.urlsplit(self.base_url)
+        self.pool = ConnectionPool(base.hostname, base.port,
+                                   maxsize=max_connections, timeout=timeout)
 
     def call(self, service, params=None):
-        url = self.build_url(service, params)
+        url = urlparse.urlsplit(self.build_url(service, params))
+
+        acquired = []
+        for limit in self.limits:
+            if not limit.acquire(blocking=self.block_on_limit):
+                # No request is made, so don't use up the other limits
+                for bucket in acquired:
+                    bucket.release()
+                raise GeonamesError('Client side rate limit reached.')
+            acquired.append(limit)
 
         try:
-            response = urllib2.urlopen(urllib2.Request(url))
-            json_response = json.loads(response.read())
-        except urllib2.URLError, e:
+            status, body = self.pool.get("%s?%s" % (url.path, url.query))
+        except socket.timeout:
+            raise GeonamesError('API request timed out.')
+        except (httplib.HTTPException, socket.error):
+            raise GeonamesError('API didnt return 200 response.')
+        if status != 200:
             raise GeonamesError('API didnt return 200 response.')
+
+        try:
+            json_response = json.loads(body)
         except ValueError:
             raise GeonamesError('API did not return valid json response.')
         else:
@@ -40,7 +133,7 @@ class GeonamesClient(object):
         return json_response
 
     def build_url(self, service, params=None):
-        url = '%s%s?username=%s' % (GeonamesClient.BASE_URL, service, self.username)
+        url = '%s%s?username=%s' % (self.base_url, service, self.username)
         if params:
             if isinstance(params, dict):
                 params = dict((k, v) for k, v in params.items() if v is not None)
@@ -51,3 +144,38 @@ class GeonamesClient(object):
     # http://api.geonames.org/timezoneJSON?lat=47.01&lng=10.2&username=demo
     def find_timezone(self, params):
         return self.call('timezoneJSON', params)
+
+    def iter_timezones(self, params_list, pool=None, rate_limiter=None):
+        """Call ``find_timezone`` for each of ``params_list``, yielding
+        ``(i, response)`` for ``params_list[i]`` as each call finishes, with
+        None for the response wherever there was a ``GeonamesError``.
+
+        If a thread ``pool`` is given the calls are made concurrently on it,
+        sharing this client's connections, and are yielded in the order
+        they finish.  If a ``rate_limiter`` is given then its ``acquire``
+        method is called before each request.
+        """
+
+        def fetch(item):
+            i, params = item
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+            try:
+                return i, self.find_timezone(params)
+            except GeonamesError, e:
+                logging.getLogger().warn("GeonamesError for lat: %f, "
+                    "lng: %f : %s" % (params["lat"], params["lng"], e))
+                return i, None
+
+        if pool is None:
+            return (fetch(item) for item in enumerate(params_list))
+        return pool.imap_unordered(fetch, enumerate(params_list))
+
+    def find_timezones(self, params_list, pool=None, rate_limiter=None):
+        """Return a list of the responses to ``find_timezone`` for each of
+        ``params_list``, see ``iter_timezones``"""
+        responses = [None]*len(params_list)
+        for i, response in self.iter_timezones(params_list, pool=pool,
+                                               rate_limiter=rate_limiter):
+            responses[i] = response
+        return responses
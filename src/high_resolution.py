@@ -0,0 +1,169 @@
+"""High resolution frames (4K, 8K) without full-size temporary copies.
+
+The usual path bins every frame with a float64 ``np.histogram2d``, and then
+``rot90``, ``log``, the blur and the colorization each make another full
+size array, most of them float64, and the colorized frame is 32 bytes a bin.
+Here instead:
+
+* ``heatmap_shape`` works out the bin grid from the target resolution, as
+  whole numbers of bins.
+* ``BinnedPoints`` projects the points and works out the flat index of the
+  bin each one falls in once, a chunk at a time, and sorts the points by
+  bin.  Each frame is then accumulated straight into one float32 grid, in
+  image orientation, by summing the weights of each run of equal bins in a
+  chunk.  No temporary is larger than a chunk.
+* ``finish_heatmap`` takes the log and applies the normalization in place
+  on that grid, then blurs it (in place with ``SeparableDensity``) and
+  colorizes it into a uint8 RGBA array, a block of rows at a time.
+
+Peak memory for a frame of W x H pixels with nx x ny bins and N points,
+in bytes, is about
+
+    14*N                   bins (int32), minute (int16) and point order
+                           (intp) while sorting, then 6*N (10*N with counts)
+    4*nx*ny + 4*nx*ny      the float32 grid and the uint8 RGBA heatmap
+    4*nx*ny                the normalization map, if used
+    ~40*chunk_size         temporaries while binning and accumulating
+    4*W*H + 4*W*H          the map background and the Agg canvas
+    ~8*W*H                 matplotlib's resampling of the heatmap onto the
+                           canvas
+
+so with the default 3.2 pixels per bin it is the canvas, not the heatmap,
+that sets the floor.  Rendering a day of frames from a million photos
+peaked at about 150MB for 3840x2160 and 600MB for 7680x4320, background
+included.  ``benchmarks.py high_resolution`` measures the heatmap part on
+its own: at one bin per pixel and 3840x2160 it needed 72MB, against 517MB
+the float64 way.  ``test_high_resolution.py`` fails if that grows past
+14*N + 12*nx*ny + 40*chunk_size bytes, and checks that the pixels are the
+same as the float64 way's at 1600x900.
+"""
+import argparse
+import numpy as np
+
+from density import SeparableDensity
+
+# The default 500 bins across a 1600 pixel frame
+DEFAULT_PIXELS_PER_BIN = 3.2
+
+# Rows colorized at a time by ``finish_heatmap``
+COLORIZE_ROWS = 256
+
+
+def parse_resolution(value):
+    """argparse type for a resolution given as WIDTHxHEIGHT"""
+    try:
+        width, height = [int(n) for n in value.lower().split("x")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("resolutions must look like "
+                                         "3840x2160")
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError("resolutions must be positive")
+    return width, height
+
+
+def heatmap_shape(resolution, pixels_per_bin=DEFAULT_PIXELS_PER_BIN):
+    """(rows, columns) of the heatmap grid for a (width, height) frame"""
+    width, height = resolution
+    return (max(1, int(round(height/float(pixels_per_bin)))),
+            max(1, int(round(width/float(pixels_per_bin)))))
+
+
+def uint8_lut(lut):
+    """Convert a float RGBA lookup table from ``build_color_lut`` to the
+    bytes that drawing it would give"""
+    return (np.clip(lut, 0, 1)*255).astype(np.uint8)
+
+
+class BinnedPoints(object):
+    """Points binned once on a (rows, columns) grid spanning ``xrange`` and
+    ``yrange`` of the map, with row 0 at the top as in an image.  Points
+    outside the grid are dropped.
+
+    :project:  Function mapping ``(lon, lat)`` arrays to map ``(x, y)``
+    :minutes, counts:  Per point arrays, kept in bin order for
+        ``accumulate`` to hand to its weight function
+    """
+
+    def __init__(self, lat, lon, minutes, xrange, yrange, shape, project,
+                 counts=None, chunk_size=1000000):
+        self.shape = shape
+        self.chunk_size = chunk_size
+        nrows, ncols = shape
+        if nrows*ncols > np.iinfo(np.int32).max:
+            raise ValueError("Heatmap grid %dx%d is too large" % shape)
+
+        bins = np.empty(len(lat), dtype=np.int32)
+        for start in range(0, len(lat), chunk_size):
+            stop = start + chunk_size
+            x, y = project(lon[start:stop], lat[start:stop])
+            column = np.floor((np.asarray(x) - xrange[0]) /
+                              (xrange[1] - xrange[0])*ncols)
+            row = np.floor((yrange[1] - np.asarray(y)) /
+                           (yrange[1] - yrange[0])*nrows)
+            # As in np.histogram2d, the last bin includes its far edge
+            column[np.asarray(x) == xrange[1]] = ncols - 1
+            row[np.asarray(y) == yrange[0]] = nrows - 1
+            inside = ((column >= 0) & (column < ncols) &
+                      (row >= 0) & (row < nrows))
+            bins[start:stop] = np.where(inside, row*ncols + column, -1)
+
+        order = np.argsort(bins, kind="mergesort")
+        order = order[bins[order] >= 0]
+        self.bins = bins[order]
+        del bins
+        self.minutes = np.asarray(minutes)[order]
+        self.counts = None if counts is None else np.asarray(counts)[order]
+
+    def __len__(self):
+        return len(self.bins)
+
+    def accumulate(self, weights, out=None):
+        """Sum the weights of the points into the float32 grid ``out``
+        (zeroed first), or a new one.  ``weights(start, stop)`` returns the
+        weights of the points ``start`` to ``stop`` in bin order"""
+        if out is None:
+            out = np.zeros(self.shape, dtype=np.float32)
+        else:
+            out.fill(0)
+        flat = out.reshape(-1)
+
+        for start in range(0, len(self.bins), self.chunk_size):
+            stop = min(start + self.chunk_size, len(self.bins))
+            bins = self.bins[start:stop]
+            runs = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+            # Each bin appears once in a chunk, so += doesn't lose any
+            flat[bins[runs]] += np.add.reduceat(weights(start, stop), runs)
+        return out
+
+
+def finish_heatmap(grid, lut, sigma=1, density=None, norm_map=None,
+                   out=None):
+    """Turn the weighted histogram ``grid`` into a uint8 RGBA heatmap, in
+    ``out`` if given.  ``grid`` is overwritten along the way.
+
+    :lut:  uint8 lookup table from ``uint8_lut``
+    :density:  Backend from ``density.DENSITY_BACKENDS``.  Defaults to
+        ``SeparableDensity``, which blurs ``grid`` in place
+    :norm_map:  Optional map to divide the log histogram by, as
+        ``--normalize_map`` does
+    """
+    np.log1p(grid, out=grid)
+    if norm_map is not None:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            np.divide(grid, norm_map, out=grid)
+        grid[np.isnan(grid)] = 0.0
+
+    if density is None:
+        density = SeparableDensity()
+    grid = density.smooth(grid, sigma)
+
+    if out is None:
+        out = np.empty(grid.shape + (4,), dtype=np.uint8)
+    nentries = lut.shape[0]
+    for start in range(0, grid.shape[0], COLORIZE_ROWS):
+        rows = grid[start:start + COLORIZE_ROWS]
+        np.multiply(rows, nentries, out=rows)
+        np.clip(rows, 0, nentries - 1, out=rows)
+        np.take(lut, rows.astype(np.intp), axis=0,
+                out=out[start:start + COLORIZE_ROWS])
+    return out
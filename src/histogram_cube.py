@@ -0,0 +1,136 @@
+"""Time-binned histogram cube, so that every frame of a day can be made from a
+single pass over the points.
+
+Points are projected and binned once into a (time bin, x, y) cube.  Each time
+bin ends on a frame time, and a point taken ``r`` minutes before the end of
+its bin goes into the cube with weight exp(-r/tau), where tau is the decay
+time.  Because the decay is exponential, the weighted histogram for a frame
+is then exactly the circular convolution of the cube along its time axis with
+the kernel exp(-m*bin_width/tau), m = 0, 1, ..., which costs a multiple of the
+grid size per frame rather than a pass over every point.
+"""
+import fractions
+import numpy as np
+
+MINUTES_PER_DAY = 24*60
+
+
+def frame_bin_minutes(minutes_step):
+    """Widest time bin that every frame ``minutes_step`` minutes apart,
+    starting from midnight, ends on"""
+    return fractions.gcd(minutes_step, MINUTES_PER_DAY)
+
+
+def bin_times(minutes, time_bin_minutes=60, decay_hours=1, counts=None):
+    """Return ``(timebins, weights)``, the time bin that each point taken at
+    ``minutes`` past midnight goes in and its weight in that bin.  These
+    don't depend on the projection, so they can be worked out once and
+    shared by the cubes of several cameras"""
+    if MINUTES_PER_DAY % time_bin_minutes != 0:
+        raise ValueError("time_bin_minutes must divide %d" % MINUTES_PER_DAY)
+
+    # Each point goes in the first bin that ends at or after it was taken
+    minutes = np.asarray(minutes, dtype=np.int64)
+    timebins = -(-minutes // time_bin_minutes)
+    weights = np.exp(-(timebins*time_bin_minutes - minutes)/60./decay_hours)
+    if counts is not None:
+        weights *= counts
+    timebins %= MINUTES_PER_DAY // time_bin_minutes
+    return timebins, weights
+
+
+def cube_nbytes(bins, minutes_step):
+    """Bytes taken by the cube that ``HistogramCube.for_frame_step`` builds
+    with ``bins`` for frames every ``minutes_step`` minutes"""
+    ntimebins = MINUTES_PER_DAY // frame_bin_minutes(minutes_step)
+    return 8*ntimebins*bins[0]*bins[1]
+
+
+class HistogramCube(object):
+    """Weighted 2d histograms of a set of points, binned by time of day
+
+    :xpoints, ypoints:  Projected coordinates of the points
+    :minutes:  Minute of the day (0-1439) at which each point was taken
+    :xrange, yrange:  (min, max) of the histogram in each direction
+    :bins:  (nx, ny) number of histogram bins in each direction
+    :time_bin_minutes:  Width of the time bins.  Must divide a day, and every
+        frame time asked for must be a multiple of it
+    :decay_hours:  Decay time of the point weights, as in
+        ``calculate_point_weights``
+    :counts:  Optional number of photos that each point stands for
+    :binned_times:  Optional ``(timebins, weights)`` from ``bin_times``,
+        made with the same ``time_bin_minutes``, ``decay_hours`` and
+        ``counts``.  If given, ``minutes`` and ``counts`` are not used
+
+    ``cube`` holds the (ntimebins, nx, ny) array, which takes
+    ``8*ntimebins*nx*ny`` bytes.
+    """
+
+    def __init__(self, xpoints, ypoints, minutes, xrange, yrange, bins,
+                 time_bin_minutes=60, decay_hours=1, counts=None,
+                 binned_times=None):
+
+        if binned_times is None:
+            binned_times = bin_times(minutes, time_bin_minutes,
+                                     decay_hours=decay_hours, counts=counts)
+        timebins, weights = binned_times
+
+        self.time_bin_minutes = time_bin_minutes
+        self.ntimebins = MINUTES_PER_DAY // time_bin_minutes
+        # Factor the weights decay by from one time bin to the next
+        self.decay = np.exp(-float(time_bin_minutes)/60/decay_hours)
+
+        self.cube, edges = np.histogramdd(
+            (timebins, np.asarray(xpoints), np.asarray(ypoints)),
+            bins=(self.ntimebins, bins[0], bins[1]),
+            range=((-0.5, self.ntimebins - 0.5), xrange, yrange),
+            weights=weights)
+        self.xedges = edges[1]
+        self.yedges = edges[2]
+
+        self._last_index = None
+        self._last_histogram = None
+
+    @classmethod
+    def for_frame_step(cls, xpoints, ypoints, minutes, xrange, yrange, bins,
+                       minutes_step=60, decay_hours=1, counts=None,
+                       binned_times=None):
+        """Build a cube fine enough for frames every ``minutes_step``
+        minutes, starting from midnight"""
+        return cls(xpoints, ypoints, minutes, xrange, yrange, bins,
+                   time_bin_minutes=frame_bin_minutes(minutes_step),
+                   decay_hours=decay_hours, counts=counts,
+                   binned_times=binned_times)
+
+    def frame_index(self, target_time):
+        """Index of the time bin that ends at ``target_time``"""
+        minutes = 60*target_time.hour + target_time.minute
+        if minutes % self.time_bin_minutes != 0:
+            raise ValueError("Frame time %s is not a multiple of %d minutes" %
+                             (target_time.strftime("%H:%M"),
+                              self.time_bin_minutes))
+        return (minutes // self.time_bin_minutes) % self.ntimebins
+
+    def histogram(self, target_time):
+        """Return ``(im, xedges, yedges)`` for the frame at ``target_time``,
+        with ``im`` the same histogram that ``np.histogram2d`` would give for
+        the weights from ``calculate_point_weights``.
+
+        Frames asked for in order reuse the previous histogram, using
+        F[j] = decay*F[j-1] + (1 - decay**ntimebins)*cube[j].  The returned
+        array must not be modified.
+        """
+        index = self.frame_index(target_time)
+
+        if (self._last_index is not None and
+                index == (self._last_index + 1) % self.ntimebins):
+            im = (self.decay*self._last_histogram +
+                  (1 - self.decay**self.ntimebins)*self.cube[index])
+        else:
+            kernel = self.decay**((index - np.arange(self.ntimebins)) %
+                                  self.ntimebins)
+            im = np.tensordot(kernel, self.cube, axes=1)
+
+        self._last_index = index
+        self._last_histogram = im
+        return im, self.xedges, self.yedges
@@ -1,65 +1,483 @@
 """Read instagram photos with a specific tag and save to Mongo"""
 import argparse
 from instagram.client import InstagramAPI
-from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError
 from retry import retries, example_exc_handler
-from extract_data import get_cursors
+from extract_data import (get_cursors, geojson_point, ensure_location_index,
+                          LOCATION_FIELD)
+from geonames import GeonamesError
 from time import sleep
-import geonames
+import threading
+import datetime
 import logging
+import timeit
+import time
+import urlparse
+import Queue
+import heapq
 import os
 
+import profiling
+from rate_limit import TokenBucket
+from seen_ids import RecentIds
+
 CLIENT_ID = os.environ.get("INSTAGRAM_CLIENT_ID", None)
 CLIENT_SECRET = os.environ.get("INSTAGRAM_CLIENT_SECRET", None)
 
-@retries(5, hook=example_exc_handler, delay=10, backoff=2)
-def save_instagram_to_mongo(desired_tag):
+def media_to_dict(media):
+    """Convert an Instagram media object to the dict that is saved to
+    MongoDB, without the timezone offset.  Returns None if the media is
+    missing any of the fields that we need"""
 
-    ig_mongo, geo = get_cursors()
+    media_dict = {}
+    media_dict["_id"] = media.id
+    try:
+        media_dict["latitude"] = media.location.point.latitude
+        media_dict["longitude"] = media.location.point.longitude
+        media_dict["created_time"] = media.created_time
+        media_dict["caption"] = str(media.caption)
+        media_dict["image_url"] = media.images['standard_resolution'].url
+        media_dict["schema"] = 1
+    except AttributeError:
+        # If an instagram is missing a tag that we want, skip it
+        return None
 
-    api = InstagramAPI(client_id=CLIENT_ID, client_secret=CLIENT_SECRET)
-    tag_recent_media, _ = api.tag_recent_media(tag_name=desired_tag)
+    location = geojson_point(media_dict["latitude"], media_dict["longitude"])
+    if location is not None:
+        media_dict[LOCATION_FIELD] = location
 
-    batch_to_send = []
-    for media in tag_recent_media:
-        media_dict = {}
-        media_dict["_id"] = media.id
-        try:
-            media_dict["latitude"] = media.location.point.latitude
-            media_dict["longitude"] = media.location.point.longitude
-            media_dict["created_time"] = media.created_time
-            media_dict["caption"] = str(media.caption)
-            media_dict["image_url"] = media.images['standard_resolution'].url
-            media_dict["schema"] = 1
-        except AttributeError:
-            # If an instagram is missing a tag that we want, skip it
-            continue
+    try:
+        media_dict["tags"] = [str(x)[5:] for x in media.tags]
+    except AttributeError:
+        media_dict["tags"] = None
+
+    return media_dict
+
+def next_max_tag_id(next_url):
+    """Return the ``max_tag_id`` to ask for the page after the one whose
+    pagination gave ``next_url``, or None if there are no more pages"""
+    if not next_url:
+        return None
+    query = urlparse.parse_qs(urlparse.urlsplit(next_url).query)
+    return query.get("max_tag_id", [None])[0]
+
+class Collector(object):
+    """Polls Instagram for recent photos with a tag and saves them to MongoDB.
+
+    The MongoDB, geonames and Instagram clients are created once and reused
+    for every poll, including retries after a failure.  ``seen`` is the
+    ``RecentIds`` used to drop photos that have already been saved.
+    """
+
+    def __init__(self, ig_mongo, geo, api, seen=None):
+        self.ig_mongo = ig_mongo
+        self.geo = geo
+        self.api = api
+        self.seen = seen if seen is not None else RecentIds()
+
+    @classmethod
+    def from_environment(cls, geonames_timeout=10, seen_ids=100000):
+        """Create a collector with clients configured from the environment.
+        Geonames requests that take longer than ``geonames_timeout`` seconds
+        are abandoned, leaving the offset to be backfilled later.  The ids
+        of the newest ``seen_ids`` photos in MongoDB are loaded so that
+        they are not saved again"""
+        ig_mongo, geo = get_cursors(geonames_timeout=geonames_timeout)
+        ensure_location_index(ig_mongo)
+        ig_mongo.ensure_index("saved_time")
+        api = InstagramAPI(client_id=CLIENT_ID, client_secret=CLIENT_SECRET)
+        seen = RecentIds.from_mongo(ig_mongo, max_size=seen_ids)
+        logging.getLogger().info("Loaded %d recently seen ids" % len(seen))
+        return cls(ig_mongo, geo, api, seen=seen)
+
+    def fetch_new(self, desired_tag, seen_ids=(), max_pages=1, page_size=20,
+                  rate_limiter=None, max_tag_id=None):
+        """Page back through the photos with ``desired_tag``, newest first
+        or from ``max_tag_id``, until reaching one whose id is in
+        ``seen_ids``, running out of photos, or fetching ``max_pages``
+        pages.  ``rate_limiter.acquire()`` is called before each request, if
+        a rate limiter is given.
+
+        Returns ``(media_dicts, newest_ids, num_new, num_calls, complete,
+        max_tag_id)``, where ``newest_ids`` are the ids on the first page (to
+        pass as ``seen_ids`` next time), ``num_new`` counts every new photo
+        including those without a location, ``complete`` is False if there
+        may be more new photos than were fetched, and ``max_tag_id`` is where
+        to carry on from if so.
+        """
+        media_list = []
+        newest_ids = set()
+        num_calls = 0
+        complete = False
+        while num_calls < max_pages:
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+            kwargs = {"tag_name": desired_tag, "count": page_size}
+            if max_tag_id is not None:
+                kwargs["max_tag_id"] = max_tag_id
+            with profiling.span("instagram", tag=desired_tag):
+                page, next_url = self.api.tag_recent_media(**kwargs)
+            profiling.count("instagram_calls")
+            num_calls += 1
+            if num_calls == 1:
+                newest_ids = set(media.id for media in page)
 
+            for media in page:
+                if media.id in seen_ids:
+                    complete = True
+                    break
+                media_list.append(media)
+
+            max_tag_id = next_max_tag_id(next_url)
+            if complete or max_tag_id is None:
+                complete = True
+                break
+
+        media_dicts = [media_to_dict(media) for media in media_list]
+        return ([media_dict for media_dict in media_dicts
+                 if media_dict is not None], newest_ids, len(media_list),
+                num_calls, complete, max_tag_id)
+
+    def enrich(self, media_dict):
+        """Add the timezone offset to ``media_dict``, if geonames can give
+        it to us.  Photos are saved without one otherwise, and can be
+        backfilled later"""
         try:
             # Times returned by Instagram are all UTC.  Use geonames
             # to add the offset so we can convert to local time
-            timezone = geo.find_timezone({"lat": media_dict["latitude"],
+            timezone = self.geo.find_timezone({"lat": media_dict["latitude"],
                                           "lng": media_dict["longitude"]})
+        except GeonamesError, e:
+            logging.getLogger().warning("No timezone for %s : %s" %
+                                        (media_dict["_id"], e))
+            return media_dict
+        except Exception:
+            logging.getLogger().exception("Timezone lookup failed for %s" %
+                                          media_dict["_id"])
+            return media_dict
+        if "rawOffset" in timezone:
             media_dict["offset"] = timezone["rawOffset"]
-        except:
-            # Any failure here should be ignored because we can always
-            # add this data back in later
-            pass
+        return media_dict
 
+    def drop_seen(self, media_dicts):
+        """Return the media dicts that have not been seen before, marking
+        them as seen"""
+        return self.seen.add_new(media_dicts)
+
+    def insert(self, batch_to_send):
+        """Save a list of media dicts to MongoDB with an unordered bulk
+        upsert, so photos that are already saved are left alone.  Returns
+        ``(num_inserted, num_duplicates)``"""
+        if not batch_to_send:
+            return 0, 0
+        bulk = self.ig_mongo.initialize_unordered_bulk_op()
+        # When they were saved, which the snapshot syncs by
+        saved_time = datetime.datetime.utcnow()
+        for media_dict in batch_to_send:
+            fields = dict((k, v) for k, v in media_dict.items() if k != "_id")
+            fields["saved_time"] = saved_time
+            bulk.find({"_id": media_dict["_id"]}).upsert().update(
+                {"$setOnInsert": fields})
         try:
-            media_dict["tags"] = [str(x)[5:] for x in media.tags]
-        except AttributeError:
-            media_dict["tags"] = None
+            with profiling.span("mongo_insert", photos=len(batch_to_send)):
+                result = bulk.execute()
+        except Exception:
+            # Forget them, so that they are saved if they come back
+            self.seen.discard([media_dict["_id"]
+                               for media_dict in batch_to_send])
+            raise
+        num_inserted = result["nUpserted"]
+        num_duplicates = len(batch_to_send) - num_inserted
+        profiling.count("photos_inserted", num_inserted)
+        profiling.count("photos_duplicate", num_duplicates)
+        logging.getLogger().warning("Saved %d to mongo, %d were already "
+                                    "there" % (num_inserted, num_duplicates))
+        return num_inserted, num_duplicates
 
-        batch_to_send.append(media_dict)
+class TagState(object):
+    """Polling state of one tag in a ``TagScheduler``
 
-    try:
-        res = ig_mongo.insert(batch_to_send, continue_on_error=True)
-    except DuplicateKeyError:
-        res = []
+    :interval:  Seconds between polls wanted for this tag, before any
+        stretching to fit the API budget
+    :rate:  Smoothed estimate of new photos per second, or None before the
+        second poll
+    :seen_ids:  Ids of the newest photos seen, where the next poll stops
+    :gap:  After a poll that stopped short of ``seen_ids``, the
+        ``(max_tag_id, seen_ids, weight)`` to carry on paging from and down
+        to, and how much each photo found there adds to ``rate``; otherwise
+        None
+    """
+
+    def __init__(self, tag, interval):
+        self.tag = tag
+        self.interval = interval
+        self.rate = None
+        self.last_poll = None
+        self.seen_ids = set()
+        self.gap = None
+
+
+class TagScheduler(object):
+    """Decides when to poll each of a set of tags.
+
+    The arrival rate of new photos on each tag is tracked with an
+    exponentially weighted average, and each tag is polled often enough that
+    a poll finds about ``target_fill`` of a page of new photos, within
+    ``[min_delay, max_delay]``.  A poll that ran out of pages before reaching
+    photos already seen is followed up after ``min_delay`` by polls that
+    carry on paging back from where it stopped, until they get to those
+    photos.  If the tags together would need more than ``calls_per_hour``
+    calls, every interval is stretched by the same factor, and ``budget`` is
+    a token bucket that holds every request (including extra pages) to that
+    rate.
+    """
+
+    def __init__(self, tags, initial_delay=30, min_delay=2, max_delay=600,
+                 calls_per_hour=4000, page_size=20, max_pages=10,
+                 target_fill=0.8, smoothing=0.3):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.calls_per_second = calls_per_hour/3600.
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.target_fill = target_fill
+        self.smoothing = smoothing
+        self.budget = TokenBucket(self.calls_per_second,
+                                  capacity=max(1, calls_per_hour//60))
+        self.states = [TagState(tag, initial_delay) for tag in tags]
+        now = time.time()
+        self.queue = [(now, n, state) for n, state in enumerate(self.states)]
+        heapq.heapify(self.queue)
+
+    def stretch(self):
+        """Factor that intervals are multiplied by to fit the API budget"""
+        wanted = sum(1./state.interval for state in self.states)
+        return max(1., wanted/self.calls_per_second)
+
+    def wait_time(self):
+        """Seconds until the next tag is due to be polled"""
+        return max(0, self.queue[0][0] - time.time())
 
-    logging.getLogger().warning("Saved "+str(len(res))+" to mongo")
+    def pop_due(self):
+        """Return the ``TagState`` of the next tag to poll.  It must be
+        handed back with ``record_poll`` or ``reschedule``"""
+        return heapq.heappop(self.queue)[2]
+
+    def pages_for(self, state):
+        """Most pages to fetch for ``state``.  The first poll of a tag has
+        nothing to stop at, so it only fetches the newest page"""
+        return self.max_pages if state.seen_ids else 1
+
+    def fetch_kwargs(self, state):
+        """Keyword arguments to ``Collector.fetch_new`` for the next poll of
+        ``state``: from the newest photo back to ``seen_ids``, or on through
+        the ``gap`` left by a poll that stopped short"""
+        kwargs = {"page_size": self.page_size, "rate_limiter": self.budget}
+        if state.gap is not None:
+            kwargs["max_tag_id"], kwargs["seen_ids"], _ = state.gap
+            kwargs["max_pages"] = self.max_pages
+        else:
+            kwargs["seen_ids"] = state.seen_ids
+            kwargs["max_pages"] = self.pages_for(state)
+        return kwargs
+
+    def reschedule(self, state, delay=None):
+        """Poll ``state`` again after ``delay`` seconds, or after its usual
+        interval"""
+        if delay is None:
+            delay = state.interval*self.stretch()
+        heapq.heappush(self.queue, (time.time() + delay,
+                                    self.states.index(state), state))
+
+    def record_poll(self, state, num_new, complete, newest_ids,
+                    max_tag_id=None):
+        """Update the arrival rate of ``state`` after a poll, with the
+        results of ``Collector.fetch_new``, and schedule its next poll"""
+        if state.gap is not None:
+            # The photos in the gap arrived before the poll that left it,
+            # so they count as if that poll had found them
+            _, seen_ids, weight = state.gap
+            state.rate += weight*num_new
+            state.gap = None if complete else (max_tag_id, seen_ids, weight)
+        else:
+            now = time.time()
+            weight = None
+            if state.last_poll is not None:
+                elapsed = max(now - state.last_poll, 1e-3)
+                if state.rate is None:
+                    state.rate = num_new/elapsed
+                    weight = 1/elapsed
+                else:
+                    state.rate = (self.smoothing*num_new/elapsed +
+                                  (1 - self.smoothing)*state.rate)
+                    weight = self.smoothing/elapsed
+            state.last_poll = now
+            if not complete and state.seen_ids:
+                state.gap = (max_tag_id, state.seen_ids, weight)
+            if newest_ids:
+                state.seen_ids = newest_ids
+
+        if state.rate is not None:
+            if state.rate > 0:
+                interval = self.target_fill*self.page_size/state.rate
+            else:
+                interval = self.max_delay
+            state.interval = min(self.max_delay, max(self.min_delay, interval))
+
+        if complete:
+            self.reschedule(state)
+        else:
+            self.reschedule(state, self.min_delay*self.stretch())
+        logging.getLogger().debug("Tag %s: %d new, rate %s/s, next poll in "
+                                  "%fs" % (state.tag, num_new, state.rate,
+                                           self.wait_time()))
+
+# Passed down the pipeline queues to tell each stage to finish
+_DONE = object()
+
+class CollectorPipeline(object):
+    """Runs the fetch, enrich and insert steps of a ``Collector`` as three
+    threads connected by bounded queues, so that a slow geonames or MongoDB
+    doesn't hold up the next poll of Instagram.
+
+    :collector:  The ``Collector`` whose clients are used
+    :scheduler:  ``TagScheduler`` deciding which tag to poll and when
+    :queue_size:  Maximum number of photos waiting in front of each of the
+        enrich and insert stages.  When a queue is full, the stage feeding
+        it blocks, so a slow writer eventually throttles the poller
+    :batch_size:  The writer inserts once it has this many photos...
+    :flush_seconds:  ...or once the oldest photo it holds has waited this
+        long
+
+    ``last_metrics`` holds the latest measurements of each stage:
+    ``fetch_seconds``, ``num_fetched`` and ``num_not_seen`` of the last
+    poll, ``enrich_seconds`` of the last photo, and ``insert_seconds``,
+    ``num_new`` and ``num_duplicates`` of the last batch saved.
+    """
+
+    def __init__(self, collector, scheduler, queue_size=1000,
+                 batch_size=100, flush_seconds=5):
+        self.collector = collector
+        self.scheduler = scheduler
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.enrich_queue = Queue.Queue(queue_size)
+        self.write_queue = Queue.Queue(queue_size)
+        self.stopping = threading.Event()
+        self.metrics_lock = threading.Lock()
+        self.last_metrics = {}
+        self.threads = [threading.Thread(target=self.poller),
+                        threading.Thread(target=self.enricher),
+                        threading.Thread(target=self.writer)]
+        for thread in self.threads:
+            thread.daemon = True
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """Stop polling, and wait for the photos already fetched to be
+        enriched and saved"""
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+
+    def record(self, **metrics):
+        """Update ``last_metrics``, from any stage"""
+        with self.metrics_lock:
+            self.last_metrics.update(metrics)
+
+    def poller(self):
+        fetch_new = retries(5, hook=example_exc_handler, delay=10,
+                            backoff=2)(self.collector.fetch_new)
+        while not self.stopping.is_set():
+            wait = self.scheduler.wait_time()
+            if wait > 0:
+                self.stopping.wait(wait)
+                continue
+
+            state = self.scheduler.pop_due()
+            start = timeit.default_timer()
+            try:
+                with profiling.span("fetch", tag=state.tag):
+                    (media_dicts, newest_ids, num_new, num_calls, complete,
+                     max_tag_id) = fetch_new(
+                        state.tag, **self.scheduler.fetch_kwargs(state))
+            except Exception:
+                logging.getLogger().exception("Failed to fetch %s from "
+                                              "Instagram" % state.tag)
+                self.scheduler.reschedule(state)
+                continue
+            self.scheduler.record_poll(state, num_new, complete, newest_ids,
+                                       max_tag_id)
+            num_fetched = len(media_dicts)
+            media_dicts = self.collector.drop_seen(media_dicts)
+            fetch_seconds = timeit.default_timer() - start
+            profiling.count("photos_fetched", num_fetched)
+            self.record(fetch_seconds=fetch_seconds, num_fetched=num_fetched,
+                        num_not_seen=len(media_dicts))
+            logging.getLogger().info("Fetched %d photos tagged %s, %d not "
+                "seen before, with %d calls in %fs" %
+                (num_fetched, state.tag, len(media_dicts), num_calls,
+                 fetch_seconds))
+
+            for media_dict in media_dicts:
+                self.enrich_queue.put(media_dict)
+        self.enrich_queue.put(_DONE)
+
+    def enricher(self):
+        while True:
+            media_dict = self.enrich_queue.get()
+            if media_dict is _DONE:
+                break
+            start = timeit.default_timer()
+            with profiling.span("enrich"):
+                media_dict = self.collector.enrich(media_dict)
+            self.record(enrich_seconds=timeit.default_timer() - start)
+            self.write_queue.put(media_dict)
+        self.write_queue.put(_DONE)
+
+    def writer(self):
+        insert = retries(5, hook=example_exc_handler, delay=10,
+                         backoff=2)(self.collector.insert)
+        batch = []
+        deadline = None
+        while True:
+            try:
+                if deadline is None:
+                    media_dict = self.write_queue.get()
+                else:
+                    media_dict = self.write_queue.get(
+                        timeout=max(0, deadline - timeit.default_timer()))
+            except Queue.Empty:
+                media_dict = None
+
+            if media_dict is not None and media_dict is not _DONE:
+                if not batch:
+                    deadline = timeit.default_timer() + self.flush_seconds
+                batch.append(media_dict)
+
+            if batch and (media_dict is None or media_dict is _DONE or
+                          len(batch) >= self.batch_size):
+                start = timeit.default_timer()
+                try:
+                    with profiling.span("insert", photos=len(batch)):
+                        num_new, num_duplicates = insert(batch)
+                except Exception:
+                    logging.getLogger().exception("Failed to save %d photos" %
+                                                  len(batch))
+                    num_new, num_duplicates = 0, 0
+                insert_seconds = timeit.default_timer() - start
+                self.record(insert_seconds=insert_seconds, num_new=num_new,
+                            num_duplicates=num_duplicates)
+                logging.getLogger().info("Inserted %d of %d photos (%d "
+                    "duplicates) in %fs" % (num_new, len(batch),
+                    num_duplicates, insert_seconds))
+                batch = []
+                deadline = None
+
+            if media_dict is _DONE:
+                break
 
 
 if __name__ == "__main__":
@@ -69,16 +487,50 @@ if __name__ == "__main__":
         "links to the images and GPS coordinates to MongoDB")
     parser.add_argument('--logfile', type=str, default="instagram_map.log",
                    help='Name of logfile')
-    parser.add_argument('--tag', type=str, required=True,
-                   help='Tag to search for')
-    parser.add_argument('--delay', type=int, default=30,
-                   help='Delay time between hits to the Instagram API')
+    parser.add_argument('--tags', '--tag', type=str, nargs='+',
+                   required=True, help='Tags to search for')
+    parser.add_argument('--delay', type=float, default=30,
+                   help='Delay time between hits to the Instagram API for '
+                   'each tag, until its rate of new photos is known')
+    parser.add_argument('--min_delay', type=float, default=2,
+                   help='Shortest delay between polls of a tag')
+    parser.add_argument('--max_delay', type=float, default=600,
+                   help='Longest delay between polls of a tag')
+    parser.add_argument('--calls_per_hour', type=int, default=4000,
+                   help='Most Instagram API calls to make per hour, across '
+                   'all tags')
+    parser.add_argument('--max_pages', type=int, default=10,
+                   help='Most pages to fetch when catching up on a tag')
+    parser.add_argument('--geonames_timeout', type=float, default=2,
+                   help='Seconds to wait for a timezone from geonames before '
+                   'saving a photo without one')
+    parser.add_argument('--batch_size', type=int, default=100,
+                   help='Number of photos to save to MongoDB at once')
+    parser.add_argument('--flush_seconds', type=float, default=5,
+                   help='Longest time a photo waits to be saved to MongoDB')
+    parser.add_argument('--seen_ids', type=int, default=100000,
+                   help='Number of recently saved photo ids to remember, so '
+                   'that they are not looked up or saved again')
+    parser.add_argument('--queue_size', type=int, default=1000,
+                   help='Number of photos that can wait for each stage before '
+                   'polling Instagram is held up')
+    parser.add_argument('--profile', choices=profiling.TRACE_FORMATS,
+                   default=None,
+                   help='If given, then write timing spans and counters as '
+                   'JSON lines or a Chrome trace next to the logfile')
+    parser.add_argument('--profile_memory_interval', type=float, default=0.1,
+                   help='Seconds between samples of memory use when '
+                   'profiling, or 0 to not sample')
 
     args = parser.parse_args()
 
     logging.basicConfig(filename=args.logfile,
                         level=logging.DEBUG)
     logging.basicConfig(format='%(asctime)s %(message)s')
+    if args.profile:
+        profiling.enable(profiling.trace_path(args.logfile, args.profile),
+                         trace_format=args.profile,
+                         memory_interval=args.profile_memory_interval)
 
     if CLIENT_ID is None:
         raise ValueError("Environment variable INSTAGRAM_CLIENT_ID must "
@@ -87,6 +539,22 @@ if __name__ == "__main__":
         raise ValueError("Environment variable INSTAGRAM_CLIENT_SECRET must "
             "contain your client ID")
 
-    while True:
-        save_instagram_to_mongo(args.tag)
-        sleep(args.delay)
+    collector = Collector.from_environment(
+        geonames_timeout=args.geonames_timeout, seen_ids=args.seen_ids)
+    scheduler = TagScheduler(args.tags, initial_delay=args.delay,
+                             min_delay=args.min_delay,
+                             max_delay=args.max_delay,
+                             calls_per_hour=args.calls_per_hour,
+                             max_pages=args.max_pages)
+    pipeline = CollectorPipeline(collector, scheduler,
+                                 queue_size=args.queue_size,
+                                 batch_size=args.batch_size,
+                                 flush_seconds=args.flush_seconds)
+    pipeline.start()
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        pipeline.stop()
+    finally:
+        profiling.disable()
@@ -1,199 +1,1111 @@
 import os
+import copy
 import argparse
 import pymongo
 import numpy as np
-from scipy.ndimage.filters import gaussian_filter
-from mpl_toolkits.basemap import Basemap
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 import matplotlib.patches as patches
 import datetime
 import logging
+import time
 
-from configs import (cameras, ValidRegions)
-from extract_data import (add_timezone_info, read_results_from_mongo)
+import profiling
+from configs import (cameras, ValidRegions, ValidRegionsOrAll)
+from aggregate import (aggregate_points, AGGREGATE_GRID)
+from density import (DENSITY_BACKENDS, GaussianFilterDensity,
+                     SeparableDensity)
+from extract_data import (add_timezone_info, add_geojson_locations)
+from map_background import (get_map_background, DEFAULT_DPI)
+from frame_sinks import (PngSink, RawStackSink, EncoderSink, LatestPngSink,
+                         encoder_command, encode_stack, DEFAULT_ENCODER)
+from high_resolution import (BinnedPoints, finish_heatmap, heatmap_shape,
+                             uint8_lut, parse_resolution,
+                             DEFAULT_PIXELS_PER_BIN)
+from histogram_cube import (HistogramCube, bin_times, frame_bin_minutes,
+                            cube_nbytes)
+from live import (LiveHeatmap, NewPhotoPoller)
+from parallel_render import (run_parallel, split_into_chunks)
+from point_dataset import PointDataset
+from snapshot import (sync_snapshot, load_snapshot)
+from streaming import (parse_time, range_frame_times, iter_point_chunks,
+                       SlidingWindow)
+from tiles import (TilePyramid, TileWriter)
+from norm_cache import (NormalizationCache, normalization_key,
+                        dataset_fingerprint)
+from viewport import (camera_bounds, union_bounds, bounds_mask, points_query)
 from utils import TimedLogger
 
-def fix_opacity_and_color_map(x, opacity_thresh=0.1, max_opacity=0.8):
-    """"Given a 2d image, x, get rgbt values for each pixel and modify
-    opacity values"""
-    tmp = cm.hot(x)
+def build_color_lut(colormap=cm.hot, rgb_gain=2.0, opacity_thresh=0.1,
+                    max_opacity=0.8, nentries=4096):
+    """Precompute an ``nentries`` x 4 RGBA lookup table for the heatmap.
 
-    for i in xrange(tmp.shape[0]):
-        for j in xrange(tmp.shape[1]):
+    Entry ``i`` holds the color of the pixel value at the centre of the bin
+    ``[i/nentries, (i+1)/nentries)``, with RGB scaled by ``rgb_gain`` and the
+    opacity ramp applied.  If ``nentries`` is a multiple of ``colormap.N``
+    the RGB values are identical to calling the colormap directly, and only
+    the opacity ramp is quantized.
+    """
+    x = (np.arange(nentries) + 0.5) / nentries
+    lut = colormap(x)
+    lut[:, :3] *= rgb_gain
+    lut[:, 3] = np.where(x > opacity_thresh, max_opacity,
+                         max_opacity * x / opacity_thresh)
+    return lut
 
-            # XXXXXXXXXXXX
-            tmp[i,j][0] *= 2
-            tmp[i,j][1] *= 2
-            tmp[i,j][2] *= 2
+def fix_opacity_and_color_map(x, opacity_thresh=0.1, max_opacity=0.8,
+                              lut=None, out=None):
+    """"Given a 2d image, x, get rgbt values for each pixel and modify
+    opacity values.
 
-            # ############
+    Colors are looked up in ``lut`` (built by ``build_color_lut`` if not
+    given), with values outside [0, 1] clipped to the ends of the table.  If
+    ``out`` is given it must be a float64 array of shape ``x.shape + (4,)``,
+    and it is filled in place and returned.
+    """
+    if lut is None:
+        lut = build_color_lut(opacity_thresh=opacity_thresh,
+                              max_opacity=max_opacity)
+    nentries = lut.shape[0]
 
-            if x[i,j] > opacity_thresh:
-                tmp[i,j][3] = max_opacity
-            else:
-                tmp[i,j][3] = max_opacity * x[i,j] / opacity_thresh
-    return tmp
+    idx = np.multiply(x, nentries)
+    np.clip(idx, 0, nentries - 1, out=idx)
+    return np.take(lut, idx.astype(np.intp), axis=0, out=out, mode="clip")
 
-def add_time_labels(fig, target_time, background_color="#FFFFFF"):
-    """Adds time labels to the plot"""
+def add_time_labels(fig, target_time, background_color="#FFFFFF",
+                    rect=(0, 0, 1, 1)):
+    """Adds time labels to the plot, in a new axes at ``rect`` which is
+    returned.  If ``background_color`` is None then no background is drawn
+    behind the labels"""
 
     #Axes with range [0,1] to allow for easy absolute positioning of text
-    ax = fig.add_axes([0,0,1,1])
+    ax = fig.add_axes(list(rect))
 
     # axes coordinates are 0,0 is bottom left and 1,1 is upper right
-    p = patches.Rectangle((0, 0), 1, 1, fill=True, transform=ax.transAxes,
-                          clip_on=False, color=background_color)
-    ax.add_patch(p)
+    if background_color is not None:
+        p = patches.Rectangle((0, 0), 1, 1, fill=True, transform=ax.transAxes,
+                              clip_on=False, color=background_color)
+        ax.add_patch(p)
 
     font_kwargs = {"color": "white", "fontsize": 40, "transform": ax.transAxes}
 
-    gmt_time = target_time - datetime.timedelta(hours=0)
-    ax.text(0.5, 0.02, gmt_time.strftime("%I%p GMT"),
+    gmt_label, eastern_label, aest_label = time_label_strings(target_time)
+    ax.text(0.5, 0.02, gmt_label,
         horizontalalignment='center',
         verticalalignment='bottom',
         **font_kwargs)
 
-    eastern_time = target_time - datetime.timedelta(hours=4)
-    ax.text(0.02, 0.02, eastern_time.strftime("%I%p EST"),
+    ax.text(0.02, 0.02, eastern_label,
         horizontalalignment='left',
         verticalalignment='bottom',
         **font_kwargs)
 
-    aest_time = target_time + datetime.timedelta(hours=10)
-    ax.text(0.98, 0.02, aest_time.strftime("%I%p AEST"),
+    ax.text(0.98, 0.02, aest_label,
         horizontalalignment='right',
         verticalalignment='bottom',
         **font_kwargs)
 
     ax.set_axis_off()
+    return ax
+
+def time_label_strings(target_time, show_date=False):
+    """Text of the GMT, EST and AEST labels drawn by ``add_time_labels``.
+    If ``show_date`` is set then the GMT label includes the date"""
+    gmt_time = target_time - datetime.timedelta(hours=0)
+    eastern_time = target_time - datetime.timedelta(hours=4)
+    aest_time = target_time + datetime.timedelta(hours=10)
+    return [gmt_time.strftime("%d %b %I%p GMT" if show_date else "%I%p GMT"),
+            eastern_time.strftime("%I%p EST"),
+            aest_time.strftime("%I%p AEST")]
+
+class FrameCanvas(object):
+    """One figure, holding the map background, the heatmap and the time
+    labels, that is redrawn for every frame of a sequence rather than
+    making a new figure each time.
+
+    ``render`` draws straight to the figure's Agg canvas and returns the
+    pixels as a (height, width, 4) uint8 array, which is only valid until
+    the next call.  ``show_date`` is passed on to ``time_label_strings``.
+    """
+
+    def __init__(self, background, extent, target_time, show_date=False):
+        self.fig = background.new_figure()
+        self.ax = add_time_labels(self.fig, target_time,
+                                  background_color=None,
+                                  rect=background.position)
+        self.image = None
+        self.extent = extent
+        self.show_date = show_date
+
+    def render(self, rgba, target_time):
+        if self.image is None:
+            self.image = self.ax.imshow(rgba, extent=self.extent, zorder=10,
+                                        aspect="auto")
+        else:
+            self.image.set_data(rgba)
+        for text, label in zip(self.ax.texts,
+                               time_label_strings(target_time,
+                                                  self.show_date)):
+            text.set_text(label)
+
+        canvas = self.fig.canvas
+        canvas.draw()
+        width, height = canvas.get_width_height()
+        return np.frombuffer(canvas.buffer_rgba(),
+                             dtype=np.uint8).reshape(height, width, 4)
 
 
 def make_single_map(target_time, camera, lons, lats, weights, gauss_sigma=1,
              sea_color="#111111", land_color="#888888", nheatmapbins=500,
              file_prefix="USA", opacity_thresh=0.1, max_opacity=0.8,
-             calc_norm_map=False, norm_map=None, do_map_normalization=False):
-    """Makes a single image"""
-
-    fig = plt.gcf()
-
-    fig = plt.figure()
-    fig.set_size_inches(16,9)
-    plt.clf()
-
-    add_time_labels(fig, target_time, background_color=sea_color)
-
-    m = Basemap(
-            projection=camera["projection"],
-            resolution=camera["resolution"],
-            **camera["projection_kwargs"])
-    m.drawcoastlines(color=sea_color)
-    m.drawcountries(color=sea_color)
-    m.drawstates(color=sea_color)
-    m.drawmapboundary(fill_color=sea_color)
-    m.fillcontinents(color=land_color,lake_color=sea_color)
-
-    xpoints,ypoints = m(lons,lats)
-    im, xedges, yedges = np.histogram2d(xpoints, ypoints,
-                                    range=((m.llcrnrx, m.urcrnrx),
-                                           (m.llcrnry, m.urcrnry)),
-                                    bins=(nheatmapbins, (9./16.)*nheatmapbins),
-                                    weights=weights)
+             calc_norm_map=False, norm_map=None, do_map_normalization=False,
+             color_lut=None, rgba_buffer=None, background_cache_dir=None,
+             histogram=None, canvas=None, sink=None, frame_index=0,
+             density=None):
+    """Makes a single image.
+
+    If ``histogram`` is given, as an ``(im, xedges, yedges)`` tuple such as
+    ``HistogramCube.histogram`` returns, then it is used as the weighted
+    histogram and ``lons``, ``lats`` and ``weights`` are ignored.
+
+    The map itself comes from ``get_map_background``, so it is only drawn
+    once per camera (and, if ``background_cache_dir`` is set, once across
+    runs).  ``color_lut`` and ``rgba_buffer`` are passed through to
+    ``fix_opacity_and_color_map`` so that a sequence of frames can share one
+    lookup table and one RGBA array.
+
+    The frame is drawn on ``canvas``, a ``FrameCanvas`` that can be shared
+    by a sequence of frames, and handed to ``sink`` as frame number
+    ``frame_index``.  By default a new canvas is made and the frame is saved
+    to ``file_prefix`` + ".png".  Returns the histogram if ``calc_norm_map``
+    is True, otherwise the RGBA heatmap that was drawn.
+
+    The heatmap is smoothed by ``gauss_sigma`` bins with ``density``, one of
+    the ``density.DENSITY_BACKENDS``, or with ``gaussian_filter`` if it is
+    not given.
+    """
+
+    with profiling.span("background"):
+        background = get_map_background(camera, figsize=(16, 9),
+                                        sea_color=sea_color,
+                                        land_color=land_color,
+                                        cache_dir=background_cache_dir)
+    m = background.basemap
+
+    if histogram is None:
+        with profiling.span("project"):
+            xpoints,ypoints = m(lons,lats)
+        profiling.count("points", len(xpoints))
+        with profiling.span("histogram"):
+            im, xedges, yedges = np.histogram2d(xpoints, ypoints,
+                                        range=((m.llcrnrx, m.urcrnrx),
+                                               (m.llcrnry, m.urcrnry)),
+                                        bins=(nheatmapbins,
+                                              int((9./16.)*nheatmapbins)),
+                                        weights=weights)
+    else:
+        im, xedges, yedges = histogram
 
     extent = [xedges[0], xedges[-1], yedges[0], yedges[-1]]
 
-    im = np.log(np.rot90(im)+1)
+    with profiling.span("log"):
+        im = np.log(np.rot90(im)+1)
 
     if calc_norm_map:
         return im
 
     if do_map_normalization:
-        im = np.divide(im, norm_map)
-        im[np.isnan(im)] = 0.0
+        with profiling.span("normalize"):
+            im = np.divide(im, norm_map)
+            im[np.isnan(im)] = 0.0
 
     if not calc_norm_map:
 
-        im = gaussian_filter(im, gauss_sigma)
+        if density is None:
+            density = GaussianFilterDensity()
+        with profiling.span("blur"):
+            im = density.smooth(im, gauss_sigma)
+
+        with profiling.span("colorize"):
+            rgba = fix_opacity_and_color_map(im, max_opacity=max_opacity,
+                                             opacity_thresh=opacity_thresh,
+                                             lut=color_lut, out=rgba_buffer)
+
+        if canvas is None:
+            canvas = FrameCanvas(background, extent, target_time)
+        if sink is None:
+            sink = PngSink()
+        with profiling.span("draw"):
+            frame = canvas.render(rgba, target_time)
+        logging.getLogger().info("Writing frame : "+file_prefix)
+        with profiling.span("write"):
+            sink.write(frame_index, file_prefix, frame)
+        profiling.count("frames")
+        return rgba
+
+
 
-        plt.imshow(fix_opacity_and_color_map(im, max_opacity=max_opacity,
-                                             opacity_thresh=opacity_thresh),
-                    extent=extent, zorder=10)
-        logging.getLogger().info("Saving file : "+file_prefix+".png")
-        plt.savefig(file_prefix+".png")
+def point_arrays(points):
+    """Return numpy arrays of the latitude, longitude and minute of the day
+    (0-1439) of each of ``points``, which is either a ``PointDataset`` or a
+    list of MongoDB results"""
+    if not isinstance(points, PointDataset):
+        points = PointDataset.from_results(points)
+    return points.lat, points.lon, points.minutes
 
+def point_counts(points):
+    """Number of photos that each of ``points`` stands for, or None if each
+    is a single photo"""
+    return getattr(points, "count", None)
 
+def decay_weights(minutes, time, decay_hours=1):
+    """Weights for points taken at ``minutes`` past midnight, which drop off
+    as the points fall further into the past of ``time``"""
+
+    #Time to the nearest minute from the photo being taken to now:
+    #+ve times mean that the photo was taken earlier than now.
+    dt_in_minutes = (60*time.hour + time.minute - minutes) % (24*60)
+    return np.exp(-dt_in_minutes/60./decay_hours)
 
 def calculate_point_weights(points, time, decay_hours=1):
     """For each of the lat and lng points calculate a weight.
     Point weights should drop off as the associated time falls further into
     the past"""
 
-    lat = []
-    lon = []
-    weights = []
-    for res in points:
-        image_time = res["created_time"]
-
-        #Time to the nearest minute from the photo being taken to now:
-        #+ve times mean that the photo was taken earlier than now.
-        dt_in_minutes = (60*(time.hour - image_time.hour) +
-                            (time.minute-image_time.minute))
-        if dt_in_minutes < 0:
-            dt_in_minutes = dt_in_minutes + 24*60
-        weight = np.exp(-float(dt_in_minutes)/60/decay_hours)
-        lat.append(res["latitude"])
-        lon.append(res["longitude"])
-        weights.append(weight)
-
-    return lat, lon, weights
+    lat, lon, minutes = point_arrays(points)
+    return lat, lon, decay_weights(minutes, time, decay_hours=decay_hours)
 
-def make_map_sequence(args, full_results, calc_norm_map=False,
-                      do_map_normalization=False, aggregate_norm_frame=None):
-    """Generate heatmap frames and do one of two things, if ``calc_norm_map`` is
-    False then save an image of the heatmap overlaid on a Basemap.  If
-    ``calc_norm_map`` is True then calculate the heatmap and return it for use
-    in an integrated normalization map.
+def use_histogram_cube(args, nheatmapbins=500):
+    """Whether to bin the points into a ``HistogramCube``: unless
+    ``args.no_histogram_cube`` is set, or the cube would take more than
+    ``args.max_cube_mb``, in which case every frame weights and histograms
+    every point instead"""
+    if args.no_histogram_cube:
+        return False
+    nbytes = cube_nbytes((nheatmapbins, int((9./16.)*nheatmapbins)),
+                         args.minutes_step)
+    if nbytes > args.max_cube_mb*2**20:
+        logging.getLogger().warning("Not binning points by time of day, as "
+            "the histogram cube for minutes_step=%d would take %dMB, more "
+            "than max_cube_mb=%d" % (args.minutes_step, nbytes//2**20,
+                                     args.max_cube_mb))
+        return False
+    return True
 
-    args:  argparse parsed arguments for this program
-    full_results:  Full dump of the MongoDB results
-    """
+def build_histogram_cube(points, camera, minutes_step=60, decay_hours=1,
+                         nheatmapbins=500, background_cache_dir=None,
+                         binned_times=None):
+    """Project every point once and bin it into a ``HistogramCube`` that can
+    produce the weighted histogram for every frame of the day.
+    ``binned_times`` is passed on to ``HistogramCube``"""
+
+    m = get_map_background(camera, cache_dir=background_cache_dir).basemap
 
-    timedelta = datetime.timedelta(minutes=args.minutes_step)
+    lat, lon, minutes = point_arrays(points)
+    xpoints, ypoints = m(lon, lat)
+    return HistogramCube.for_frame_step(xpoints, ypoints, minutes,
+                                        (m.llcrnrx, m.urcrnrx),
+                                        (m.llcrnry, m.urcrnry),
+                                        (nheatmapbins,
+                                         int((9./16.)*nheatmapbins)),
+                                        minutes_step=minutes_step,
+                                        decay_hours=decay_hours,
+                                        counts=point_counts(points),
+                                        binned_times=binned_times)
+
+def frame_times(minutes_step):
+    """Times of each of the frames in a day long sequence"""
+
+    timedelta = datetime.timedelta(minutes=minutes_step)
     target_time = datetime.datetime(2014, 1, 1, 0,0,0)
 
+    times = []
     while target_time.day == 1:
         target_time += timedelta
+        times.append(target_time)
+    return times
+
+def frame_output_paths(args):
+    """Paths of the frame stack and of the video for ``args.region``"""
+    base = os.path.join(args.data_dir, args.region)
+    return base + "_frames.npy", base + ".mp4"
+
+def open_frame_sink(args, shape, streaming=True):
+    """Return the sink that ``args.output`` asks for, for frames of
+    (height, width) ``shape``.  For "stack" output the stack must already
+    exist.  Video is piped to the encoder if ``streaming`` is set, and
+    otherwise written to the stack for ``encode_stack``"""
+    if args.output == "png":
+        return PngSink()
+    stack_path, video_path = frame_output_paths(args)
+    if args.output == "video" and streaming:
+        return EncoderSink(encoder_command(video_path, shape[1], shape[0],
+                                           fps=args.fps,
+                                           template=args.encoder))
+    return RawStackSink(stack_path)
+
+def render_frames(args, target_times, lat, lon, minutes, cube=None,
+                  calc_norm_map=False, do_map_normalization=False,
+                  norm_map=None, counts=None, sink=None):
+    """Make the frame for each of ``target_times``, see ``make_map_sequence``.
+    ``counts``, if given, is the number of photos each point stands for.
+    Frames are written to ``sink``, or to a sink from ``open_frame_sink``
+    that is closed once they are done.  Returns the sum of the frames if
+    ``calc_norm_map`` is True, otherwise None"""
+
+    camera = cameras[args.region]
+    max_opacity = camera.get("max_opacity", 0.8)
+    opacity_thresh = camera.get("opacity_thresh", 0.1)
+
+    # The colormap lookup table, the RGBA output buffer and the figure are
+    # the same for every frame, so build them once up front
+    color_lut = build_color_lut(opacity_thresh=opacity_thresh,
+                                max_opacity=max_opacity)
+    density = DENSITY_BACKENDS[args.density]()
+    rgba_buffer = None
+    frame_sum = None
+
+    canvas = None
+    own_sink = False
+    if not calc_norm_map and target_times:
+        background = get_map_background(camera,
+                                        cache_dir=args.background_cache_dir)
+        m = background.basemap
+        canvas = FrameCanvas(background,
+                             [m.llcrnrx, m.urcrnrx, m.llcrnry, m.urcrnry],
+                             target_times[0])
+        if sink is None:
+            sink = open_frame_sink(args, background.image.shape)
+            own_sink = True
+    all_times = frame_times(args.minutes_step)
 
-        lat, lon, weights = calculate_point_weights(full_results,
-                                                    target_time, decay_hours=1)
+    for target_time in target_times:
+
+        if cube is None:
+            weights = decay_weights(minutes, target_time, decay_hours=1)
+            if counts is not None:
+                weights *= counts
+            histogram = None
+        else:
+            weights = None
+            with profiling.span("cube_histogram"):
+                histogram = cube.histogram(target_time)
 
         file_prefix = os.path.join(args.data_dir,
                                    args.region+target_time.strftime("%H%M"))
 
         map_kwargs = {
-            "gauss_sigma": 1,
+            "gauss_sigma": args.gauss_sigma,
             "file_prefix": file_prefix,
             "opacity_thresh": opacity_thresh,
             "max_opacity": max_opacity,
             "calc_norm_map": calc_norm_map,
             "do_map_normalization": do_map_normalization,
-            "norm_map": aggregate_norm_frame
+            "norm_map": norm_map,
+            "color_lut": color_lut,
+            "rgba_buffer": rgba_buffer,
+            "background_cache_dir": args.background_cache_dir,
+            "histogram": histogram,
+            "canvas": canvas,
+            "sink": sink,
+            "frame_index": all_times.index(target_time),
+            "density": density
         }
 
         with TimedLogger("Generating frame with prefix %s" % file_prefix,
                          logging.getLogger()):
-            norm_frame = make_single_map(target_time, cameras[args.region], lon,
+            frame = make_single_map(target_time, camera, lon,
                      lat, weights, **map_kwargs)
 
         if calc_norm_map:
+            if frame_sum is None:
+                frame_sum = frame
+            else:
+                frame_sum = np.add(frame_sum, frame)
+        else:
+            # Colorize the next frame into the RGBA array of this one
+            rgba_buffer = frame
+
+    if own_sink:
+        sink.close()
+    return frame_sum
+
+def _render_frames_task(target_times, arrays, context):
+    """Worker process entry point used by ``make_map_sequence``"""
+    args, cube, calc_norm_map, do_map_normalization, shape = context
+    if cube is not None:
+        cube.cube = arrays["cube"]
+    sink = None
+    if not calc_norm_map:
+        # Frames from several processes can't be piped to one encoder, so
+        # video goes through the frame stack
+        sink = open_frame_sink(args, shape, streaming=False)
+    frame_sum = render_frames(args, target_times, arrays["lat"],
+                              arrays["lon"], arrays["minutes"], cube=cube,
+                              calc_norm_map=calc_norm_map,
+                              do_map_normalization=do_map_normalization,
+                              norm_map=arrays.get("norm_map"),
+                              counts=arrays.get("counts"), sink=sink)
+    if sink is not None:
+        sink.close()
+    return frame_sum
+
+def make_map_sequence(args, full_results, calc_norm_map=False,
+                      do_map_normalization=False, aggregate_norm_frame=None,
+                      cube=None):
+    """Generate heatmap frames and do one of two things, if ``calc_norm_map`` is
+    False then save an image of the heatmap overlaid on a Basemap.  If
+    ``calc_norm_map`` is True then calculate the heatmap and return it for use
+    in an integrated normalization map.
+
+    If ``args.workers`` is more than one, the frames are split into that many
+    contiguous chunks which are rendered in separate processes.  In the
+    normalization pass each worker sums its own frames, and only those
+    partial sums are sent back and added together.
+
+    Frames go to the sink that ``args.output`` picks (see
+    ``open_frame_sink``).  The frame stack is created here, before any
+    frames are rendered.  With several workers, video is written to the
+    stack first and then encoded from it, and the stack is removed.
+
+    args:  argparse parsed arguments for this program
+    full_results:  ``PointDataset`` (or list of MongoDB results) to draw
+    cube:  Optional ``HistogramCube`` built from ``full_results``.  If given,
+        frame histograms come from it rather than from a pass over the points
+    """
+
+    lat, lon, minutes = point_arrays(full_results)
+    counts = point_counts(full_results)
+    target_times = frame_times(args.minutes_step)
+    norm_map = None if calc_norm_map else aggregate_norm_frame
+
+    # Draw the map before any workers start, so that they all inherit it
+    background = get_map_background(cameras[args.region],
+                                    cache_dir=args.background_cache_dir)
+    shape = background.image.shape[:2]
+
+    parallel = args.workers > 1
+    stack_path, video_path = frame_output_paths(args)
+    use_stack = not calc_norm_map and (args.output == "stack" or
+                                       (args.output == "video" and parallel))
+    if use_stack:
+        RawStackSink(stack_path, len(target_times), shape).close()
+
+    with profiling.span("make_map_sequence", frames=len(target_times),
+                        workers=args.workers, points=len(lat),
+                        calc_norm_map=calc_norm_map):
+        if parallel:
+            arrays = {"lat": lat, "lon": lon, "minutes": minutes}
+            if norm_map is not None:
+                arrays["norm_map"] = norm_map
+            if counts is not None:
+                arrays["counts"] = counts
+            if cube is not None:
+                # The cube itself travels as a shared array, not with the
+                # object
+                arrays["cube"] = cube.cube
+                cube = copy.copy(cube)
+                cube.cube = None
+
+            frame_sums = run_parallel(_render_frames_task,
+                            split_into_chunks(target_times, args.workers),
+                            args.workers, arrays,
+                            context=(args, cube, calc_norm_map,
+                                     do_map_normalization, shape))
+        else:
+            frame_sums = [render_frames(args, target_times, lat, lon,
+                                minutes, cube=cube,
+                                calc_norm_map=calc_norm_map,
+                                do_map_normalization=do_map_normalization,
+                                norm_map=norm_map, counts=counts)]
+
+    if use_stack and args.output == "video":
+        with TimedLogger("Encoding %s" % video_path, logging.getLogger()):
+            encode_stack(stack_path, encoder_command(video_path, shape[1],
+                                                     shape[0], fps=args.fps,
+                                                     template=args.encoder))
+        os.remove(stack_path)
+
+    if calc_norm_map:
+        for frame_sum in frame_sums:
             if aggregate_norm_frame is None:
-                aggregate_norm_frame = norm_frame
+                aggregate_norm_frame = frame_sum
             else:
                 aggregate_norm_frame = np.add(aggregate_norm_frame,
-                                                  norm_frame)
+                                                  frame_sum)
 
     return aggregate_norm_frame
 
+def make_high_resolution_sequence(args, full_results):
+    """Write the frames of the day at ``args.resolution``, with the heatmap
+    grid worked out from it, using the float32 in place pipeline of
+    ``high_resolution``.  Frames are rendered in this process, one at a
+    time, whatever ``args.workers`` is"""
+
+    camera = cameras[args.region]
+    width, height = args.resolution
+    background = get_map_background(camera,
+                                    figsize=(float(width)/DEFAULT_DPI,
+                                             float(height)/DEFAULT_DPI),
+                                    cache_dir=args.background_cache_dir)
+    m = background.basemap
+    shape = heatmap_shape(args.resolution, args.pixels_per_bin)
+
+    lat, lon, minutes = point_arrays(full_results)
+    with TimedLogger("Binning points into %dx%d grid" % (shape[1], shape[0]),
+                     logging.getLogger()):
+        points = BinnedPoints(lat, lon, minutes, (m.llcrnrx, m.urcrnrx),
+                              (m.llcrnry, m.urcrnry), shape, m,
+                              counts=point_counts(full_results))
+
+    def frame_weights(target_time):
+        def weights(start, stop):
+            w = decay_weights(points.minutes[start:stop], target_time,
+                              decay_hours=1)
+            if points.counts is not None:
+                w *= points.counts[start:stop]
+            return w
+        return weights
+
+    target_times = frame_times(args.minutes_step)
+    grid = np.empty(shape, dtype=np.float32)
+
+    norm_map = None
+    if args.normalize_map:
+        with TimedLogger("Making normalization map", logging.getLogger()):
+            norm_map = np.zeros(shape, dtype=np.float32)
+            for target_time in target_times:
+                points.accumulate(frame_weights(target_time), out=grid)
+                norm_map += np.log1p(grid, out=grid)
+
+    lut = uint8_lut(build_color_lut(
+        opacity_thresh=camera.get("opacity_thresh", 0.1),
+        max_opacity=camera.get("max_opacity", 0.8)))
+    # separable gives the same blur as gaussian_filter, but in place
+    if args.density == "gaussian_filter":
+        density = SeparableDensity()
+    else:
+        density = DENSITY_BACKENDS[args.density]()
+
+    canvas = FrameCanvas(background,
+                         [m.llcrnrx, m.urcrnrx, m.llcrnry, m.urcrnry],
+                         target_times[0])
+    if args.output == "stack":
+        RawStackSink(frame_output_paths(args)[0], len(target_times),
+                     background.image.shape).close()
+    sink = open_frame_sink(args, background.image.shape)
+
+    rgba = None
+    for frame_index, target_time in enumerate(target_times):
+        file_prefix = os.path.join(args.data_dir,
+                                   args.region+target_time.strftime("%H%M"))
+        with TimedLogger("Generating frame with prefix %s" % file_prefix,
+                         logging.getLogger()):
+            points.accumulate(frame_weights(target_time), out=grid)
+            rgba = finish_heatmap(grid, lut, sigma=args.gauss_sigma,
+                                  density=density, norm_map=norm_map,
+                                  out=rgba)
+            sink.write(frame_index, file_prefix,
+                       canvas.render(rgba, target_time))
+    sink.close()
+
+def frame_histograms(points, camera, minutes_step, nheatmapbins=500,
+                     decay_hours=1, background_cache_dir=None, cube=None,
+                     use_cube=True):
+    """Return the (nframes, nx, ny) stack of the weighted histograms of
+    ``points`` for each frame of the day, without drawing anything.
+
+    The histograms come from ``cube`` if it is given, otherwise from a
+    ``HistogramCube`` built here if ``use_cube`` is set, otherwise from one
+    ``np.histogram2d`` per frame.
+    """
+    target_times = frame_times(minutes_step)
+    if cube is None and use_cube:
+        cube = build_histogram_cube(points, camera, minutes_step=minutes_step,
+                                    decay_hours=decay_hours,
+                                    nheatmapbins=nheatmapbins,
+                                    background_cache_dir=background_cache_dir)
+    if cube is not None:
+        return np.array([cube.histogram(t)[0] for t in target_times])
+
+    m = get_map_background(camera, cache_dir=background_cache_dir).basemap
+    lat, lon, minutes = point_arrays(points)
+    counts = point_counts(points)
+    xpoints, ypoints = m(lon, lat)
+    histograms = np.empty((len(target_times), nheatmapbins,
+                           int((9./16.)*nheatmapbins)))
+    for n, target_time in enumerate(target_times):
+        weights = decay_weights(minutes, target_time, decay_hours=decay_hours)
+        if counts is not None:
+            weights *= counts
+        histograms[n] = np.histogram2d(xpoints, ypoints,
+                                       range=((m.llcrnrx, m.urcrnrx),
+                                              (m.llcrnry, m.urcrnry)),
+                                       bins=histograms.shape[1:],
+                                       weights=weights)[0]
+    return histograms
+
+def normalization_from_histograms(histograms):
+    """Sum the frames of ``histograms`` the way ``make_map_sequence`` does
+    with ``calc_norm_map``"""
+    norm_map = None
+    for histogram in histograms:
+        frame = np.log(np.rot90(histogram) + 1)
+        if norm_map is None:
+            norm_map = frame
+        else:
+            norm_map += frame
+    return norm_map
+
+def cached_normalization_map(args, points, bounds=None, cube=None):
+    """Return the normalization map for ``args.region``, reusing or
+    updating the frame histograms cached in ``args.norm_cache_dir`` (by
+    default ``args.data_dir``) where possible.
+
+    ``points`` are all of the points loaded, of which only those inside
+    ``bounds`` are drawn.  ``cube``, if given, is the ``HistogramCube`` of
+    the points that are drawn.
+    """
+    camera = cameras[args.region]
+
+    def drawn(subset):
+        if bounds is None:
+            return subset
+        return subset.select(bounds_mask(bounds, subset.lat, subset.lon))
+
+    fingerprint, appendable = dataset_fingerprint(points)
+    key = normalization_key(camera, 500, args.minutes_step, 1, bounds=bounds)
+    cache = NormalizationCache(args.norm_cache_dir or args.data_dir)
+    histogram_kwargs = {"background_cache_dir": args.background_cache_dir,
+                        "use_cube": use_histogram_cube(args)}
+
+    histograms = None
+    cached = cache.load(key)
+    if cached is not None and cached[0]["fingerprint"] == fingerprint:
+        meta, histograms = cached
+        if meta["count"] == len(points):
+            logging.getLogger().info("Using cached normalization map")
+            return normalization_from_histograms(histograms)
+        elif appendable and meta["count"] < len(points):
+            logging.getLogger().info("Adding %d new points to the cached "
+                                     "normalization map" %
+                                     (len(points) - meta["count"]))
+            histograms += frame_histograms(
+                drawn(points.select(slice(meta["count"], None))), camera,
+                args.minutes_step, **histogram_kwargs)
+        else:
+            histograms = None
+
+    if histograms is None:
+        histograms = frame_histograms(None if cube is not None
+                                      else drawn(points), camera,
+                                      args.minutes_step, cube=cube,
+                                      **histogram_kwargs)
+
+    cache.save(key, {"fingerprint": fingerprint, "count": len(points)},
+               histograms)
+    return normalization_from_histograms(histograms)
+
+def render_time_range(args, indexed_times, bounds=None, calc_norm_map=False,
+                      do_map_normalization=False, norm_map=None, sink=None):
+    """Make the frames for a real range of times, see
+    ``make_time_range_sequence``.  ``indexed_times`` is a list of
+    ``(frame index, time)`` in time order.  Returns the sum of the frames
+    if ``calc_norm_map`` is True, otherwise None"""
+
+    camera = cameras[args.region]
+    max_opacity = camera.get("max_opacity", 0.8)
+    opacity_thresh = camera.get("opacity_thresh", 0.1)
+    color_lut = build_color_lut(opacity_thresh=opacity_thresh,
+                                max_opacity=max_opacity)
+    density = DENSITY_BACKENDS[args.density]()
+    rgba_buffer = None
+    frame_sum = None
+
+    background = get_map_background(camera,
+                                    cache_dir=args.background_cache_dir)
+    m = background.basemap
+    bins = (500, int((9./16.)*500))
+    hist_range = ((m.llcrnrx, m.urcrnrx), (m.llcrnry, m.urcrnry))
+
+    canvas = None
+    own_sink = False
+    if not calc_norm_map:
+        canvas = FrameCanvas(background, [m.llcrnrx, m.urcrnrx,
+                                          m.llcrnry, m.urcrnry],
+                             indexed_times[0][1], show_date=True)
+        if sink is None:
+            sink = open_frame_sink(args, background.image.shape)
+            own_sink = True
+
+    # Read from far enough before the first frame to fill its window
+    window = datetime.timedelta(hours=args.window_hours)
+    chunk_start = indexed_times[0][1] - window
+    chunks = iter_point_chunks(chunk_start, indexed_times[-1][1],
+                               bounds=bounds, chunk_size=args.chunk_size)
+    points = SlidingWindow(chunks, window.total_seconds(), m)
+
+    for frame_index, target_time in indexed_times:
+        seconds = (target_time - chunk_start).total_seconds()
+        xpoints, ypoints, t = points.advance(seconds)
+        weights = np.exp(-(seconds - t)/3600.)
+        histogram = np.histogram2d(xpoints, ypoints, range=hist_range,
+                                   bins=bins, weights=weights)
+
+        file_prefix = os.path.join(args.data_dir, args.region +
+                                   target_time.strftime("%Y%m%d%H%M"))
+        with TimedLogger("Generating frame with prefix %s" % file_prefix,
+                         logging.getLogger()):
+            frame = make_single_map(target_time, camera, None, None, None,
+                        gauss_sigma=args.gauss_sigma,
+                        file_prefix=file_prefix,
+                        opacity_thresh=opacity_thresh,
+                        max_opacity=max_opacity,
+                        calc_norm_map=calc_norm_map,
+                        do_map_normalization=do_map_normalization,
+                        norm_map=norm_map, color_lut=color_lut,
+                        rgba_buffer=rgba_buffer,
+                        background_cache_dir=args.background_cache_dir,
+                        histogram=histogram, canvas=canvas, sink=sink,
+                        frame_index=frame_index, density=density)
+
+        if calc_norm_map:
+            if frame_sum is None:
+                frame_sum = frame
+            else:
+                frame_sum = np.add(frame_sum, frame)
+        else:
+            rgba_buffer = frame
+
+    if own_sink:
+        sink.close()
+    return frame_sum
+
+def _render_time_range_task(indexed_times, arrays, context):
+    """Worker process entry point used by ``make_time_range_sequence``"""
+    args, bounds, calc_norm_map, do_map_normalization, shape = context
+    sink = None
+    if not calc_norm_map:
+        sink = open_frame_sink(args, shape, streaming=False)
+    frame_sum = render_time_range(args, indexed_times, bounds=bounds,
+                                  calc_norm_map=calc_norm_map,
+                                  do_map_normalization=do_map_normalization,
+                                  norm_map=arrays.get("norm_map"), sink=sink)
+    if sink is not None:
+        sink.close()
+    return frame_sum
+
+def make_time_range_sequence(args, bounds=None, calc_norm_map=False,
+                             do_map_normalization=False, norm_map=None):
+    """Like ``make_map_sequence``, but with a frame every
+    ``args.minutes_step`` minutes from ``args.start`` to ``args.end``.
+
+    Each frame weights the photos taken in the ``args.window_hours`` before
+    it by how long before it they were taken.  Photos are streamed from
+    MongoDB in time order, ``args.chunk_size`` at a time, so memory use
+    doesn't grow with the length of the range.  With several workers, each
+    streams its own contiguous part of the range.
+    """
+
+    target_times = range_frame_times(args.start, args.end, args.minutes_step)
+    indexed_times = list(enumerate(target_times))
+
+    background = get_map_background(cameras[args.region],
+                                    cache_dir=args.background_cache_dir)
+    shape = background.image.shape[:2]
+
+    parallel = args.workers > 1
+    stack_path, video_path = frame_output_paths(args)
+    use_stack = not calc_norm_map and (args.output == "stack" or
+                                       (args.output == "video" and parallel))
+    if use_stack:
+        RawStackSink(stack_path, len(target_times), shape).close()
+
+    if parallel:
+        arrays = {} if norm_map is None else {"norm_map": norm_map}
+        frame_sums = run_parallel(_render_time_range_task,
+                        split_into_chunks(indexed_times, args.workers),
+                        args.workers, arrays,
+                        context=(args, bounds, calc_norm_map,
+                                 do_map_normalization, shape))
+    else:
+        frame_sums = [render_time_range(args, indexed_times, bounds=bounds,
+                                    calc_norm_map=calc_norm_map,
+                                    do_map_normalization=do_map_normalization,
+                                    norm_map=norm_map)]
+
+    if use_stack and args.output == "video":
+        with TimedLogger("Encoding %s" % video_path, logging.getLogger()):
+            encode_stack(stack_path, encoder_command(video_path, shape[1],
+                                                     shape[0], fps=args.fps,
+                                                     template=args.encoder))
+        os.remove(stack_path)
+
+    if calc_norm_map:
+        frame_sums = [frame_sum for frame_sum in frame_sums
+                      if frame_sum is not None]
+        return np.sum(frame_sums, axis=0) if frame_sums else None
+
+def render_region_time_range(args, bounds=None):
+    """Write the frames of ``make_time_range_sequence`` for ``args.region``
+    into ``args.data_dir``, normalizing them if ``args.normalize_map`` is
+    set.  The normalization needs a second pass over the range"""
+
+    normalization_map = None
+    if args.normalize_map:
+        with TimedLogger("Making normalization map", logging.getLogger()):
+            normalization_map = make_time_range_sequence(args, bounds=bounds,
+                                                         calc_norm_map=True)
+
+    with TimedLogger("Writing movie frames", logging.getLogger()):
+        make_time_range_sequence(args, bounds=bounds,
+                                 do_map_normalization=args.normalize_map,
+                                 norm_map=normalization_map)
+
+def run_live(args, bounds=None):
+    """Keep the heatmap of ``args.region`` up to date with the photos
+    inside ``bounds`` as they are collected, redrawing it every
+    ``args.poll_seconds`` to ``args.data_dir``/REGION_live.png.  Starts
+    from the photos of the last ``args.window_hours``, and runs until
+    interrupted"""
+
+    camera = cameras[args.region]
+    max_opacity = camera.get("max_opacity", 0.8)
+    opacity_thresh = camera.get("opacity_thresh", 0.1)
+    color_lut = build_color_lut(opacity_thresh=opacity_thresh,
+                                max_opacity=max_opacity)
+    density = DENSITY_BACKENDS[args.density]()
+    rgba_buffer = None
+
+    background = get_map_background(camera,
+                                    cache_dir=args.background_cache_dir)
+    m = background.basemap
+    now = datetime.datetime.utcnow()
+    heatmap = LiveHeatmap(m, (m.llcrnrx, m.urcrnrx), (m.llcrnry, m.urcrnry),
+                          (500, int((9./16.)*500)), now, decay_hours=1)
+    poller = NewPhotoPoller(bounds=bounds)
+    canvas = FrameCanvas(background, [m.llcrnrx, m.urcrnrx,
+                                      m.llcrnry, m.urcrnry],
+                         now, show_date=True)
+    file_prefix = os.path.join(args.data_dir, args.region + "_live")
+    sink = LatestPngSink(file_prefix + ".png")
+    window = datetime.timedelta(hours=args.window_hours)
+
+    while True:
+        tick_start = time.time()
+        now = datetime.datetime.utcnow()
+        with TimedLogger("Updating live map", logging.getLogger()):
+            heatmap.advance(now)
+            lat, lon, created_times = poller.poll(now - window)
+            heatmap.add(lat, lon, created_times)
+            rgba_buffer = make_single_map(now, camera, None, None, None,
+                            gauss_sigma=args.gauss_sigma,
+                            file_prefix=file_prefix,
+                            opacity_thresh=opacity_thresh,
+                            max_opacity=max_opacity, color_lut=color_lut,
+                            rgba_buffer=rgba_buffer,
+                            background_cache_dir=args.background_cache_dir,
+                            histogram=heatmap.histogram(), canvas=canvas,
+                            sink=sink, density=density)
+        logging.getLogger().info("Added %d new photos, up to %s" %
+                                 (len(lat), poller.high_water))
+        time.sleep(max(0, args.poll_seconds - (time.time() - tick_start)))
+
+def region_bounds(args, region):
+    """Box of the points that can appear in ``region``, once blurred, or
+    None if every point should be loaded"""
+    if args.no_viewport_filter:
+        return None
+    margin_bins = DENSITY_BACKENDS[args.density]().support(args.gauss_sigma)
+    return camera_bounds(get_map_background(cameras[region],
+                         cache_dir=args.background_cache_dir).basemap,
+                         margin_bins=margin_bins)
+
+def load_points(args, regions, bounds):
+    """Load the points inside ``bounds`` (or all of them, if it is None) for
+    drawing ``regions``, either from the snapshot or by aggregating them in
+    MongoDB"""
+    logging.getLogger().info("Loading points inside %s" % bounds)
+
+    if args.aggregate_in_db:
+        with TimedLogger("Aggregating points in MongoDB", logging.getLogger()):
+            return aggregate_points(grid=args.aggregate_grid,
+                                    query=points_query(bounds))
+
+    snapshot_dir = os.path.join(args.data_dir, "snapshot")
+    if bounds is not None:
+        snapshot_dir += "_" + "_".join(regions)
+    with TimedLogger("Syncing snapshot with MongoDB", logging.getLogger()):
+        sync_snapshot(snapshot_dir, rebuild=args.rebuild_snapshot,
+                      bounds=bounds)
+    return load_snapshot(snapshot_dir)
+
+def render_region(args, full_results, binned_times=None, bounds=None):
+    """Write the movie frames for ``args.region`` into ``args.data_dir``,
+    from the points in ``full_results`` that are inside ``bounds``.
+    ``binned_times`` is passed on to ``build_histogram_cube``"""
+
+    camera = cameras[args.region]
+    logging.getLogger().info("Setting region=%s" % args.region)
+    logging.getLogger().info("Setting max_opacity=%f" %
+                             camera.get("max_opacity", 0.8))
+    logging.getLogger().info("Setting opacity_thresh=%f" %
+                             camera.get("opacity_thresh", 0.1))
+
+    # Drop the points outside this region before projecting them
+    points = full_results
+    if bounds is not None:
+        mask = bounds_mask(bounds, points.lat, points.lon)
+        if not mask.all():
+            points = points.select(mask)
+            if binned_times is not None:
+                binned_times = tuple(a[mask] for a in binned_times)
+
+    if args.resolution is not None:
+        with TimedLogger("Writing movie frames", logging.getLogger()):
+            make_high_resolution_sequence(args, points)
+        return
+
+    cube = None
+    if use_histogram_cube(args):
+        with TimedLogger("Binning points by time of day", logging.getLogger()):
+            cube = build_histogram_cube(points, camera,
+                            minutes_step=args.minutes_step, decay_hours=1,
+                            background_cache_dir=args.background_cache_dir,
+                            binned_times=binned_times)
+
+    # If normalize_map is set then sum the histograms of every frame, or
+    # bring the cached sum up to date, for normalization purposes
+    if args.normalize_map:
+        with TimedLogger("Making normalization map", logging.getLogger()):
+            normalization_map = cached_normalization_map(args, full_results,
+                                                         bounds=bounds,
+                                                         cube=cube)
+
+    # Write movie frames
+    with TimedLogger("Writing movie frames", logging.getLogger()):
+        if args.normalize_map:
+            make_map_sequence(args, points, do_map_normalization=True,
+                aggregate_norm_frame=normalization_map, cube=cube)
+        else:
+            make_map_sequence(args, points, cube=cube)
+
+def write_tile_pyramids(args, points):
+    """Write the heatmap at each frame time of the day as a Web Mercator tile
+    pyramid, from zoom ``args.min_zoom`` to ``args.max_zoom``, in
+    ``args.data_dir``/tiles/HHMM.  Tiles that are unchanged since the last
+    run are left alone (see ``tiles.TileWriter``).
+
+    Tiles are logged and smoothed with ``args.density`` and
+    ``args.gauss_sigma``, as frames are, and each zoom level is divided by
+    the log of its heaviest bin over the whole day, so that every level and
+    time slot is drawn on the same colour scale.  Each tile is smoothed on
+    its own, so nothing is spread across tile edges."""
+
+    camera = cameras[args.region]
+    color_lut = build_color_lut(
+        opacity_thresh=camera.get("opacity_thresh", 0.1),
+        max_opacity=camera.get("max_opacity", 0.8))
+    density = DENSITY_BACKENDS[args.density]()
+
+    lat, lon, minutes = point_arrays(points)
+    with TimedLogger("Sorting points into tiles", logging.getLogger()):
+        pyramid = TilePyramid(lat, lon, max_zoom=args.max_zoom,
+                              min_zoom=args.min_zoom)
+    minutes = minutes[pyramid.order]
+    counts = point_counts(points)
+    if counts is not None:
+        counts = counts[pyramid.order]
+
+    def slot_weights(target_time):
+        weights = decay_weights(minutes, target_time, decay_hours=1)
+        if counts is not None:
+            weights *= counts
+        return weights
+
+    zoom_max = {}
+
+    def track_max(zoom, x, y, tile):
+        zoom_max[zoom] = max(zoom_max.get(zoom, 0), tile.max())
+
+    with TimedLogger("Finding the heaviest bin of each zoom level",
+                     logging.getLogger()):
+        for target_time in frame_times(args.minutes_step):
+            pyramid.render(slot_weights(target_time), track_max)
+
+    def colorize(zoom, tile):
+        im = density.smooth(np.log(tile + 1), args.gauss_sigma)
+        return fix_opacity_and_color_map(im/np.log(zoom_max[zoom] + 1),
+                                         lut=color_lut)
+
+    for target_time in frame_times(args.minutes_step):
+        slot = target_time.strftime("%H%M")
+        writer = TileWriter(os.path.join(args.data_dir, "tiles", slot),
+                            colorize)
+        with TimedLogger("Writing tiles for %s" % slot, logging.getLogger()):
+            pyramid.render(slot_weights(target_time), writer)
+            writer.close()
+        logging.getLogger().info("Wrote %d of %d tiles for %s" %
+                                 (writer.num_written, len(writer.hashes),
+                                  slot))
+
+def _render_region_task(region, arrays, context):
+    """Render one region for ``render_regions``, from its share of the
+    points in ``arrays``"""
+
+    args, snapshot_id = context
+    region_args = copy.copy(args)
+    region_args.region = region
+    region_args.data_dir = os.path.join(args.data_dir, region)
+    region_args.workers = 1
+    if not os.path.exists(region_args.data_dir):
+        os.makedirs(region_args.data_dir)
+
+    points = PointDataset(arrays["lat"], arrays["lon"], arrays["minutes"],
+                          arrays["offset"], count=arrays.get("count"))
+    points.snapshot_id = snapshot_id
+    binned_times = None
+    if "timebins" in arrays:
+        binned_times = (arrays["timebins"], arrays["time_weights"])
+
+    with TimedLogger("Rendering region %s" % region, logging.getLogger()):
+        render_region(region_args, points, binned_times=binned_times,
+                      bounds=region_bounds(args, region))
+
+def render_regions(args, regions, full_results):
+    """Write the movie frames for each of ``regions`` into a subdirectory of
+    ``args.data_dir`` named after it, from a single set of points.
+
+    The time bins and weights of the points are worked out once and shared.
+    Up to ``args.workers`` regions are rendered at the same time, each in
+    its own process, with the points shared as in ``run_parallel``.
+    """
+
+    arrays = {"lat": full_results.lat, "lon": full_results.lon,
+              "minutes": full_results.minutes,
+              "offset": full_results.offset}
+    if point_counts(full_results) is not None:
+        arrays["count"] = point_counts(full_results)
+    if use_histogram_cube(args):
+        with TimedLogger("Binning point times", logging.getLogger()):
+            arrays["timebins"], arrays["time_weights"] = bin_times(
+                full_results.minutes, frame_bin_minutes(args.minutes_step),
+                decay_hours=1, counts=point_counts(full_results))
+
+    # Draw every map before any workers start, so that they all inherit them
+    for region in regions:
+        get_map_background(cameras[region],
+                           cache_dir=args.background_cache_dir)
+
+    workers = min(args.workers, len(regions))
+    if workers > 1:
+        run_parallel(_render_region_task, regions, workers, arrays,
+                     context=(args, full_results.snapshot_id))
+    else:
+        for region in regions:
+            _render_region_task(region, arrays,
+                                (args, full_results.snapshot_id))
+
 if __name__ == "__main__":
     """If run directly from the command line, parse arguments and write
     movie frames"""
@@ -206,6 +1118,32 @@ if __name__ == "__main__":
     parser.add_argument('--region', type=ValidRegions, default="World",
                    help='Select which of the configs in config.py to use, by '
                    'dictionary key.  Allowed values : \n%s' % cameras.keys())
+    parser.add_argument('--regions', type=ValidRegionsOrAll, nargs='+',
+                   default=None,
+                   help='Render each of these regions (or "all" of them) '
+                   'into its own subdirectory of data_dir, loading the points '
+                   'only once.  Overrides --region')
+    parser.add_argument('--start', type=parse_time, default=None,
+                   help='If given, along with --end, then make a movie over '
+                   'the real times from start to end (UTC, as YYYY-MM-DD or '
+                   'YYYY-MM-DDTHH:MM), rather than over a single day with '
+                   'every photo folded onto it by time of day')
+    parser.add_argument('--end', type=parse_time, default=None,
+                   help='Time of the last frame of a --start movie')
+    parser.add_argument('--window_hours', type=float, default=8,
+                   help='Photos taken up to this long before a frame of a '
+                   '--start movie are drawn in it, and a --live map starts '
+                   'from the photos taken this long before it starts')
+    parser.add_argument('--live', action="count",
+                   help='If present, then keep a map of the most recent '
+                   'photos in memory and, until interrupted, add newly '
+                   'collected photos to it and redraw it to '
+                   'data_dir/REGION_live.png every poll_seconds')
+    parser.add_argument('--poll_seconds', type=float, default=60,
+                   help='Seconds between updates of a --live map')
+    parser.add_argument('--chunk_size', type=int, default=10000,
+                   help='Number of photos to read from MongoDB at a time '
+                   'for a --start movie')
     parser.add_argument('--add_timezones', action="count",
                    help='If present then add timezone offsets to any DB '
                    'elements that are missing them')
@@ -213,48 +1151,158 @@ if __name__ == "__main__":
                    help='Path to store output images')
     parser.add_argument('--logfile', type=str, default="instagram_map.log",
                    help='Name of logfile')
+    parser.add_argument('--background_cache_dir', type=str, default=None,
+                   help='If set, save rasterized map backgrounds to this '
+                   'directory and reuse them on later runs')
+    parser.add_argument('--rebuild_snapshot', action="count",
+                   help='If present, then rebuild the local snapshot of the '
+                   'points in data_dir from scratch, rather than only adding '
+                   'points newer than it')
+    parser.add_argument('--add_locations', action="count",
+                   help='If present then add the GeoJSON location used to '
+                   'select the points inside a region to any DB elements '
+                   'that are missing it')
+    parser.add_argument('--no_viewport_filter', action="count",
+                   help='If present, then load every point rather than only '
+                   'those that can appear in the region')
+    parser.add_argument('--aggregate_in_db', action="count",
+                   help='If present, then have MongoDB count the points in '
+                   'each cell of a latitude/longitude grid for each minute of '
+                   'the day, and draw those counts, rather than downloading '
+                   'every point.  The local snapshot is not used')
+    parser.add_argument('--aggregate_grid', type=float, default=AGGREGATE_GRID,
+                   help='Size in degrees of the grid cells used by '
+                   'aggregate_in_db')
+    parser.add_argument('--output', choices=("png", "stack", "video"),
+                   default="png",
+                   help='Write each frame as a PNG, all of the frames to one '
+                   'memory-mapped REGION_frames.npy stack of RGBA pixels, or '
+                   'a REGION.mp4 video piped through the encoder')
+    parser.add_argument('--resolution', type=parse_resolution, default=None,
+                   help='If given, as WIDTHxHEIGHT (e.g. 3840x2160), then '
+                   'draw frames of this many pixels, with the heatmap grid '
+                   'scaled to match, accumulating and colorizing the '
+                   'heatmap in float32 and in place to keep memory down')
+    parser.add_argument('--pixels_per_bin', type=float,
+                   default=DEFAULT_PIXELS_PER_BIN,
+                   help='Size of a heatmap bin in pixels, with --resolution')
+    parser.add_argument('--tiles', action="count",
+                   help='If present, then write the heatmap for each frame '
+                   'time as a z/x/y tile pyramid in data_dir/tiles/HHMM, '
+                   'to be served by serve_tiles.py, instead of movie frames')
+    parser.add_argument('--min_zoom', type=int, default=0,
+                   help='Lowest zoom level of the tile pyramid')
+    parser.add_argument('--max_zoom', type=int, default=7,
+                   help='Highest zoom level of the tile pyramid.  Its '
+                   'points are binned at this level and every other level '
+                   'is built by downsampling it')
+    parser.add_argument('--fps', type=float, default=24,
+                   help='Frame rate of the video output')
+    parser.add_argument('--encoder', type=str, default=DEFAULT_ENCODER,
+                   help='Shell command that reads raw RGBA video on its '
+                   'standard input, with {width}, {height}, {fps} and '
+                   '{output} filled in')
+    parser.add_argument('--workers', type=int, default=1,
+                   help='Number of processes to render frames with')
+    parser.add_argument('--density', choices=sorted(DENSITY_BACKENDS),
+                   default="gaussian_filter",
+                   help='How to smooth the heatmap: gaussian_filter, fft '
+                   '(quickest for wide blurs), separable (float32, in '
+                   'place) or adaptive (narrower in dense areas, wider in '
+                   'sparse ones)')
+    parser.add_argument('--gauss_sigma', type=float, default=1,
+                   help='Width of the heatmap blur, in heatmap bins')
+    parser.add_argument('--no_histogram_cube', action="count",
+                   help='If present, then weight and histogram every point '
+                   'for every frame, rather than binning them all once by time '
+                   'of day.  Slower, but the time-binned cube needs '
+                   '8*nbins bytes for each of the 1440/gcd(minutes_step, 1440) '
+                   'time bins')
+    parser.add_argument('--max_cube_mb', type=float, default=1024,
+                   help='Largest time-binned cube to build, in megabytes.  '
+                   'If the cube for minutes_step would be larger, then every '
+                   'point is weighted and histogrammed for every frame, as '
+                   'with no_histogram_cube')
+    parser.add_argument('--norm_cache_dir', type=str, default=None,
+                   help='Where to keep the frame histograms behind '
+                   'normalize_map between runs.  Defaults to data_dir')
     parser.add_argument('--normalize_map', action="count",
                    help='If present, then generate the map twice, and '
                    'use the maximum values for each pixel generated in the '
                    'normalized map to rescale the output on the second run '
                    'through')
+    parser.add_argument('--profile', choices=profiling.TRACE_FORMATS,
+                   default=None,
+                   help='If given, then write timing spans and counters as '
+                   'JSON lines or a Chrome trace next to the logfile')
+    parser.add_argument('--profile_memory_interval', type=float, default=0.1,
+                   help='Seconds between samples of memory use when '
+                   'profiling, or 0 to not sample')
 
     args = parser.parse_args()
+    if (args.start is None) != (args.end is None):
+        parser.error("--start and --end must be given together")
+    if args.tiles and (args.start is not None or args.regions is not None):
+        parser.error("--tiles can't be used with --start or --regions")
+    if args.resolution is not None and args.start is not None:
+        parser.error("--resolution can't be used with --start")
+    if args.live and (args.start is not None or args.regions is not None or
+                      args.tiles or args.resolution is not None or
+                      args.normalize_map):
+        parser.error("--live can't be used with --start, --regions, "
+                     "--tiles, --resolution or --normalize_map")
 
     logging.basicConfig(filename=os.path.join(args.data_dir, args.logfile),
                         level=logging.DEBUG)
     logging.basicConfig(format='%(asctime)s %(message)s')
 
-    # Generate up optional values from the config:
-    max_opacity = cameras[args.region].get("max_opacity", 0.8)
-    opacity_thresh = cameras[args.region].get("opacity_thresh", 0.1)
-
-    logging.getLogger().info("Setting region=%s" % args.region)
-    logging.getLogger().info("Setting max_opacity=%f" % max_opacity)
-    logging.getLogger().info("Setting opacity_thresh=%f" % opacity_thresh)
+    if args.profile:
+        profiling.enable(
+            profiling.trace_path(os.path.join(args.data_dir, args.logfile),
+                                 args.profile),
+            trace_format=args.profile,
+            memory_interval=args.profile_memory_interval)
 
     if args.add_timezones:
         with TimedLogger("Adding missing timezone info", logging.getLogger()):
             add_timezone_info()
 
-    with TimedLogger("Reading full dataset from MongoDB", logging.getLogger()):
-        full_results = read_results_from_mongo()
+    if args.add_locations:
+        with TimedLogger("Adding missing locations", logging.getLogger()):
+            add_geojson_locations()
 
-    # If normalize_map is set then do a first run through an generate an
-    # integrated map for normalization purposes
-    full_norm_frame = None
-    if args.normalize_map:
-        with TimedLogger("Making normalization map", logging.getLogger()):
-            normalization_map = make_map_sequence(args, full_results,
-                            calc_norm_map=True,
-                            aggregate_norm_frame=full_norm_frame)
+    if args.regions is None:
+        regions = [args.region]
+    elif "all" in args.regions:
+        regions = sorted(cameras.keys())
+    else:
+        regions = args.regions
 
-    # Write movie frames
-    with TimedLogger("Writing movie frames", logging.getLogger()):
-        if args.normalize_map:
-            make_map_sequence(args, full_results, do_map_normalization=True,
-                aggregate_norm_frame=normalization_map)
+    if args.live:
+        run_live(args, bounds=region_bounds(args, args.region))
+    elif args.tiles:
+        # Tiles cover the whole globe, whatever the region
+        write_tile_pyramids(args, load_points(args, regions, None))
+    elif args.start is not None:
+        # Streamed from MongoDB, one region at a time
+        for region in regions:
+            region_args = copy.copy(args)
+            region_args.region = region
+            if args.regions is not None:
+                region_args.data_dir = os.path.join(args.data_dir, region)
+                if not os.path.exists(region_args.data_dir):
+                    os.makedirs(region_args.data_dir)
+            render_region_time_range(region_args,
+                                     bounds=region_bounds(args, region))
+    else:
+        bounds = union_bounds([region_bounds(args, region)
+                               for region in regions])
+        full_results = load_points(args, regions, bounds)
+
+        if args.regions is None:
+            render_region(args, full_results, bounds=bounds)
         else:
-            make_map_sequence(args, full_results)
+            render_regions(args, regions, full_results)
 
+    profiling.disable()
     logging.getLogger().info("instagram_map_visualize is COMPLETE")
@@ -0,0 +1,124 @@
+"""Live heatmap of the most recent photos, for a wall display.
+
+Rather than re-reading everything each time, ``LiveHeatmap`` keeps the
+weighted histogram of every photo seen so far in memory.  Because the
+weights decay exponentially, moving the map on to a later time is one
+multiply of the whole grid, and new photos are simply added with their
+weight at that time.  ``NewPhotoPoller`` fetches the photos saved since the
+last poll through the ``saved_time`` index.  The work per tick depends on
+the grid size and on the number of new photos, not on the size of the
+collection.
+
+Photos can be saved long after they were taken, since the collector pages
+back through the photos of each tag, so polls go by ``saved_time`` rather
+than ``created_time``.  As in ``snapshot.sync_snapshot``, each poll reads
+back ``SAVED_LOOKBACK`` before the newest ``saved_time`` already seen, in
+case saves land out of order, and drops the photos it has already returned.
+"""
+import numpy as np
+import pymongo
+
+from extract_data import get_cursors
+from seen_ids import RecentIds
+from snapshot import SAVED_LOOKBACK
+from viewport import points_query
+
+
+class LiveHeatmap(object):
+    """Weighted 2d histogram of photos, with weights exp(-age/decay_hours)
+    as of ``time``
+
+    :project:  Function mapping ``(lon, lat)`` arrays to map ``(x, y)``
+    :xrange, yrange, bins:  As for ``np.histogram2d``
+    """
+
+    def __init__(self, project, xrange, yrange, bins, time, decay_hours=1):
+        self.project = project
+        self.range = (xrange, yrange)
+        self.bins = bins
+        self.time = time
+        self.decay_hours = decay_hours
+        self.grid, self.xedges, self.yedges = np.histogram2d(
+            [], [], bins=bins, range=self.range)
+
+    def histogram(self):
+        """``(im, xedges, yedges)`` as ``make_single_map`` takes it"""
+        return self.grid, self.xedges, self.yedges
+
+    def advance(self, time):
+        """Decay the weights to ``time``, if it is later than the map's"""
+        hours = (time - self.time).total_seconds()/3600.
+        if hours > 0:
+            self.grid *= np.exp(-hours/self.decay_hours)
+            self.time = time
+
+    def add(self, lat, lon, created_times):
+        """Add photos taken at the datetimes ``created_times``.  Photos
+        from after the map's time count in full"""
+        if len(lat) == 0:
+            return
+        hours = np.array([(self.time - created_time).total_seconds()
+                          for created_time in created_times])/3600.
+        weights = np.exp(-np.maximum(hours, 0)/self.decay_hours)
+        x, y = self.project(np.asarray(lon), np.asarray(lat))
+        im, _, _ = np.histogram2d(x, y, bins=self.bins, range=self.range,
+                                  weights=weights)
+        self.grid += im
+
+
+class NewPhotoPoller(object):
+    """Reads the photos inside ``bounds`` that it has not returned before
+
+    :seen_size:  Number of ids to remember, which must cover every photo
+        saved in ``SAVED_LOOKBACK``
+    """
+
+    def __init__(self, ig_mongo=None, bounds=None, seen_size=100000):
+        if ig_mongo is None:
+            ig_mongo, _ = get_cursors()
+        ig_mongo.ensure_index("created_time")
+        ig_mongo.ensure_index("saved_time")
+        self.ig_mongo = ig_mongo
+        self.bounds = bounds
+        self.seen = RecentIds(seen_size)
+        self.polled = False
+        self.high_water = None
+
+    def latest_saved_time(self):
+        """The newest ``saved_time`` in the collection, or None"""
+        cursor = self.ig_mongo.find({"saved_time": {"$exists": True}},
+                                    fields={"saved_time": True})
+        for res in cursor.sort("saved_time", pymongo.DESCENDING).limit(1):
+            return res["saved_time"]
+        return None
+
+    def poll(self, since):
+        """Return ``(lat, lon, created_times)`` of the new photos taken from
+        ``since`` on.  The first poll reads every one of them, and later
+        polls those saved since"""
+        query = points_query(self.bounds)
+        query["created_time"] = {"$gte": since}
+        if not self.polled:
+            # Anything saved after this is left to the next poll
+            self.high_water = self.latest_saved_time()
+            self.polled = True
+        elif self.high_water is None:
+            query["saved_time"] = {"$exists": True}
+        else:
+            query["saved_time"] = {"$gte": self.high_water - SAVED_LOOKBACK}
+        cursor = self.ig_mongo.find(query, fields={"_id": True,
+                                                   "latitude": True,
+                                                   "longitude": True,
+                                                   "created_time": True,
+                                                   "saved_time": True})
+        cursor.sort("saved_time", pymongo.ASCENDING)
+
+        new = self.seen.add_new(cursor)
+        for res in new:
+            saved_time = res.get("saved_time")
+            if saved_time is not None and (self.high_water is None or
+                                           saved_time > self.high_water):
+                self.high_water = saved_time
+        return (np.array([res["latitude"] for res in new]),
+                np.array([res["longitude"] for res in new]),
+                [res["created_time"] for res in new])
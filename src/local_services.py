@@ -0,0 +1,334 @@
+"""Stand-ins for MongoDB and geonames, for running the pipeline offline.
+
+``MemoryCollection`` holds documents in memory and answers the queries,
+projections, cursor methods and bulk updates that the collector, the
+visualizer and the timezone backfill send to the ``ig`` collection.
+``LocalGeonamesServer`` is a web server on localhost that answers
+``timezoneJSON`` requests, so that ``GeonamesClient`` is exercised as it is
+against geonames, connection pool and all.  It can also be told to answer
+badly for chosen latitudes, for testing the client's error handling.
+
+    collection = MemoryCollection(benchmarks.synthetic_documents(100000))
+    server = LocalGeonamesServer(latency=0.02)
+    geo = TimezoneCache(GeonamesClient("local", base_url=server.base_url,
+                                       hourly_limit=None, daily_limit=None))
+    add_timezone_info(ig_mongo=collection, geo=geo)
+    server.close()
+
+Both are only as faithful as the benchmarks need: ``MemoryCollection``
+scans every document for each query, except for lookups by ``_id``.
+"""
+import json
+import urlparse
+import threading
+import collections
+import BaseHTTPServer
+import SocketServer
+import time
+import pymongo
+from pymongo.errors import DuplicateKeyError
+
+_MISSING = object()
+
+# Ways that ``LocalGeonamesServer`` can answer badly
+SLOW = "slow"
+SERVER_ERROR = "server_error"
+BAD_JSON = "bad_json"
+ERROR_STATUS = "error_status"
+DROP_CONNECTION = "drop_connection"
+
+
+def _compare(op, value, arg):
+    if op == "$exists":
+        return (value is not _MISSING) == bool(arg)
+    if op == "$in":
+        return value is not _MISSING and value in arg
+    if op == "$nin":
+        return value is _MISSING or value not in arg
+    if value is _MISSING:
+        return False
+    if op == "$gt":
+        return value > arg
+    if op == "$gte":
+        return value >= arg
+    if op == "$lt":
+        return value < arg
+    if op == "$lte":
+        return value <= arg
+    raise NotImplementedError("MemoryCollection doesn't support %s" % op)
+
+
+def matches(document, query):
+    """Whether ``document`` matches the MongoDB ``query``"""
+    for key, condition in (query or {}).items():
+        value = document.get(key, _MISSING)
+        if isinstance(condition, dict) and condition and all(
+                op.startswith("$") for op in condition):
+            if not all(_compare(op, value, arg)
+                       for op, arg in condition.items()):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def project(document, fields):
+    """Copy of ``document`` with only the ``fields`` that are True, and
+    ``_id`` unless it is False, as a MongoDB projection gives"""
+    if not fields:
+        return dict(document)
+    projected = dict((key, document[key]) for key, value in fields.items()
+                     if value and key in document)
+    if fields.get("_id", True):
+        projected["_id"] = document["_id"]
+    return projected
+
+
+class MemoryCursor(list):
+    """The results of ``MemoryCollection.find``, with the cursor methods
+    that are used on them.  As in MongoDB, they can be sorted on fields
+    that the projection ``fields`` leaves out"""
+
+    def __init__(self, documents=(), fields=None):
+        self.documents = list(documents)
+        list.__init__(self, (project(document, fields)
+                             for document in self.documents))
+
+    def batch_size(self, size):
+        return self
+
+    def sort(self, key, direction=pymongo.ASCENDING):
+        order = sorted(range(len(self)),
+                       key=lambda n: self.documents[n].get(key),
+                       reverse=direction == pymongo.DESCENDING)
+        self[:] = [self[n] for n in order]
+        self.documents = [self.documents[n] for n in order]
+        return self
+
+    def limit(self, size):
+        if size:
+            del self[size:]
+            del self.documents[size:]
+        return self
+
+
+class MemoryBulkOperation(object):
+
+    def __init__(self, bulk, query):
+        self.bulk = bulk
+        self.query = query
+        self.is_upsert = False
+
+    def upsert(self):
+        self.is_upsert = True
+        return self
+
+    def update(self, update):
+        self.bulk.operations.append((self.query, update, self.is_upsert))
+
+
+class MemoryBulk(object):
+    """Unordered bulk operation on a ``MemoryCollection``"""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.operations = []
+
+    def find(self, query):
+        return MemoryBulkOperation(self, query)
+
+    def execute(self):
+        result = {"nMatched": 0, "nModified": 0, "nUpserted": 0}
+        for query, update, upsert in self.operations:
+            for key, value in self.collection.update(
+                    query, update, upsert=upsert).items():
+                result[key] += value
+        self.operations = []
+        return result
+
+
+class MemoryCollection(object):
+    """Documents held in memory, in insertion order, behind the parts of
+    ``pymongo``'s collection API that this project uses.  Queries can test
+    for equality and use ``$gt``, ``$gte``, ``$lt``, ``$lte``, ``$in``,
+    ``$nin`` and ``$exists``; updates can use ``$set`` and
+    ``$setOnInsert``."""
+
+    def __init__(self, documents=()):
+        self.documents = collections.OrderedDict()
+        self.insert(documents)
+
+    def count(self):
+        return len(self.documents)
+
+    def drop(self):
+        self.documents.clear()
+
+    def ensure_index(self, *args, **kwargs):
+        pass
+
+    def insert(self, documents):
+        if isinstance(documents, dict):
+            documents = [documents]
+        for document in documents:
+            if document["_id"] in self.documents:
+                raise DuplicateKeyError("Duplicate _id %r" %
+                                        (document["_id"],))
+            self.documents[document["_id"]] = dict(document)
+
+    def candidates(self, query):
+        """Documents that might match ``query``, which is only every
+        document when the query doesn't pick out ``_id``s"""
+        ids = (query or {}).get("_id", _MISSING)
+        if ids is _MISSING:
+            return self.documents.values()
+        if isinstance(ids, dict) and ids.keys() == ["$in"]:
+            ids = ids["$in"]
+        elif isinstance(ids, dict):
+            return self.documents.values()
+        else:
+            ids = [ids]
+        return [self.documents[_id] for _id in ids if _id in self.documents]
+
+    def find(self, query=None, fields=None):
+        return MemoryCursor((document for document in self.candidates(query)
+                             if matches(document, query)), fields)
+
+    def update(self, query, update, upsert=False):
+        """Apply ``update`` to every document matching ``query``, or insert
+        one if none do and ``upsert`` is set"""
+        result = {"nMatched": 0, "nModified": 0, "nUpserted": 0}
+        for document in self.candidates(query):
+            if not matches(document, query):
+                continue
+            result["nMatched"] += 1
+            changes = update.get("$set", {})
+            if any(document.get(key, _MISSING) != value
+                   for key, value in changes.items()):
+                document.update(changes)
+                result["nModified"] += 1
+
+        if upsert and not result["nMatched"]:
+            document = dict((key, value) for key, value in query.items()
+                            if not isinstance(value, dict))
+            document.update(update.get("$setOnInsert", {}))
+            document.update(update.get("$set", {}))
+            self.insert(document)
+            result["nUpserted"] += 1
+        return result
+
+    def initialize_unordered_bulk_op(self):
+        return MemoryBulk(self)
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that time out hang up before the answer is written
+        pass
+
+
+class LocalGeonamesServer(object):
+    """Answers geonames ``timezoneJSON`` requests on localhost with a
+    ``rawOffset`` of ``lng``/15 hours, rounded, after waiting ``latency``
+    seconds.  ``requests`` counts the requests answered so far,
+    ``request_log`` holds the ``(path, params)`` of each, and
+    ``connections`` counts the connections opened.
+
+    :faults:  Dict from latitude to how to answer requests for it instead:
+        ``SLOW`` after ``fault_latency`` seconds, ``SERVER_ERROR`` with a
+        500, ``BAD_JSON`` with a body that isn't JSON, ``ERROR_STATUS`` with
+        a geonames error ``status``, or ``DROP_CONNECTION`` by closing the
+        connection after answering, without saying so
+    """
+
+    def __init__(self, latency=0.0, port=0, faults=None, fault_latency=1.0):
+        self.latency = latency
+        self.faults = faults or {}
+        self.fault_latency = fault_latency
+        self.requests = 0
+        self.request_log = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.server = _ThreadingHTTPServer(("127.0.0.1", port),
+                                           self.handler_class())
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def base_url(self):
+        """URL to give ``GeonamesClient`` as its ``base_url``"""
+        return "http://127.0.0.1:%d/" % self.server.server_address[1]
+
+    def timezone(self, lat, lng):
+        """The response for the point (lat, lng)"""
+        offset = round(lng/15.)
+        return {"lat": lat, "lng": lng, "rawOffset": offset,
+                "gmtOffset": offset, "dstOffset": offset,
+                "timezoneId": "Etc/GMT%+d" % -offset}
+
+    def handler_class(self):
+        local_server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            # Keep connections alive, as geonames does, without the
+            # headers and the body waiting on each other's ACKs
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                with local_server.lock:
+                    local_server.connections += 1
+
+            def do_GET(self):
+                url = urlparse.urlsplit(self.path)
+                params = dict(urlparse.parse_qsl(url.query))
+                with local_server.lock:
+                    local_server.request_log.append((url.path, params))
+                try:
+                    if url.path != "/timezoneJSON":
+                        raise ValueError(url.path)
+                    lat = float(params["lat"])
+                    response = local_server.timezone(lat,
+                                                     float(params["lng"]))
+                except (KeyError, ValueError):
+                    self.send_error(404)
+                    return
+                with local_server.lock:
+                    local_server.requests += 1
+                if local_server.latency:
+                    time.sleep(local_server.latency)
+
+                fault = local_server.faults.get(lat)
+                status = 200
+                body = json.dumps(response)
+                if fault == SLOW:
+                    time.sleep(local_server.fault_latency)
+                elif fault == SERVER_ERROR:
+                    status, body = 500, "Internal error"
+                elif fault == BAD_JSON:
+                    body = "<html>not json</html>"
+                elif fault == ERROR_STATUS:
+                    body = json.dumps({"status": {
+                        "message": "invalid lat/lng", "value": 14}})
+
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                if fault == DROP_CONNECTION:
+                    self.close_connection = 1
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,145 @@
+"""Cached map backgrounds for the visualizer.
+
+Drawing a Basemap (coastlines, countries, states and filled continents) is
+the most expensive part of a frame, and it is identical for every frame
+rendered with a given camera.  ``get_map_background`` draws it once,
+rasterizes the whole figure to an RGBA array and keeps that, along with the
+projection, in memory and optionally on disk, so that every frame only has
+to composite the heatmap and the time labels on top.
+"""
+import os
+import json
+import pickle
+import hashlib
+import logging
+import numpy as np
+from mpl_toolkits.basemap import Basemap
+import matplotlib.pyplot as plt
+import matplotlib.patches as patches
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# Frames are saved at this resolution, so that a 16x9 inch frame is
+# 1600x900 pixels
+DEFAULT_DPI = 100
+
+# In-memory cache of MapBackground objects, keyed by ``background_key``
+_backgrounds = {}
+
+
+class MapBackground(object):
+    """A rasterized map background for one camera
+
+    :basemap: The ``Basemap`` instance the map was drawn with, used to
+        project points into map coordinates
+    :image: (height, width, 4) uint8 RGBA raster of the full figure
+    :position: [left, bottom, width, height] of the map axes, in figure
+        coordinates
+    :dpi: Resolution the raster was drawn at
+    """
+
+    def __init__(self, basemap, image, position, dpi):
+        self.basemap = basemap
+        self.image = image
+        self.position = position
+        self.dpi = dpi
+
+    def new_figure(self):
+        """Create a new figure, on its own Agg canvas, with the background
+        already drawn into it.  The figure is not registered with pyplot,
+        so it is freed as soon as it is no longer referenced"""
+        height, width = self.image.shape[:2]
+        fig = Figure(figsize=(float(width)/self.dpi, float(height)/self.dpi),
+                     dpi=self.dpi)
+        FigureCanvasAgg(fig)
+        fig.figimage(self.image, xo=0, yo=0, origin="upper")
+        return fig
+
+
+def background_key(camera, figsize, dpi, sea_color, land_color):
+    """Return a string that uniquely identifies a background"""
+    key = json.dumps({"camera": camera, "figsize": list(figsize), "dpi": dpi,
+                      "sea_color": sea_color, "land_color": land_color},
+                     sort_keys=True)
+    return hashlib.md5(key).hexdigest()
+
+
+def draw_background(camera, figsize=(16, 9), dpi=DEFAULT_DPI,
+                    sea_color="#111111", land_color="#888888"):
+    """Draw the map for ``camera`` and rasterize it to a ``MapBackground``"""
+
+    fig = plt.figure(figsize=figsize, dpi=dpi)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.add_patch(patches.Rectangle((0, 0), 1, 1, fill=True,
+                                   transform=ax.transAxes, clip_on=False,
+                                   color=sea_color))
+
+    m = Basemap(
+            projection=camera["projection"],
+            resolution=camera["resolution"],
+            ax=ax,
+            **camera["projection_kwargs"])
+    m.drawcoastlines(color=sea_color)
+    m.drawcountries(color=sea_color)
+    m.drawstates(color=sea_color)
+    m.drawmapboundary(fill_color=sea_color)
+    m.fillcontinents(color=land_color,lake_color=sea_color)
+    ax.set_axis_off()
+
+    fig.canvas.draw()
+    image = np.array(fig.canvas.buffer_rgba(), dtype=np.uint8).reshape(
+        fig.canvas.get_width_height()[::-1] + (4,))
+    position = list(ax.get_position().bounds)
+    plt.close(fig)
+
+    # Only the projection is needed from here on.  Dropping the axes keeps
+    # the figure out of the pickled background
+    m.ax = None
+
+    return MapBackground(m, image, position, dpi)
+
+
+def get_map_background(camera, figsize=(16, 9), dpi=DEFAULT_DPI,
+                       sea_color="#111111", land_color="#888888",
+                       cache_dir=None):
+    """Return the ``MapBackground`` for ``camera``, drawing it only if it is
+    not already cached in memory or, if ``cache_dir`` is given, on disk"""
+
+    key = background_key(camera, figsize, dpi, sea_color, land_color)
+    if key in _backgrounds:
+        return _backgrounds[key]
+
+    if cache_dir is not None:
+        image_file = os.path.join(cache_dir, "background_%s.npy" % key)
+        meta_file = os.path.join(cache_dir, "background_%s.pickle" % key)
+
+    if cache_dir is not None and os.path.exists(meta_file):
+        logging.getLogger().info("Loading map background from %s" %
+                                 meta_file)
+        with open(meta_file, "rb") as f:
+            meta = pickle.load(f)
+        background = MapBackground(meta["basemap"], np.load(image_file),
+                                   meta["position"], meta["dpi"])
+    else:
+        background = draw_background(camera, figsize=figsize, dpi=dpi,
+                                     sea_color=sea_color,
+                                     land_color=land_color)
+        if cache_dir is not None:
+            logging.getLogger().info("Saving map background to %s" %
+                                     meta_file)
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            # Each file is renamed into place once it is complete, and the
+            # meta file goes last, so a crash never leaves a partly written
+            # background to be loaded
+            with open(image_file + ".tmp", "wb") as f:
+                np.save(f, background.image)
+            os.rename(image_file + ".tmp", image_file)
+            with open(meta_file + ".tmp", "wb") as f:
+                pickle.dump({"basemap": background.basemap,
+                             "position": background.position,
+                             "dpi": background.dpi}, f, -1)
+            os.rename(meta_file + ".tmp", meta_file)
+
+    _backgrounds[key] = background
+    return background
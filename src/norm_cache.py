@@ -0,0 +1,83 @@
+"""On-disk cache of the frame histograms behind ``--normalize_map``.
+
+The normalization map is the sum over frames of ``log(histogram + 1)``, so
+it can't be updated by adding the contribution of new points to it directly.
+The frame histograms themselves are linear in the points, though, so they are
+what is kept: a cached stack is reused as it is when the points haven't
+changed, and has only the new points' histograms added to it when points
+have been appended to the snapshot it was made from.
+
+Each cache entry is a ``normalization_<key>.npy`` stack of frame histograms
+and a ``normalization_<key>.json`` describing the points it holds, where the
+key covers the camera, the bins, the frame step, the decay time and the
+viewport bounds.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+
+from point_dataset import COLUMNS
+
+
+def normalization_key(camera, nheatmapbins, minutes_step, decay_hours,
+                      bounds=None):
+    """Return a string that identifies the frame histograms for these
+    settings"""
+    key = json.dumps({"camera": camera, "nheatmapbins": nheatmapbins,
+                      "minutes_step": minutes_step,
+                      "decay_hours": decay_hours, "bounds": bounds},
+                     sort_keys=True)
+    return hashlib.md5(key).hexdigest()
+
+
+def dataset_fingerprint(points):
+    """Return ``(fingerprint, appendable)`` for ``points``.  Points loaded
+    from a snapshot are identified by the snapshot, and later loads of the
+    same snapshot only ever have points appended.  Anything else is
+    identified by a hash of its contents"""
+    snapshot_id = getattr(points, "snapshot_id", None)
+    if snapshot_id is not None:
+        return snapshot_id, True
+
+    digest = hashlib.md5()
+    for name, _ in COLUMNS:
+        digest.update(np.ascontiguousarray(getattr(points, name)).data)
+    if points.count is not None:
+        digest.update(np.ascontiguousarray(points.count).data)
+    return digest.hexdigest(), False
+
+
+class NormalizationCache(object):
+    """Frame histogram stacks saved in ``cache_dir``"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, "normalization_%s" % key)
+        return base + ".npy", base + ".json"
+
+    def load(self, key):
+        """Return ``(meta, histograms)`` saved under ``key``, or None"""
+        histogram_file, meta_file = self._paths(key)
+        if not os.path.exists(meta_file):
+            return None
+        with open(meta_file) as f:
+            meta = json.load(f)
+        return meta, np.load(histogram_file)
+
+    def save(self, key, meta, histograms):
+        """Save ``histograms`` and their ``meta`` under ``key``.  The meta
+        file is written last, so a partly written entry is never loaded"""
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        histogram_file, meta_file = self._paths(key)
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+        with open(histogram_file + ".tmp", "wb") as f:
+            np.save(f, histograms)
+        os.rename(histogram_file + ".tmp", histogram_file)
+        with open(meta_file + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.rename(meta_file + ".tmp", meta_file)
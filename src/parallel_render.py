@@ -0,0 +1,80 @@
+"""Run work that reads large numpy arrays on a pool of worker processes.
+
+The arrays are written once to ``.npy`` files in a temporary directory and
+memory-mapped read-only by every worker when it starts, so they are shared
+through the page cache rather than pickled and sent with each task.
+"""
+import os
+import shutil
+import logging
+import tempfile
+import multiprocessing
+import numpy as np
+
+# Per-process state, set up by ``_init_worker``
+_worker = {}
+
+
+def share_arrays(directory, arrays):
+    """Save each of the ``arrays`` dict to ``directory``, and return a dict
+    with the same keys giving the filename of each"""
+    files = {}
+    for name, array in arrays.items():
+        files[name] = os.path.join(directory, name + ".npy")
+        np.save(files[name], array)
+    return files
+
+
+def load_shared_arrays(files):
+    """Memory-map each of the files written by ``share_arrays``"""
+    return dict((name, np.load(path, mmap_mode="r"))
+                for name, path in files.items())
+
+
+def _init_worker(func, files, context):
+    """Runs once in each worker process when the pool starts"""
+    _worker["func"] = func
+    _worker["arrays"] = load_shared_arrays(files)
+    _worker["context"] = context
+
+
+def _run_task(task):
+    return _worker["func"](task, _worker["arrays"], _worker["context"])
+
+
+def run_parallel(func, tasks, workers, arrays, context=None, tmp_dir=None):
+    """Call ``func(task, arrays, context)`` for each of ``tasks`` on a pool of
+    ``workers`` processes and return the results in task order.
+
+    func:  Module level function to run for each task
+    arrays:  Dict of numpy arrays, seen by ``func`` as read-only memory maps
+    context:  Any other state ``func`` needs.  It is handed to each worker
+        once, when the worker starts
+    tmp_dir:  Where to write the shared arrays, by default the system
+        temporary directory
+    """
+
+    share_dir = tempfile.mkdtemp(prefix="instagram_map_", dir=tmp_dir)
+    try:
+        files = share_arrays(share_dir, arrays)
+        logging.getLogger().info("Starting %d workers for %d tasks" %
+                                 (workers, len(tasks)))
+        pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                    initargs=(func, files, context))
+        try:
+            results = pool.map(_run_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(share_dir)
+
+    return results
+
+
+def split_into_chunks(items, nchunks):
+    """Split ``items`` into at most ``nchunks`` contiguous lists of nearly
+    equal length"""
+    nchunks = max(1, min(nchunks, len(items)))
+    bounds = np.linspace(0, len(items), nchunks + 1).astype(int)
+    return [items[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
@@ -0,0 +1,123 @@
+"""Compact columnar storage for the points that the visualizer draws.
+
+A ``PointDataset`` holds one numpy array per field, rather than one dict per
+photo, so that tens of millions of points fit in a few hundred megabytes and
+can be handed straight to the projection and histogram code.
+"""
+import numpy as np
+
+# Stored in ``PointDataset.offset`` for photos with no timezone information
+MISSING_OFFSET = np.iinfo(np.int32).min
+
+# numpy type of each of the columns of a PointDataset
+COLUMNS = (("lat", np.float32),
+           ("lon", np.float32),
+           ("minutes", np.int16),
+           ("offset", np.int32))
+
+
+class PointDataset(object):
+    """Columnar set of points
+
+    :lat, lon: float32 latitude and longitude in degrees
+    :minutes: int16 minute of the day, 0-1439, at which each photo was taken
+        (UTC)
+    :offset: int32 offset of local time from UTC in seconds, or
+        ``MISSING_OFFSET`` if it is not known
+    :count: Optional number of photos that each point stands for, for
+        points that are bins aggregated by MongoDB.  None means one each
+
+    ``snapshot_id`` is set by ``snapshot.load_snapshot`` to the id of the
+    snapshot that the points are the first ``len(self)`` rows of.
+    """
+
+    snapshot_id = None
+
+    def __init__(self, lat, lon, minutes, offset, count=None):
+        self.lat = lat
+        self.lon = lon
+        self.minutes = minutes
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return len(self.lat)
+
+    @property
+    def nbytes(self):
+        """Memory used by the arrays, in bytes"""
+        nbytes = sum(getattr(self, name).nbytes for name, _ in COLUMNS)
+        if self.count is not None:
+            nbytes += self.count.nbytes
+        return nbytes
+
+    def select(self, index):
+        """Return a new dataset of the points picked out by the boolean
+        mask or index array ``index``"""
+        return PointDataset(*[getattr(self, name)[index]
+                              for name, _ in COLUMNS],
+                            count=None if self.count is None
+                            else self.count[index])
+
+    @classmethod
+    def from_results(cls, results):
+        """Build a dataset from a list of MongoDB result dicts"""
+        builder = PointDatasetBuilder(capacity=len(results))
+        builder.extend_results(results)
+        return builder.dataset()
+
+
+def result_minutes(res):
+    """Minute of the day at which the photo in ``res`` was taken"""
+    return 60*res["created_time"].hour + res["created_time"].minute
+
+
+def result_offset(res):
+    """UTC offset in seconds of the photo in ``res``.  Geonames gives
+    ``rawOffset`` in (possibly fractional) hours"""
+    if res.get("offset") is None:
+        return MISSING_OFFSET
+    return int(round(3600*res["offset"]))
+
+
+class PointDatasetBuilder(object):
+    """Accumulates points into preallocated arrays, which double in size
+    whenever they fill up"""
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.arrays = dict((name, np.empty(max(capacity, 1), dtype=dtype))
+                           for name, dtype in COLUMNS)
+
+    def _reserve(self, n):
+        capacity = len(self.arrays["lat"])
+        if self.size + n <= capacity:
+            return
+        while capacity < self.size + n:
+            capacity *= 2
+        for name, array in self.arrays.items():
+            grown = np.empty(capacity, dtype=array.dtype)
+            grown[:self.size] = array[:self.size]
+            self.arrays[name] = grown
+
+    def extend(self, lat, lon, minutes, offset):
+        """Append a batch of points, given as sequences of equal length"""
+        n = len(lat)
+        self._reserve(n)
+        for name, values in (("lat", lat), ("lon", lon),
+                             ("minutes", minutes), ("offset", offset)):
+            self.arrays[name][self.size:self.size + n] = values
+        self.size += n
+
+    def extend_results(self, results):
+        """Append a batch of MongoDB result dicts"""
+        self.extend([res["latitude"] for res in results],
+                    [res["longitude"] for res in results],
+                    [result_minutes(res) for res in results],
+                    [result_offset(res) for res in results])
+
+    def dataset(self):
+        """Return a ``PointDataset`` of everything appended so far, with the
+        arrays trimmed to size"""
+        return PointDataset(**dict((name, array[:self.size].copy())
+                                   for name, array in self.arrays.items()))
@@ -0,0 +1,241 @@
+"""Optional profiling of where the time and memory go.
+
+    with profiling.span("histogram", points=len(x)):
+        ...
+    profiling.count("geonames_calls")
+
+Spans nest, per thread, and each records the span it was opened inside, so
+a trace shows how a frame's time divides between its stages.  Counters add
+up both overall and on the innermost open span of the thread that counts
+them.  ``utils.TimedLogger`` blocks are spans too.
+
+Nothing is recorded until ``enable`` is called.  Until then ``span``
+returns a shared context manager that does nothing and ``count`` returns at
+once, so instrumented code only pays for a function call.
+
+Once enabled, each span is written to ``path`` as it closes, either as a
+line of JSON ("jsonl") or as a Chrome trace event ("chrome", for
+chrome://tracing or Perfetto).  Every event is a single ``os.write`` to a
+file opened for appending, so worker processes forked by
+``parallel_render`` add their spans to the same file.  Each span records
+the process's peak memory (``ru_maxrss``) when it closed, and with
+``memory_interval`` set a thread samples the resident set size that often,
+and each span also records the largest sample taken while it was open.
+"""
+import os
+import json
+import resource
+import threading
+import itertools
+import timeit
+
+TRACE_FORMATS = ("jsonl", "chrome")
+
+# The active Profiler, or None
+_profiler = None
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name, **attrs):
+    """Context manager timing the block inside it as ``name``, with
+    ``attrs`` saved alongside"""
+    if _profiler is None:
+        return _NULL_SPAN
+    return Span(_profiler, name, attrs)
+
+
+def count(name, value=1):
+    """Add ``value`` to the counter ``name``"""
+    if _profiler is not None:
+        _profiler.count(name, value)
+
+
+def enabled():
+    return _profiler is not None
+
+
+def enable(path, trace_format="jsonl", memory_interval=None):
+    """Start recording to ``path``, replacing it, and return the
+    ``Profiler``"""
+    global _profiler
+    disable()
+    _profiler = Profiler(path, trace_format=trace_format,
+                         memory_interval=memory_interval)
+    return _profiler
+
+
+def disable():
+    """Stop recording, and write the totals of the counters"""
+    global _profiler
+    if _profiler is not None:
+        _profiler.close()
+        _profiler = None
+
+
+def trace_path(logfile, trace_format="jsonl"):
+    """Where to write the trace for a run logging to ``logfile``"""
+    return logfile + (".trace.jsonl" if trace_format == "jsonl"
+                      else ".trace.json")
+
+
+def max_rss():
+    """Peak resident set size of this process so far, in bytes"""
+    # ru_maxrss is in kilobytes on Linux
+    return 1024*resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def current_rss():
+    """Resident set size of this process now, in bytes, or its peak so far
+    where /proc is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1])*resource.getpagesize()
+    except IOError:
+        return max_rss()
+
+
+class Span(object):
+
+    def __init__(self, profiler, name, attrs):
+        self.profiler = profiler
+        self.name = name
+        self.attrs = attrs
+        self.counters = {}
+        self.peak_rss = None
+
+    def __enter__(self):
+        stack = self.profiler.stack()
+        self.parent = stack[-1].id if stack else None
+        self.id = self.profiler.new_id()
+        stack.append(self)
+        if self.profiler.sampler is not None:
+            self.peak_rss = current_rss()
+            self.profiler.open_spans.add(self)
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds = timeit.default_timer() - self.start
+        self.profiler.stack().pop()
+        self.profiler.open_spans.discard(self)
+        self.profiler.record(self)
+        return False
+
+
+class Profiler(object):
+    """Records spans and counters to ``path``, see the module docstring"""
+
+    def __init__(self, path, trace_format="jsonl", memory_interval=None):
+        if trace_format not in TRACE_FORMATS:
+            raise ValueError("trace_format must be one of %s" %
+                             (TRACE_FORMATS,))
+        self.trace_format = trace_format
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                          os.O_APPEND, 0644)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.counters = {}
+        self.open_spans = set()
+        if trace_format == "chrome":
+            self.write("[\n")
+
+        self.sampler = None
+        self.stopping = threading.Event()
+        if memory_interval:
+            self.sampler = threading.Thread(target=self.sample_memory,
+                                            args=(memory_interval,))
+            self.sampler.daemon = True
+            self.sampler.start()
+
+    def stack(self):
+        """Spans open in this thread, innermost last"""
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def new_id(self):
+        # Unique across the processes writing to the same file
+        return "%d-%d" % (os.getpid(), next(self.ids))
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        stack = self.stack()
+        if stack:
+            counters = stack[-1].counters
+            counters[name] = counters.get(name, 0) + value
+
+    def write(self, text):
+        os.write(self.fd, text)
+
+    def write_event(self, event):
+        if self.trace_format == "chrome":
+            self.write(json.dumps(event) + ",\n")
+        else:
+            self.write(json.dumps(event) + "\n")
+
+    def record(self, span):
+        """Write a closed span"""
+        info = {"id": span.id, "parent": span.parent,
+                "max_rss_bytes": max_rss()}
+        if span.peak_rss is not None:
+            info["peak_rss_bytes"] = span.peak_rss
+        info.update(span.attrs)
+
+        if self.trace_format == "chrome":
+            args = dict(info)
+            args.update(span.counters)
+            self.write_event({"name": span.name, "ph": "X",
+                              "ts": 1e6*span.start,
+                              "dur": 1e6*span.seconds,
+                              "pid": os.getpid(),
+                              "tid": threading.current_thread().ident,
+                              "args": args})
+        else:
+            info.update({"type": "span", "name": span.name,
+                         "start": span.start, "seconds": span.seconds,
+                         "pid": os.getpid(),
+                         "thread": threading.current_thread().name,
+                         "counters": span.counters})
+            self.write_event(info)
+
+    def sample_memory(self, interval):
+        while not self.stopping.wait(interval):
+            rss = current_rss()
+            for open_span in list(self.open_spans):
+                if rss > open_span.peak_rss:
+                    open_span.peak_rss = rss
+            if self.trace_format == "chrome":
+                self.write_event({"name": "rss", "ph": "C",
+                                  "ts": 1e6*timeit.default_timer(),
+                                  "pid": os.getpid(),
+                                  "args": {"bytes": rss}})
+
+    def close(self):
+        self.stopping.set()
+        if self.sampler is not None:
+            self.sampler.join()
+        totals = {"max_rss_bytes": max_rss()}
+        totals.update(self.counters)
+        if self.trace_format == "chrome":
+            self.write(json.dumps({"name": "totals", "ph": "i", "s": "g",
+                                   "ts": 1e6*timeit.default_timer(),
+                                   "pid": os.getpid(), "args": totals}) +
+                       "\n]\n")
+        else:
+            totals["type"] = "totals"
+            self.write_event(totals)
+        os.close(self.fd)
@@ -0,0 +1,50 @@
+"""Client side rate limiting for calls to external APIs"""
+import time
+import threading
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket that allows ``rate`` calls per second on
+    average, in bursts of up to ``capacity`` calls
+
+    with bucket:          # or bucket.acquire()
+        call_the_api()
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, blocking=True):
+        """Take a token, sleeping until one is available.  If ``blocking``
+        is False then return False straight away if there is no token,
+        rather than waiting.  Otherwise returns True"""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last)*self.rate)
+            self.last = now
+            if not blocking and self.tokens < 1:
+                return False
+            # Reserve the token even if it has not arrived yet, so that
+            # callers waiting at the same time queue up behind each other
+            self.tokens -= 1
+            wait = -self.tokens/self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    def release(self):
+        """Give back a token taken by ``acquire``, for a call that was not
+        made after all"""
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *args):
+        pass
@@ -0,0 +1,64 @@
+"""Bounded record of the media ids the collector has recently seen.
+
+Most of the photos returned by each poll of Instagram are already in
+MongoDB.  Checking ids against ``RecentIds`` first means those photos are
+dropped before their timezone is looked up or they are sent to MongoDB.
+"""
+import threading
+import collections
+import pymongo
+
+
+class RecentIds(object):
+    """Thread-safe set of at most ``max_size`` ids, forgetting the oldest
+    first.  An id that has been forgotten is just looked up and inserted
+    again, which the upsert in ``Collector.insert`` makes harmless"""
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.ids = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_mongo(cls, ig_mongo, max_size=100000):
+        """Seed the set with the ids of the ``max_size`` photos saved to
+        ``ig_mongo`` most recently.  This needs an index on ``saved_time``,
+        or MongoDB sorts the whole collection in memory"""
+        recent = cls(max_size)
+        cursor = ig_mongo.find({}, fields={"_id": True}).sort(
+            "saved_time", pymongo.DESCENDING).limit(max_size)
+        recent.update(reversed([res["_id"] for res in cursor]))
+        return recent
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, media_id):
+        return media_id in self.ids
+
+    def update(self, media_ids):
+        with self.lock:
+            for media_id in media_ids:
+                self.ids.pop(media_id, None)
+                self.ids[media_id] = True
+            while len(self.ids) > self.max_size:
+                self.ids.popitem(last=False)
+
+    def discard(self, media_ids):
+        """Forget ``media_ids``, e.g. because saving them failed"""
+        with self.lock:
+            for media_id in media_ids:
+                self.ids.pop(media_id, None)
+
+    def add_new(self, media_dicts):
+        """Return the media dicts whose ids have not been seen, and mark
+        them as seen"""
+        with self.lock:
+            new = []
+            for media_dict in media_dicts:
+                if media_dict["_id"] not in self.ids:
+                    self.ids[media_dict["_id"]] = True
+                    new.append(media_dict)
+            while len(self.ids) > self.max_size:
+                self.ids.popitem(last=False)
+        return new
@@ -0,0 +1,95 @@
+"""Serve the tile pyramids written by ``instagram_map_visualize.py --tiles``
+on a local web server, with a Leaflet map to look at them.
+
+    python serve_tiles.py --tile_dir data/tiles --port 8000
+
+then open http://localhost:8000/ and pick a time slot.
+"""
+import os
+import json
+import argparse
+import SimpleHTTPServer
+import SocketServer
+
+INDEX_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>instagram-map tiles</title>
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>
+html, body, #map { height: 100%%; margin: 0; background: #111111; }
+#slot { position: absolute; top: 10px; right: 10px; z-index: 1000; }
+</style>
+</head>
+<body>
+<select id="slot"></select>
+<div id="map"></div>
+<script>
+var slots = %(slots)s;
+var map = L.map("map").setView([20, 0], 2);
+L.tileLayer("https://{s}.basemaps.cartocdn.com/dark_nolabels/{z}/{x}/{y}.png",
+            {maxZoom: %(max_zoom)d}).addTo(map);
+var heatmap = null;
+var select = document.getElementById("slot");
+slots.forEach(function (slot) {
+    var option = document.createElement("option");
+    option.text = slot;
+    select.add(option);
+});
+function showSlot(slot) {
+    if (heatmap) { map.removeLayer(heatmap); }
+    heatmap = L.tileLayer(slot + "/{z}/{x}/{y}.png",
+                          {maxNativeZoom: %(max_zoom)d,
+                           maxZoom: %(max_zoom)d,
+                           errorTileUrl: ""}).addTo(map);
+}
+select.onchange = function () { showSlot(select.value); };
+if (slots.length) { showSlot(slots[0]); }
+</script>
+</body>
+</html>
+"""
+
+
+def tile_slots(tile_dir):
+    """Names of the time slots with a finished pyramid in ``tile_dir``"""
+    return sorted(name for name in os.listdir(tile_dir)
+                  if os.path.exists(os.path.join(tile_dir, name,
+                                                 "manifest.json")))
+
+
+def max_tile_zoom(tile_dir, slots):
+    """Deepest zoom level of any of the pyramids"""
+    zooms = [int(name) for slot in slots
+             for name in os.listdir(os.path.join(tile_dir, slot))
+             if name.isdigit()]
+    return max(zooms) if zooms else 0
+
+
+def write_index_page(tile_dir):
+    """Write the Leaflet viewer to ``tile_dir``/index.html"""
+    slots = tile_slots(tile_dir)
+    with open(os.path.join(tile_dir, "index.html"), "w") as f:
+        f.write(INDEX_PAGE % {"slots": json.dumps(slots),
+                              "max_zoom": max_tile_zoom(tile_dir, slots)})
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Serve heatmap tiles on a "
+        "local web server for checking them in a browser")
+    parser.add_argument('--tile_dir', type=str,
+                   default=os.path.join("data", "tiles"),
+                   help='Directory the tiles were written to')
+    parser.add_argument('--port', type=int, default=8000,
+                   help='Port to serve on')
+    args = parser.parse_args()
+
+    write_index_page(args.tile_dir)
+    os.chdir(args.tile_dir)
+    server = SocketServer.TCPServer(("", args.port),
+                                    SimpleHTTPServer.SimpleHTTPRequestHandler)
+    print "Serving %s at http://localhost:%d/" % (args.tile_dir, args.port)
+    server.serve_forever()
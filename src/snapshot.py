@@ -0,0 +1,211 @@
+"""Persistent local snapshot of the points in MongoDB.
+
+The snapshot is a directory holding one raw binary file per column of a
+``PointDataset`` and a ``manifest.json``.  Each sync only fetches documents
+saved since the snapshot's high-water mark and appends them to the column
+files, and the manifest (written last, by an atomic rename) records how many
+rows are valid.  Loading memory-maps the column files, so a render starts
+without a scan of the collection.
+
+The collector records when it saved each document in ``saved_time``, which
+unlike ``created_time`` grows in insertion order even though the collector
+pages back to older photos.  The last ``SAVED_LOOKBACK`` of it is re-read on
+each sync, minus the ids already in the snapshot, in case the saves of
+several collectors land out of order.  Documents saved before there was a
+``saved_time`` are synced by ``created_time``, as they always were.
+
+Offsets added to existing documents by ``add_timezone_info`` are only picked
+up when the snapshot is rebuilt.
+
+A snapshot can be limited to the ``viewport.camera_bounds`` of a region, and
+is rebuilt if the bounds it was made with change.
+"""
+import os
+import json
+import uuid
+import shutil
+import logging
+import datetime
+import numpy as np
+
+from extract_data import (get_cursors, ensure_location_index, POINT_FIELDS)
+from point_dataset import (PointDataset, PointDatasetBuilder, COLUMNS)
+from viewport import points_query
+
+SNAPSHOT_VERSION = 1
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+SAVED_LOOKBACK = datetime.timedelta(minutes=5)
+
+
+def column_file(snapshot_dir, name):
+    return os.path.join(snapshot_dir, name + ".bin")
+
+
+def read_manifest(snapshot_dir):
+    """Return the snapshot manifest, or None if there is no usable
+    snapshot in ``snapshot_dir``"""
+    path = os.path.join(snapshot_dir, "manifest.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != SNAPSHOT_VERSION:
+        return None
+    return manifest
+
+
+def write_manifest(snapshot_dir, manifest):
+    path = os.path.join(snapshot_dir, "manifest.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.rename(path + ".tmp", path)
+
+
+def empty_manifest(bounds=None):
+    # ``id`` changes whenever the snapshot is rebuilt, and otherwise rows
+    # are only ever appended
+    return {"version": SNAPSHOT_VERSION, "id": uuid.uuid4().hex,
+            "count": 0, "bounds": bounds, "high_water_mark": None,
+            "boundary_ids": [], "saved_mark": None, "recent_saved": {}}
+
+
+def sync_snapshot(snapshot_dir, rebuild=False, batch_size=10000,
+                  bounds=None):
+    """Bring the snapshot in ``snapshot_dir`` up to date with MongoDB,
+    creating it (or, if ``rebuild`` is set or ``bounds`` has changed,
+    recreating it) if needed.  Only points inside ``bounds`` are kept, if it
+    is given.  Returns the number of points added"""
+
+    manifest = None if rebuild else read_manifest(snapshot_dir)
+    if manifest is not None and manifest.get("bounds") != bounds:
+        manifest = None
+    if manifest is None:
+        if os.path.exists(snapshot_dir):
+            shutil.rmtree(snapshot_dir)
+        os.makedirs(snapshot_dir)
+        manifest = empty_manifest(bounds)
+
+    ig_mongo, _ = get_cursors()
+    ig_mongo.ensure_index("created_time")
+    ig_mongo.ensure_index("saved_time")
+    if bounds is not None:
+        ensure_location_index(ig_mongo)
+
+    fields = dict(POINT_FIELDS)
+    fields["_id"] = True
+    fields["saved_time"] = True
+
+    # Throw away anything appended after the manifest was last written,
+    # e.g. by a sync that was interrupted
+    files = {}
+    for name, dtype in COLUMNS:
+        files[name] = open(column_file(snapshot_dir, name), "ab")
+        files[name].truncate(manifest["count"]*np.dtype(dtype).itemsize)
+
+    def append(batch):
+        builder = PointDatasetBuilder(capacity=len(batch))
+        builder.extend_results(batch)
+        points = builder.dataset()
+        for name, _ in COLUMNS:
+            files[name].write(getattr(points, name).tobytes())
+        return len(points)
+
+    def copy(query, skip_ids=()):
+        """Append the points matching ``query``, except ``skip_ids``, and
+        return them without their columns"""
+        cursor = ig_mongo.find(query, fields=fields)
+        cursor.batch_size(batch_size)
+        added = []
+        batch = []
+        for res in cursor:
+            if res["_id"] in skip_ids:
+                continue
+            added.append({"_id": res["_id"],
+                          "created_time": res["created_time"],
+                          "saved_time": res.get("saved_time")})
+            batch.append(res)
+            if len(batch) == batch_size:
+                append(batch)
+                batch = []
+        append(batch)
+        return added
+
+    def parse_time(value):
+        if value is None:
+            return None
+        return datetime.datetime.strptime(value, TIME_FORMAT)
+
+    try:
+        # Documents saved before the collector recorded saved_time
+        query = points_query(bounds)
+        query["saved_time"] = {"$exists": False}
+        high_water_mark = parse_time(manifest["high_water_mark"])
+        if high_water_mark is not None:
+            query["created_time"] = {"$gte": high_water_mark}
+            query["_id"] = {"$nin": manifest["boundary_ids"]}
+        boundary_ids = set(manifest["boundary_ids"])
+        added = copy(query)
+        for res in added:
+            if (high_water_mark is None or
+                    res["created_time"] > high_water_mark):
+                high_water_mark = res["created_time"]
+                boundary_ids = set()
+            if res["created_time"] == high_water_mark:
+                boundary_ids.add(res["_id"])
+
+        # And those saved since the last sync, whenever they were taken
+        query = points_query(bounds)
+        saved_mark = parse_time(manifest.get("saved_mark"))
+        recent_saved = dict(manifest.get("recent_saved", {}))
+        if saved_mark is None:
+            query["saved_time"] = {"$exists": True}
+        else:
+            query["saved_time"] = {"$gte": saved_mark - SAVED_LOOKBACK}
+        added_saved = copy(query, skip_ids=recent_saved)
+        for res in added_saved:
+            if saved_mark is None or res["saved_time"] > saved_mark:
+                saved_mark = res["saved_time"]
+            recent_saved[res["_id"]] = res["saved_time"].strftime(
+                TIME_FORMAT)
+        num_added = len(added) + len(added_saved)
+    finally:
+        for f in files.values():
+            f.close()
+
+    if high_water_mark is not None:
+        manifest["high_water_mark"] = high_water_mark.strftime(TIME_FORMAT)
+    manifest["boundary_ids"] = sorted(boundary_ids)
+    if saved_mark is not None:
+        manifest["saved_mark"] = saved_mark.strftime(TIME_FORMAT)
+        lookback = (saved_mark - SAVED_LOOKBACK).strftime(TIME_FORMAT)
+        manifest["recent_saved"] = dict(
+            (_id, saved) for _id, saved in recent_saved.items()
+            if saved >= lookback)
+    manifest["count"] += num_added
+    write_manifest(snapshot_dir, manifest)
+
+    logging.getLogger().info("Added %d points to snapshot in %s, which now "
+                             "has %d" % (num_added, snapshot_dir,
+                                         manifest["count"]))
+    return num_added
+
+
+def load_snapshot(snapshot_dir):
+    """Memory-map the snapshot in ``snapshot_dir`` as a ``PointDataset``,
+    with ``snapshot_id`` set to the id of the snapshot"""
+
+    manifest = read_manifest(snapshot_dir)
+    if manifest is None:
+        raise ValueError("No snapshot in %s" % snapshot_dir)
+
+    count = manifest["count"]
+    columns = {}
+    for name, dtype in COLUMNS:
+        if count == 0:
+            columns[name] = np.empty(0, dtype=dtype)
+        else:
+            columns[name] = np.memmap(column_file(snapshot_dir, name),
+                                      dtype=dtype, mode="r", shape=(count,))
+    points = PointDataset(**columns)
+    points.snapshot_id = manifest.get("id")
+    return points
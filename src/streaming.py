@@ -0,0 +1,134 @@
+"""Animations over a real range of dates, streamed from MongoDB.
+
+The usual movie folds every photo onto one day by its time of day.  For a
+movie over real timestamps the points are instead read in ``created_time``
+order, through its index, a chunk at a time, and a ``SlidingWindow`` keeps
+only those taken within ``window_seconds`` before the current frame.  Memory
+use depends on the number of photos in one window and one chunk, not on the
+length of the range.
+"""
+import argparse
+import datetime
+import numpy as np
+import pymongo
+
+from extract_data import get_cursors
+from viewport import points_query
+
+TIME_FORMATS = ("%Y-%m-%dT%H:%M", "%Y-%m-%d")
+
+
+def parse_time(value):
+    """argparse type for a UTC time given as YYYY-MM-DD or YYYY-MM-DDTHH:MM"""
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("times must look like 2014-03-01 or "
+                                     "2014-03-01T18:00")
+
+
+def range_frame_times(start, end, minutes_step):
+    """Times of the frames from ``start`` to ``end`` inclusive"""
+    step = datetime.timedelta(minutes=minutes_step)
+    times = []
+    target_time = start
+    while target_time <= end:
+        times.append(target_time)
+        target_time += step
+    return times
+
+
+def iter_point_chunks(start, end, ig_mongo=None, bounds=None,
+                      chunk_size=10000):
+    """Yield ``(lat, lon, seconds)`` arrays for the valid points inside
+    ``bounds`` taken from ``start`` to ``end`` inclusive, in time order, up
+    to ``chunk_size`` points at a time.  ``seconds`` is the time each was
+    taken, in seconds after ``start``.
+
+    Each chunk is read in full by a query of its own, which carries on from
+    the last ``created_time`` of the one before, less the ids already read
+    at that time.  No cursor is left open while a chunk is being rendered,
+    however long that takes, so none can time out"""
+    if ig_mongo is None:
+        ig_mongo, _ = get_cursors()
+    ig_mongo.ensure_index("created_time")
+
+    def next_chunk(last_time, boundary_ids):
+        query = points_query(bounds)
+        query["created_time"] = {"$gte": last_time, "$lte": end}
+        if boundary_ids:
+            query["_id"] = {"$nin": boundary_ids}
+        cursor = ig_mongo.find(query, fields={"_id": True, "latitude": True,
+                                              "longitude": True,
+                                              "created_time": True})
+        cursor.sort("created_time", pymongo.ASCENDING)
+        return list(cursor.limit(chunk_size))
+
+    def to_arrays(chunk):
+        return (np.array([res["latitude"] for res in chunk]),
+                np.array([res["longitude"] for res in chunk]),
+                np.array([(res["created_time"] - start).total_seconds()
+                          for res in chunk]))
+
+    last_time = start
+    boundary_ids = []
+    while True:
+        chunk = next_chunk(last_time, boundary_ids)
+        if not chunk:
+            break
+        # The ids read so far that were taken at the last time read
+        if chunk[-1]["created_time"] != last_time:
+            last_time = chunk[-1]["created_time"]
+            boundary_ids = []
+        boundary_ids.extend(res["_id"] for res in chunk
+                            if res["created_time"] == last_time)
+        yield to_arrays(chunk)
+        if len(chunk) < chunk_size:
+            break
+
+
+class SlidingWindow(object):
+    """The points taken in the ``window_seconds`` up to a frame time
+
+    :chunks:  Iterable of ``(lat, lon, seconds)`` arrays in time order, such
+        as ``iter_point_chunks`` yields
+    :project:  Function mapping ``(lon, lat)`` arrays to map ``(x, y)``
+    """
+
+    def __init__(self, chunks, window_seconds, project):
+        self.chunks = iter(chunks)
+        self.window_seconds = window_seconds
+        self.project = project
+        self.exhausted = False
+        self.x = np.empty(0)
+        self.y = np.empty(0)
+        self.t = np.empty(0)
+
+    def advance(self, seconds):
+        """Move the window to end at ``seconds``, which must not go
+        backwards, and return ``(x, y, t)`` of the points in it"""
+
+        # Read until a point after the frame has been seen, or the data
+        # runs out
+        while not self.exhausted and (len(self.t) == 0 or
+                                      self.t[-1] <= seconds):
+            try:
+                lat, lon, t = next(self.chunks)
+            except StopIteration:
+                self.exhausted = True
+                break
+            x, y = self.project(lon, lat)
+            self.x = np.concatenate([self.x, x])
+            self.y = np.concatenate([self.y, y])
+            self.t = np.concatenate([self.t, t])
+
+        first = np.searchsorted(self.t, seconds - self.window_seconds,
+                                side="right")
+        self.x = self.x[first:]
+        self.y = self.y[first:]
+        self.t = self.t[first:]
+
+        last = np.searchsorted(self.t, seconds, side="right")
+        return self.x[:last], self.y[:last], self.t[:last]
@@ -0,0 +1,237 @@
+"""Tests of ``Collector`` with an in-memory MongoDB collection and fake
+Instagram and geonames clients."""
+import datetime
+import time
+import unittest
+
+from geonames import GeonamesError
+from instagram_map_collect import (Collector, CollectorPipeline,
+                                   TagScheduler)
+from local_services import MemoryCollection
+from seen_ids import RecentIds
+
+
+class Struct(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeTag(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return "Tag: %s" % self.name
+
+
+def fake_media(media_id, lat=51.5, lng=-0.1, located=True):
+    """A media object shaped like python-instagram's"""
+    media = Struct(id=media_id,
+                   created_time=datetime.datetime(2014, 3, 1, 12, 0),
+                   caption="caption %s" % media_id,
+                   images={"standard_resolution":
+                           Struct(url="http://example.com/%s.jpg" %
+                                  media_id)},
+                   tags=[FakeTag("london")])
+    if located:
+        media.location = Struct(point=Struct(latitude=lat, longitude=lng))
+    return media
+
+
+class FakeInstagramAPI(object):
+    """Serves ``media`` newest first, ``page_size`` at a time.  Like
+    Instagram's, the ``max_tag_id`` of the next page is that of its first
+    photo, so it still points there when newer photos arrive"""
+
+    def __init__(self, media, page_size=20):
+        self.media = media
+        self.page_size = page_size
+        self.calls = []
+
+    def tag_recent_media(self, tag_name, count=None, max_tag_id=None):
+        self.calls.append((tag_name, max_tag_id))
+        ids = [media.id for media in self.media]
+        start = 0 if max_tag_id is None else ids.index(max_tag_id)
+        stop = start + (count or self.page_size)
+        next_url = None
+        if stop < len(self.media):
+            next_url = ("https://api.instagram.com/v1/tags/%s/media/recent"
+                        "?max_tag_id=%s" % (tag_name, ids[stop]))
+        return self.media[start:stop], next_url
+
+
+class FakeGeo(object):
+    """Offset of ``lng``/15 hours, or a ``GeonamesError`` at lat 0"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def find_timezone(self, params):
+        self.calls += 1
+        if params["lat"] == 0:
+            raise GeonamesError("no timezone")
+        return {"rawOffset": round(params["lng"]/15.)}
+
+
+class CollectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ig_mongo = MemoryCollection()
+        self.geo = FakeGeo()
+
+    def collector(self, media):
+        return Collector(self.ig_mongo, self.geo, FakeInstagramAPI(media),
+                         seen=RecentIds(100))
+
+    def test_fetch(self):
+        collector = self.collector([fake_media("1", lng=30),
+                                    fake_media("2", located=False)])
+        media_dicts = collector.fetch_new("london")[0]
+        self.assertEqual([media_dict["_id"] for media_dict in media_dicts],
+                         ["1"])
+        media_dict = media_dicts[0]
+        self.assertEqual(media_dict["longitude"], 30)
+        self.assertEqual(media_dict["tags"], ["london"])
+        self.assertEqual(media_dict["location"],
+                         {"type": "Point", "coordinates": [30, 51.5]})
+        self.assertNotIn("offset", media_dict)
+
+    def test_fetch_new_stops_at_seen(self):
+        media = [fake_media(str(n)) for n in range(10)]
+        collector = self.collector(media)
+        collector.api.page_size = 3
+        media_dicts, newest_ids, num_new, num_calls, complete, _ = \
+            collector.fetch_new("london", seen_ids=set(["5"]), max_pages=10,
+                                page_size=3)
+        self.assertEqual([media_dict["_id"] for media_dict in media_dicts],
+                         ["0", "1", "2", "3", "4"])
+        self.assertEqual(newest_ids, set(["0", "1", "2"]))
+        self.assertEqual((num_new, num_calls, complete), (5, 2, True))
+
+    def test_fetch_new_carries_on(self):
+        collector = self.collector([fake_media(str(n)) for n in range(10)])
+        collector.api.page_size = 3
+        media_dicts, _, _, _, complete, max_tag_id = collector.fetch_new(
+            "london", seen_ids=set(["8"]), max_pages=2, page_size=3)
+        self.assertEqual((len(media_dicts), complete), (6, False))
+        media_dicts, _, _, _, complete, _ = collector.fetch_new(
+            "london", seen_ids=set(["8"]), max_pages=2, page_size=3,
+            max_tag_id=max_tag_id)
+        self.assertEqual([media_dict["_id"] for media_dict in media_dicts],
+                         ["6", "7"])
+        self.assertTrue(complete)
+
+    def test_drop_seen(self):
+        collector = self.collector([])
+        first = [{"_id": "1"}, {"_id": "2"}]
+        self.assertEqual(collector.drop_seen(first), first)
+        self.assertEqual(collector.drop_seen([{"_id": "2"}, {"_id": "3"}]),
+                         [{"_id": "3"}])
+
+    def test_enrich(self):
+        collector = self.collector([])
+        self.assertEqual(collector.enrich({"_id": "1", "latitude": 10,
+                                           "longitude": 45})["offset"], 3)
+        # Photos geonames can't place are kept, to be backfilled later
+        self.assertNotIn("offset", collector.enrich(
+            {"_id": "2", "latitude": 0, "longitude": 45}))
+
+    def test_insert_counts_duplicates(self):
+        collector = self.collector([])
+        self.assertEqual(collector.insert([]), (0, 0))
+        batch = [{"_id": str(n), "latitude": 10, "longitude": 20}
+                 for n in range(3)]
+        self.assertEqual(collector.insert(batch), (3, 0))
+        self.assertEqual(collector.insert(batch[1:] + [{"_id": "3"}]),
+                         (1, 2))
+        self.assertEqual(self.ig_mongo.count(), 4)
+
+    def test_insert_keeps_saved_fields(self):
+        collector = self.collector([])
+        collector.insert([{"_id": "1", "offset": 1}])
+        collector.insert([{"_id": "1", "offset": 2}])
+        self.assertEqual(self.ig_mongo.find({"_id": "1"})[0]["offset"], 1)
+
+    def test_pipeline_metrics(self):
+        collector = self.collector([fake_media(str(n), lng=15)
+                                    for n in range(4)])
+        # One already saved by an earlier run, one seen in this one
+        collector.insert([{"_id": "0"}])
+        collector.seen = RecentIds(100)
+        collector.seen.update(["1"])
+
+        pipeline = CollectorPipeline(collector, TagScheduler(["london"]),
+                                     flush_seconds=0.01)
+        pipeline.start()
+        deadline = time.time() + 5
+        while not collector.api.calls and time.time() < deadline:
+            time.sleep(0.01)
+        pipeline.stop()
+
+        metrics = pipeline.last_metrics
+        self.assertEqual(sorted(metrics), ["enrich_seconds", "fetch_seconds",
+                                           "insert_seconds", "num_duplicates",
+                                           "num_fetched", "num_new",
+                                           "num_not_seen"])
+        self.assertEqual(metrics["num_fetched"], 4)
+        self.assertEqual(metrics["num_not_seen"], 3)
+        self.assertEqual(metrics["num_new"], 2)
+        self.assertEqual(metrics["num_duplicates"], 1)
+        # Only the photos that weren't dropped as seen were looked up
+        self.assertEqual(self.geo.calls, 3)
+        self.assertEqual(self.ig_mongo.find({"_id": "2"})[0]["offset"], 1)
+
+class RecentIdsTest(unittest.TestCase):
+
+    def test_from_mongo_by_saved_time(self):
+        saved = datetime.datetime(2014, 3, 1, 12, 0)
+        ig_mongo = MemoryCollection(
+            {"_id": str(n), "created_time": saved - datetime.timedelta(n),
+             "saved_time": saved + datetime.timedelta(minutes=n)}
+            for n in range(5))
+        # The newest saved are seeded, however long ago they were taken
+        seen = RecentIds.from_mongo(ig_mongo, max_size=2)
+        self.assertEqual(list(seen.ids), ["3", "4"])
+
+
+class TagSchedulerTest(unittest.TestCase):
+
+    def poll(self, scheduler, media):
+        """Poll the tag of ``scheduler`` when ``media`` are its photos, and
+        return the ids fetched"""
+        state = scheduler.pop_due()
+        api = FakeInstagramAPI(media, page_size=scheduler.page_size)
+        collector = Collector(MemoryCollection(), FakeGeo(), api,
+                              seen=RecentIds(100))
+        media_dicts, newest_ids, num_new, _, complete, max_tag_id = \
+            collector.fetch_new("london", **scheduler.fetch_kwargs(state))
+        scheduler.record_poll(state, num_new, complete, newest_ids,
+                              max_tag_id)
+        return [media_dict["_id"] for media_dict in media_dicts]
+
+    def test_poll_that_stops_short_is_carried_on(self):
+        scheduler = TagScheduler(["london"], page_size=3, max_pages=2)
+        state = scheduler.states[0]
+        media = [fake_media(str(n)) for n in range(20, 30)]
+        self.assertEqual(self.poll(scheduler, media), ["20", "21", "22"])
+
+        # 11 new photos, more than two pages
+        media = [fake_media(str(n)) for n in range(9, 30)]
+        self.assertEqual(self.poll(scheduler, media),
+                         ["9", "10", "11", "12", "13", "14"])
+        self.assertIsNotNone(state.gap)
+        rate = state.rate
+        # Two more arrive before the follow-up, which pages on from 15
+        media = [fake_media(str(n)) for n in range(7, 30)]
+        self.assertEqual(self.poll(scheduler, media),
+                         ["15", "16", "17", "18", "19"])
+        self.assertIsNone(state.gap)
+        self.assertGreater(state.rate, rate)
+        # Then polls start from the newest photos again
+        self.assertEqual(self.poll(scheduler, media), ["7", "8"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+"""Tests of ``GeonamesClient`` against ``LocalGeonamesServer``.
+
+    cd src; python -m unittest discover -p "test_*.py"
+"""
+import time
+import unittest
+
+import rate_limit
+from geonames import (GeonamesClient, GeonamesError)
+from local_services import (LocalGeonamesServer, SLOW, SERVER_ERROR,
+                            BAD_JSON, ERROR_STATUS, DROP_CONNECTION)
+
+# Latitudes that the server answers badly
+SLOW_LAT = 1.5
+SLOW_SECONDS = 0.5
+ERROR_LAT = 2.5
+BAD_JSON_LAT = 3.5
+STATUS_LAT = 4.5
+DROP_LAT = 5.5
+
+
+class RecordingTime(object):
+    """Stands in for the ``time`` module in ``rate_limit``, recording
+    sleeps instead of sleeping"""
+
+    def __init__(self):
+        self.sleeps = []
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+class GeonamesClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalGeonamesServer(
+            faults={SLOW_LAT: SLOW, ERROR_LAT: SERVER_ERROR,
+                    BAD_JSON_LAT: BAD_JSON, STATUS_LAT: ERROR_STATUS,
+                    DROP_LAT: DROP_CONNECTION},
+            fault_latency=SLOW_SECONDS)
+
+    def tearDown(self):
+        self.server.close()
+        rate_limit.time = time
+
+    def client(self, **kwargs):
+        kwargs.setdefault("hourly_limit", None)
+        kwargs.setdefault("daily_limit", None)
+        kwargs.setdefault("timeout", 5)
+        return GeonamesClient("test", base_url=self.server.base_url,
+                              **kwargs)
+
+    def assert_error(self, message, client, lat):
+        with self.assertRaises(GeonamesError) as context:
+            client.find_timezone({"lat": lat, "lng": 30})
+        self.assertEqual(str(context.exception), message)
+
+    def test_find_timezone(self):
+        response = self.client().find_timezone({"lat": 10, "lng": 30})
+        self.assertEqual(response["rawOffset"], 2)
+        path, params = self.server.request_log[0]
+        self.assertEqual(path, "/timezoneJSON")
+        self.assertEqual(params, {"lat": "10", "lng": "30",
+                                  "username": "test"})
+
+    def test_timeout(self):
+        self.assert_error("API request timed out.",
+                          self.client(timeout=SLOW_SECONDS/5), SLOW_LAT)
+
+    def test_non_200(self):
+        self.assert_error("API didnt return 200 response.", self.client(),
+                          ERROR_LAT)
+
+    def test_invalid_json(self):
+        self.assert_error("API did not return valid json response.",
+                          self.client(), BAD_JSON_LAT)
+
+    def test_status_message(self):
+        self.assert_error("invalid lat/lng", self.client(), STATUS_LAT)
+
+    def test_connection_reused(self):
+        client = self.client()
+        for lat in range(5):
+            client.find_timezone({"lat": lat, "lng": 30})
+        self.assertEqual(self.server.requests, 5)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_closed_connection_retried(self):
+        client = self.client()
+        client.find_timezone({"lat": DROP_LAT, "lng": 30})
+        # The kept alive connection is dead, so this goes on a new one
+        self.assertEqual(client.find_timezone({"lat": 10, "lng": 30})
+                         ["rawOffset"], 2)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_limit_not_blocking(self):
+        client = self.client(hourly_limit=2)
+        client.find_timezone({"lat": 10, "lng": 30})
+        client.find_timezone({"lat": 11, "lng": 30})
+        self.assert_error("Client side rate limit reached.", client, 12)
+        self.assertEqual(self.server.requests, 2)
+
+    def test_daily_limit_not_blocking(self):
+        client = self.client(hourly_limit=10, daily_limit=1)
+        client.find_timezone({"lat": 10, "lng": 30})
+        self.assert_error("Client side rate limit reached.", client, 11)
+        # The hourly token taken for the refused call was given back
+        self.assertAlmostEqual(client.limits[0].tokens, 9, delta=0.01)
+
+    def test_limit_blocking(self):
+        rate_limit.time = RecordingTime()
+        client = self.client(hourly_limit=1, block_on_limit=True)
+        client.find_timezone({"lat": 10, "lng": 30})
+        self.assertEqual(rate_limit.time.sleeps, [])
+        client.find_timezone({"lat": 11, "lng": 30})
+        # The second call waits for the next of 1 token an hour
+        self.assertEqual(len(rate_limit.time.sleeps), 1)
+        self.assertAlmostEqual(rate_limit.time.sleeps[0], 3600, delta=1)
+        self.assertEqual(self.server.requests, 2)
+
+    def test_find_timezones(self):
+        client = self.client()
+        params = [{"lat": lat, "lng": 30}
+                  for lat in (10, ERROR_LAT, 11, STATUS_LAT)]
+        self.assertEqual([response and response["rawOffset"]
+                          for response in client.find_timezones(params)],
+                         [2, None, 2, None])
+
+
+if __name__ == "__main__":
+    unittest.main()
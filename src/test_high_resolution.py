@@ -0,0 +1,91 @@
+"""Tests of the ``--resolution`` heatmap pipeline in ``high_resolution``:
+that it draws the same pixels as the float64 path, and stays within its
+memory budget."""
+import datetime
+import multiprocessing
+import resource
+import unittest
+import numpy as np
+from scipy.ndimage.filters import gaussian_filter
+
+from high_resolution import (BinnedPoints, finish_heatmap, heatmap_shape,
+                             uint8_lut)
+from instagram_map_visualize import (build_color_lut, decay_weights,
+                                     fix_opacity_and_color_map)
+
+FRAME = datetime.datetime(2014, 1, 1, 12, 0, 0)
+WORLD = ((-180, 180), (-90, 90))
+
+
+def random_points(num_points, seed=0):
+    """(lat, lon, minutes) of photos spread over the world, with most of
+    them in a few clusters"""
+    rng = np.random.RandomState(seed)
+    lat = rng.uniform(-85, 85, num_points)
+    lon = rng.uniform(-180, 180, num_points)
+    clustered = rng.uniform(0, 1, num_points) < 0.8
+    city = rng.randint(0, 20, clustered.sum())
+    lat[clustered] = (city*7 - 60) + rng.normal(0, 0.5, clustered.sum())
+    lon[clustered] = (city*17 - 170) + rng.normal(0, 0.5, clustered.sum())
+    minutes = rng.randint(0, 24*60, num_points).astype(np.int16)
+    return (lat.astype(np.float32), lon.astype(np.float32), minutes)
+
+
+def float32_heatmap(lat, lon, minutes, shape, chunk_size=1000000):
+    points = BinnedPoints(lat, lon, minutes, WORLD[0], WORLD[1], shape,
+                          lambda lon, lat: (lon, lat), chunk_size=chunk_size)
+    grid = points.accumulate(
+        lambda start, stop: decay_weights(points.minutes[start:stop], FRAME))
+    return finish_heatmap(grid, uint8_lut(build_color_lut()), sigma=1)
+
+
+def measure_float32_heatmap(lat, lon, minutes, shape, chunk_size, queue):
+    """Put the extra peak memory, in bytes, of ``float32_heatmap`` on
+    ``queue``.  Run in a child process"""
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    float32_heatmap(lat, lon, minutes, shape, chunk_size=chunk_size)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux
+    queue.put(1024*(peak - baseline))
+
+
+class HighResolutionTest(unittest.TestCase):
+
+    def test_same_pixels_as_float64(self):
+        lat, lon, minutes = random_points(200000)
+        shape = heatmap_shape((1600, 900))
+        self.assertEqual(shape, (281, 500))
+
+        # The usual path, as make_single_map takes it
+        im, _, _ = np.histogram2d(lon, lat, bins=shape[::-1], range=WORLD,
+                                  weights=decay_weights(minutes, FRAME))
+        im = gaussian_filter(np.log(np.rot90(im) + 1), 1)
+        rgba = fix_opacity_and_color_map(im, lut=build_color_lut())
+        expected = (np.clip(rgba, 0, 1)*255).astype(np.uint8)
+
+        heatmap = float32_heatmap(lat, lon, minutes, shape)
+        self.assertEqual(heatmap.dtype, np.uint8)
+        np.testing.assert_array_equal(heatmap, expected)
+
+    def test_peak_memory(self):
+        # The budget that the high_resolution docstring documents: the
+        # point order and the sorted columns, the float32 grid and the
+        # uint8 RGBA heatmap with room to spare, and the chunk temporaries
+        num_points = 1000000
+        chunk_size = 100000
+        shape = heatmap_shape((3840, 2160), pixels_per_bin=1)
+        budget = (14*num_points + 12*shape[0]*shape[1] + 40*chunk_size +
+                  4*2**20)
+
+        lat, lon, minutes = random_points(num_points)
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=measure_float32_heatmap,
+            args=(lat, lon, minutes, shape, chunk_size, queue))
+        process.start()
+        peak_extra = queue.get()
+        process.join()
+        self.assertLessEqual(peak_extra, budget)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+"""Tests of ``NewPhotoPoller`` against an in-memory MongoDB collection."""
+import datetime
+import unittest
+
+from live import NewPhotoPoller
+from local_services import MemoryCollection
+
+START = datetime.datetime(2014, 3, 1, 12, 0)
+
+
+def photo(media_id, taken_minutes, saved_minutes):
+    """A saved photo, taken and saved the given minutes after ``START``"""
+    return {"_id": media_id, "latitude": 51.5, "longitude": -0.1,
+            "created_time": START + datetime.timedelta(minutes=taken_minutes),
+            "saved_time": START + datetime.timedelta(minutes=saved_minutes)}
+
+
+class NewPhotoPollerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ig_mongo = MemoryCollection([photo("old", -10, -9),
+                                          photo("1", 1, 2)])
+        self.poller = NewPhotoPoller(ig_mongo=self.ig_mongo)
+
+    def poll(self):
+        """Minutes after ``START`` that the photos of a poll were taken"""
+        lat, lon, created_times = self.poller.poll(START)
+        self.assertEqual(len(lat), len(created_times))
+        self.assertEqual(len(lon), len(created_times))
+        return sorted((created_time - START).total_seconds()/60
+                      for created_time in created_times)
+
+    def test_first_poll_reads_window(self):
+        self.assertEqual(self.poll(), [1])
+        self.assertEqual(self.poll(), [])
+
+    def test_late_and_out_of_order(self):
+        self.poll()
+        self.ig_mongo.insert(photo("recent", 50, 51))
+        self.assertEqual(self.poll(), [50])
+        # Saved long after it was taken, and after newer photos...
+        self.ig_mongo.insert(photo("late", 5, 60))
+        self.assertEqual(self.poll(), [5])
+        # ...and saved a little earlier than that, but only showing up now
+        self.ig_mongo.insert(photo("out_of_order", 3, 58))
+        self.assertEqual(self.poll(), [3])
+        self.ig_mongo.insert(photo("later", 4, 90))
+        self.assertEqual(self.poll(), [4])
+        self.assertEqual(self.poll(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
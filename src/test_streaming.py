@@ -0,0 +1,70 @@
+"""Tests of ``streaming.iter_point_chunks`` against an in-memory MongoDB
+collection whose cursors time out."""
+import datetime
+import unittest
+from pymongo.errors import CursorNotFound
+
+from local_services import (MemoryCollection, MemoryCursor)
+from streaming import iter_point_chunks
+
+START = datetime.datetime(2014, 3, 1)
+
+
+class ExpiringCursor(MemoryCursor):
+
+    def __iter__(self):
+        for res in list.__iter__(self):
+            if self.expired:
+                raise CursorNotFound("cursor id not valid at server")
+            yield res
+
+
+class ExpiringCollection(MemoryCollection):
+    """Its cursors time out whenever ``wait`` is called, as MongoDB's do
+    after sitting idle for 10 minutes"""
+
+    def __init__(self, documents=()):
+        MemoryCollection.__init__(self, documents)
+        self.cursors = []
+
+    def find(self, query=None, fields=None):
+        cursor = ExpiringCursor(MemoryCollection.find(self, query, fields))
+        cursor.expired = False
+        self.cursors.append(cursor)
+        return cursor
+
+    def wait(self):
+        for cursor in self.cursors:
+            cursor.expired = True
+
+
+class IterPointChunksTest(unittest.TestCase):
+
+    def test_slow_consumer(self):
+        # Several photos at each second, so chunks end part way through one
+        documents = [{"_id": "%d-%d" % (second, n), "latitude": n,
+                      "longitude": second,
+                      "created_time": START + datetime.timedelta(
+                          seconds=second)}
+                     for second in range(20) for n in range(3)]
+        documents.append({"_id": "after", "latitude": 0, "longitude": 0,
+                          "created_time": START + datetime.timedelta(
+                              seconds=30)})
+        ig_mongo = ExpiringCollection(reversed(documents))
+
+        seconds = []
+        num_chunks = 0
+        for lat, lon, t in iter_point_chunks(
+                START, START + datetime.timedelta(seconds=19), ig_mongo,
+                chunk_size=4):
+            ig_mongo.wait()
+            num_chunks += 1
+            self.assertLessEqual(len(t), 4)
+            self.assertEqual(list(lon), list(t))
+            seconds.extend(t)
+        self.assertEqual(num_chunks, 15)
+        self.assertEqual(seconds, sorted(3*range(20)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,154 @@
+"""Slippy-map output: the heatmap as a z/x/y Web Mercator tile pyramid.
+
+Points are projected and sorted once by their quadkey at ``max_zoom``, so the
+points in any tile, at any zoom, are a contiguous run of the sorted arrays.
+``TilePyramid.render`` walks the pyramid depth first, only into tiles that
+hold points.  Tiles at ``max_zoom`` are binned from their points, and every
+other tile is made by summing 2x2 blocks of its four children, so the points
+are only binned once per frame and only one path of tiles is held in memory
+at a time.
+
+``TileWriter`` writes the tiles of one time slot as ``<z>/<x>/<y>.png``,
+with a ``manifest.json`` of the hash of each tile's pixels.  Tiles whose
+pixels haven't changed since the last run are not written again, and tiles
+that have become empty are removed.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+import matplotlib.image
+
+TILE_SIZE = 256
+
+# Web Mercator stops short of the poles
+MAX_LATITUDE = 85.0511287798
+
+
+def mercator_pixels(lat, lon, zoom):
+    """Global pixel coordinates of (lat, lon) at ``zoom``, where the world
+    is ``TILE_SIZE*2**zoom`` pixels across"""
+    size = TILE_SIZE*2**zoom
+    lat = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(lon, dtype=float) + 180)/360*size
+    y = (1 - np.log(np.tan(lat) + 1/np.cos(lat))/np.pi)/2*size
+    return (np.clip(x, 0, size - 1e-6), np.clip(y, 0, size - 1e-6))
+
+
+def quadkey(x, y, zoom):
+    """Interleave the bits of tile coordinates ``x`` and ``y`` at ``zoom``,
+    so that the key of a tile's parent is its own key shifted right by 2"""
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    key = np.zeros_like(x)
+    for bit in range(zoom):
+        key |= ((x >> bit) & 1) << (2*bit)
+        key |= ((y >> bit) & 1) << (2*bit + 1)
+    return key
+
+
+class TilePyramid(object):
+    """The points (lat, lon), ready to render as tiles from ``min_zoom`` to
+    ``max_zoom``.  ``order`` sorts the points into the order that
+    ``render`` expects their weights in"""
+
+    def __init__(self, lat, lon, max_zoom=8, min_zoom=0):
+        self.max_zoom = max_zoom
+        self.min_zoom = min_zoom
+
+        px, py = mercator_pixels(lat, lon, max_zoom)
+        px = px.astype(np.int64)
+        py = py.astype(np.int64)
+        keys = quadkey(px // TILE_SIZE, py // TILE_SIZE, max_zoom)
+        self.order = np.argsort(keys, kind="mergesort")
+        self.keys = keys[self.order]
+        self.pixels = ((py % TILE_SIZE)*TILE_SIZE +
+                       px % TILE_SIZE)[self.order]
+
+    def _point_range(self, zoom, x, y, lo, hi):
+        """Range of the sorted points, within [lo, hi), in tile (x, y)"""
+        shift = 2*(self.max_zoom - zoom)
+        key = int(quadkey(x, y, zoom)) << shift
+        return (lo + np.searchsorted(self.keys[lo:hi], key),
+                lo + np.searchsorted(self.keys[lo:hi], key + (1 << shift)))
+
+    def render(self, weights, write_tile):
+        """Call ``write_tile(zoom, x, y, tile)`` with the (TILE_SIZE,
+        TILE_SIZE) weighted histogram, rows from north to south, of every
+        tile that holds points.  ``weights`` are in sorted order"""
+        if len(self.keys):
+            self._render(0, 0, 0, 0, len(self.keys), weights, write_tile)
+
+    def _render(self, zoom, x, y, lo, hi, weights, write_tile):
+        if zoom == self.max_zoom:
+            tile = np.bincount(self.pixels[lo:hi], weights=weights[lo:hi],
+                               minlength=TILE_SIZE*TILE_SIZE)
+            tile = tile.reshape(TILE_SIZE, TILE_SIZE)
+        else:
+            half = TILE_SIZE // 2
+            tile = np.zeros((TILE_SIZE, TILE_SIZE))
+            for dy in (0, 1):
+                for dx in (0, 1):
+                    child_lo, child_hi = self._point_range(
+                        zoom + 1, 2*x + dx, 2*y + dy, lo, hi)
+                    if child_hi == child_lo:
+                        continue
+                    child = self._render(zoom + 1, 2*x + dx, 2*y + dy,
+                                         child_lo, child_hi, weights,
+                                         write_tile)
+                    tile[dy*half:(dy + 1)*half, dx*half:(dx + 1)*half] = \
+                        child.reshape(half, 2, half, 2).sum(axis=(1, 3))
+
+        if zoom >= self.min_zoom:
+            write_tile(zoom, x, y, tile)
+        return tile
+
+
+class TileWriter(object):
+    """Writes the tiles of one time slot into ``directory``
+
+    :colorize:  Function ``colorize(zoom, tile)`` that turns the weighted
+        histogram of a tile at ``zoom`` into an RGBA image with values in
+        [0, 1]
+    """
+
+    def __init__(self, directory, colorize):
+        self.directory = directory
+        self.colorize = colorize
+        self.manifest_file = os.path.join(directory, "manifest.json")
+        self.old_hashes = {}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.old_hashes = json.load(f)
+        self.hashes = {}
+        self.num_written = 0
+
+    def __call__(self, zoom, x, y, tile):
+        rgba = np.clip(self.colorize(zoom, tile), 0, 1)
+        pixels = (rgba*255).astype(np.uint8)
+        if not pixels[..., 3].any():
+            return
+
+        name = "%d/%d/%d" % (zoom, x, y)
+        digest = hashlib.md5(pixels.data).hexdigest()
+        self.hashes[name] = digest
+        path = os.path.join(self.directory, name + ".png")
+        if self.old_hashes.get(name) == digest and os.path.exists(path):
+            return
+
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        matplotlib.image.imsave(path, pixels)
+        self.num_written += 1
+
+    def close(self):
+        """Remove tiles that are no longer drawn, and save the manifest"""
+        for name in set(self.old_hashes) - set(self.hashes):
+            path = os.path.join(self.directory, name + ".png")
+            if os.path.exists(path):
+                os.remove(path)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        with open(self.manifest_file + ".tmp", "w") as f:
+            json.dump(self.hashes, f)
+        os.rename(self.manifest_file + ".tmp", self.manifest_file)
@@ -0,0 +1,175 @@
+"""Cache of geonames timezone lookups, keyed by quantized coordinates.
+
+Photos cluster heavily in the same places, so most timezone lookups are for
+a point very close to one that has already been looked up.
+``TimezoneCache`` rounds coordinates to a grid (0.1 degrees by default) and
+only asks geonames about the first point it sees in each grid cell.  Results
+are kept in an in-memory LRU and, if a path is given, in SQLite so they
+survive restarts.
+"""
+import json
+import math
+import sqlite3
+import threading
+import collections
+import numpy as np
+
+import profiling
+
+
+class TimezoneCache(object):
+    """Caching wrapper with the same ``find_timezone`` method as
+    ``geonames.GeonamesClient``
+
+    :client:  The ``GeonamesClient`` used on a cache miss
+    :resolution:  Size in degrees of the grid that coordinates are rounded to
+    :path:  SQLite file to keep results in, or None to only cache in memory
+    :max_memory_entries:  Number of grid cells to hold in the in-memory LRU
+
+    ``hits``, ``disk_hits`` and ``misses`` count lookups answered from
+    memory, from SQLite and by geonames respectively.
+
+    The cache can be used from any thread, such as the collector's
+    enricher, with ``lock`` keeping the threads out of each other's way.
+    """
+
+    def __init__(self, client, resolution=0.1, path=None,
+                 max_memory_entries=100000):
+        self.client = client
+        self.resolution = resolution
+        self.max_memory_entries = max_memory_entries
+        self.memory = collections.OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+        self.db = None
+        if path is not None:
+            # The connection is shared between threads under ``lock``
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS timezones ("
+                            "resolution REAL, lat_key INTEGER, "
+                            "lng_key INTEGER, response TEXT, "
+                            "PRIMARY KEY (resolution, lat_key, lng_key))")
+            self.db.commit()
+
+    def key(self, lat, lng):
+        """Grid cell that the point (lat, lng) falls in"""
+        return (int(math.floor(lat/self.resolution)),
+                int(math.floor(lng/self.resolution)))
+
+    def _remember(self, key, response):
+        self.memory[key] = response
+        if len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def lookup(self, key):
+        """Return the cached response for grid cell ``key``, or None"""
+        with self.lock:
+            return self._lookup(key)
+
+    def _lookup(self, key):
+        if key in self.memory:
+            response = self.memory.pop(key)
+            self.memory[key] = response
+            self.hits += 1
+            profiling.count("timezone_cache_hits")
+            return response
+
+        if self.db is not None:
+            row = self.db.execute("SELECT response FROM timezones WHERE "
+                                  "resolution=? AND lat_key=? AND lng_key=?",
+                                  (self.resolution,) + key).fetchone()
+            if row is not None:
+                response = json.loads(row[0])
+                self._remember(key, response)
+                self.disk_hits += 1
+                profiling.count("timezone_cache_disk_hits")
+                return response
+        return None
+
+    def store(self, key, response):
+        """Cache ``response`` for grid cell ``key``.  Writes to SQLite are
+        committed by ``commit``"""
+        with self.lock:
+            self._remember(key, response)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO timezones VALUES "
+                                "(?, ?, ?, ?)", (self.resolution,) + key +
+                                (json.dumps(response),))
+
+    def commit(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+
+    def _fetch(self, key, lat, lng):
+        """Ask geonames about (lat, lng) and cache the answer under ``key``.
+        Errors are raised and not cached"""
+        self.misses += 1
+        profiling.count("geonames_calls")
+        with profiling.span("geonames"):
+            response = self.client.find_timezone({"lat": lat, "lng": lng})
+        self.store(key, response)
+        return response
+
+    def find_timezone(self, params):
+        """Return the geonames timezone response for ``params["lat"]`` and
+        ``params["lng"]``, looking it up only if nothing in the same grid
+        cell has been looked up before"""
+        key = self.key(params["lat"], params["lng"])
+        response = self.lookup(key)
+        if response is None:
+            response = self._fetch(key, params["lat"], params["lng"])
+            self.commit()
+        return response
+
+    def find_timezones(self, lats, lngs, pool=None, rate_limiter=None):
+        """Return a list with the timezone response for each of the points
+        (lats[i], lngs[i]), or None where geonames returned an error.
+
+        Points are deduplicated by grid cell first, so geonames is asked
+        about each uncached cell only once.  ``pool`` and ``rate_limiter``
+        are passed on to ``GeonamesClient.iter_timezones`` for the uncached
+        cells.  Each response is cached as it arrives, and committed even if
+        the lookups are interrupted, so none that were paid for are lost.
+        The cache itself is only touched from the calling thread.
+        """
+        lat_keys = np.floor(np.asarray(lats, dtype=float) /
+                            self.resolution).astype(np.int64)
+        lng_keys = np.floor(np.asarray(lngs, dtype=float) /
+                            self.resolution).astype(np.int64)
+        _, first, inverse = np.unique(lat_keys*(1 << 32) + lng_keys,
+                                      return_index=True, return_inverse=True)
+
+        responses = []
+        missing = []
+        for n, i in enumerate(first):
+            key = (int(lat_keys[i]), int(lng_keys[i]))
+            response = self.lookup(key)
+            if response is None:
+                missing.append((n, key, float(lats[i]), float(lngs[i])))
+            responses.append(response)
+
+        fetched = self.client.iter_timezones(
+            [{"lat": lat, "lng": lng} for _, _, lat, lng in missing],
+            pool=pool, rate_limiter=rate_limiter)
+        try:
+            with profiling.span("geonames", calls=len(missing)):
+                for i, response in fetched:
+                    self.misses += 1
+                    profiling.count("geonames_calls")
+                    n, key, _, _ = missing[i]
+                    if response is not None:
+                        self.store(key, response)
+                        responses[n] = response
+        finally:
+            self.commit()
+
+        return [responses[j] for j in inverse]
+
+    def stats(self):
+        """Return the hit and miss counters as a dict"""
+        return {"hits": self.hits, "disk_hits": self.disk_hits,
+                "misses": self.misses, "memory_entries": len(self.memory)}
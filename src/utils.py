@@ -1,4 +1,5 @@
 import timeit
+import profiling
 from extract_data import get_cursors
 
 class TimedLogger(object):
@@ -9,7 +10,8 @@ class TimedLogger(object):
         codeblock
 
     will either print "message (took X.XXs)" or if the TimedLogger was
-    initialized with a logger, will write it to that log.
+    initialized with a logger, will write it to that log.  The block is
+    also a ``profiling.span`` named ``message``.
     """
 
     def __init__(self, msg, logger=None):
@@ -18,11 +20,14 @@ class TimedLogger(object):
 
     def __enter__(self):
         """Begin timing when you enter the context manager"""
+        self.span = profiling.span(self.base_msg)
+        self.span.__enter__()
         self.start = timeit.default_timer()
 
     def __exit__(self, *args):
         """End timing and write timed ``msg`` to the log"""
         self.end = timeit.default_timer()
+        self.span.__exit__(*args)
 
         interval = self.end - self.start
         msg = "".join([self.base_msg," (took ", str(interval), "s)"])
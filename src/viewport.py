@@ -0,0 +1,86 @@
+"""Geographic bounds of a camera, used to only load the points it can show.
+
+``camera_bounds`` inverts the projection along the edges of the map, widened
+by a few heatmap bins so that points just off the edge still blur into it,
+and returns the latitude/longitude box they enclose.  ``points_query`` turns
+that box into a ``$geoWithin`` query on the GeoJSON ``location`` field, which
+MongoDB answers from its ``2dsphere`` index.
+"""
+import numpy as np
+
+from extract_data import (VALID_POINTS_QUERY, LOCATION_FIELD)
+
+
+def camera_bounds(basemap, nheatmapbins=500, margin_bins=4, nsamples=200):
+    """Return the ``{"south", "north", "west", "east"}`` box in degrees that
+    holds everything within ``margin_bins`` heatmap bins of the map drawn
+    by ``basemap``, or None if that is not a box less than half the globe
+    wide (e.g. the World camera).
+
+    The default margin covers the heatmap blur, a Gaussian with a sigma of
+    one bin that ``gaussian_filter`` truncates at four sigma.
+    """
+    xmargin = margin_bins*(basemap.urcrnrx - basemap.llcrnrx)/nheatmapbins
+    ymargin = margin_bins*(basemap.urcrnry - basemap.llcrnry)/nheatmapbins
+    xs = np.linspace(basemap.llcrnrx - xmargin, basemap.urcrnrx + xmargin,
+                     nsamples)
+    ys = np.linspace(basemap.llcrnry - ymargin, basemap.urcrnry + ymargin,
+                     nsamples)
+    edge_x = np.concatenate([xs, xs, np.repeat(xs[0], nsamples),
+                             np.repeat(xs[-1], nsamples)])
+    edge_y = np.concatenate([np.repeat(ys[0], nsamples),
+                             np.repeat(ys[-1], nsamples), ys, ys])
+    lon, lat = basemap(edge_x, edge_y, inverse=True)
+    lon = np.asarray(lon)
+    lat = np.asarray(lat)
+
+    # Basemap returns huge values for points that are off the globe
+    if not (np.all(np.abs(lat) <= 90) and np.all(np.abs(lon) <= 180)):
+        return None
+    if lon.max() - lon.min() >= 180:
+        return None
+    return {"south": float(lat.min()), "north": float(lat.max()),
+            "west": float(lon.min()), "east": float(lon.max())}
+
+
+def union_bounds(bounds_list):
+    """Smallest box holding every one of ``bounds_list``, or None if any of
+    them is None or the box would be half the globe wide"""
+    if not bounds_list or any(bounds is None for bounds in bounds_list):
+        return None
+    union = {"south": min(bounds["south"] for bounds in bounds_list),
+             "north": max(bounds["north"] for bounds in bounds_list),
+             "west": min(bounds["west"] for bounds in bounds_list),
+             "east": max(bounds["east"] for bounds in bounds_list)}
+    if union["east"] - union["west"] >= 180:
+        return None
+    return union
+
+
+def bounds_mask(bounds, lat, lon):
+    """Boolean array of which of the points (lat, lon) are inside
+    ``bounds``"""
+    return ((lat >= bounds["south"]) & (lat <= bounds["north"]) &
+            (lon >= bounds["west"]) & (lon <= bounds["east"]))
+
+
+def bounds_polygon(bounds, step=1.0):
+    """GeoJSON polygon for a ``camera_bounds`` box.  Edges in MongoDB
+    follow great circles, so the edges along parallels get a vertex every
+    ``step`` degrees to keep them close to the parallel"""
+    nsteps = int(np.ceil((bounds["east"] - bounds["west"])/step)) + 1
+    lons = np.linspace(bounds["west"], bounds["east"], nsteps).tolist()
+    ring = ([[lon, bounds["south"]] for lon in lons] +
+            [[lon, bounds["north"]] for lon in reversed(lons)])
+    ring.append(ring[0])
+    return {"type": "Polygon", "coordinates": [ring]}
+
+
+def points_query(bounds=None):
+    """MongoDB query for the valid points inside ``bounds``, or for every
+    valid point if ``bounds`` is None"""
+    query = dict(VALID_POINTS_QUERY)
+    if bounds is not None:
+        query[LOCATION_FIELD] = {
+            "$geoWithin": {"$geometry": bounds_polygon(bounds)}}
+    return query